@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import json
+import math
+import multiprocessing
+import os
+import random
+import subprocess
+import tempfile
+import time
+import types
+from datetime import datetime
+from typing import Dict, Any, List
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+from llm_backends import LLMBackend, LLMResponse, ResponseStream
+from mock_anthropic_server import make_canned_narrative, write_synthetic_patients
+
+# Benchmarks of the narrative pipeline against an in-process fake backend. They measure
+# what our own code costs per row (prompt building, streaming, JSON extraction, CSV
+# writing) at the row counts we run at, so a change to the hot loop can be compared
+# with the commit before it. Use mock_anthropic_server.py instead to include the HTTP
+# client and the network stack.
+
+# Where the results are saved, one JSON file per benchmark run
+BENCHMARK_RESULTS_DIR = "benchmark_results"
+
+# The input sizes benchmarked by default
+DEFAULT_ROW_COUNTS = [32, 1000, 10000]
+
+# The two ways the pipeline is driven:
+# - narrative: generate_patient_narrative on its own, from a pool of workers
+# - main: the full main() loop, including the CSV input, checkpoint and output files
+BENCHMARK_MODES = ["narrative", "main"]
+
+# The stages of a row we time separately
+STAGES = ["prompt_building", "streaming", "json_extraction", "csv_writing"]
+
+class FakeAPIError(Exception):
+    """
+    An API error raised by the fake backend. It carries a status code and response
+    headers, so the retry policy and scheduler handle it like an Anthropic API error.
+    """
+
+    def __init__(self, status_code: int, retry_after: float = 0.0):
+        super().__init__(f"Fake API error {status_code}")
+        self.status_code = status_code
+        self.response = types.SimpleNamespace(headers={"retry-after": str(retry_after)})
+
+class _FakeStream(ResponseStream):
+    """
+    Streams the text of a fake response in 4-character tokens.
+    """
+
+    def __init__(self, text: str, time_to_first_token: float, tokens_per_second: float, input_tokens: int):
+        super().__init__({})
+        self.text = text
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.usage = {"input_tokens": input_tokens, "output_tokens": 0}
+
+    def __iter__(self):
+        time.sleep(self.time_to_first_token)
+        for i in range(0, len(self.text), 4):
+            if self.tokens_per_second > 0 and i > 0:
+                time.sleep(1.0 / self.tokens_per_second)
+            self.usage["output_tokens"] += 1
+            yield self.text[i:i + 4]
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.time_to_first_token)
+        for i in range(0, len(self.text), 4):
+            # A rate of 0 streams without pacing, which keeps long runs short
+            if self.tokens_per_second > 0 and i > 0:
+                await asyncio.sleep(1.0 / self.tokens_per_second)
+            self.usage["output_tokens"] += 1
+            yield self.text[i:i + 4]
+
+class FakeBackend(LLMBackend):
+    """
+    An in-process backend that answers after a configurable delay with a canned narrative.
+    """
+
+    def __init__(self, latency: float = 0.05, time_to_first_token: float = 0.05, tokens_per_second: float = 0.0,
+                 error_rate: float = 0.0, invalid_rate: float = 0.0, retry_after: float = 0.0, seed: int = 0):
+        """
+        Args:
+            latency: Seconds until the response starts
+            time_to_first_token: Seconds from the start of the response to its first token
+            tokens_per_second: The streaming rate of the response tokens. 0 streams without pacing
+            error_rate: The share (0-1) of requests that fail with a 529 overloaded error
+            invalid_rate: The share (0-1) of responses that are not valid JSON
+            retry_after: The retry-after time (in seconds) sent with the 529 errors
+            seed: The seed of the random choices
+        """
+        self.latency = latency
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.invalid_rate = invalid_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    def _response_text(self):
+        narrative = make_canned_narrative(self.random)
+        text = json.dumps({"gender": self.random.choice(["Male", "Female"]), "narrative": narrative})
+        if self.random.random() < self.invalid_rate:
+            # A truncated response, as the model produces when it runs out of tokens
+            return text[:len(text) // 2]
+        return text
+
+    def _start(self, request: Dict[str, Any]):
+        # Called once the latency has passed. Fails the request or opens its stream
+        self.requests += 1
+        if self.random.random() < self.error_rate:
+            raise FakeAPIError(529, self.retry_after)
+        input_tokens = len(json.dumps(request.get("system", "")) + json.dumps(request["messages"])) // 4
+        return _FakeStream(self._response_text(), self.time_to_first_token, self.tokens_per_second, input_tokens)
+
+    def create(self, request: Dict[str, Any]) -> LLMResponse:
+        time.sleep(self.latency)
+        stream = self._start(request)
+        text = "".join(stream)
+        return LLMResponse(text, stream.usage)
+
+    def stream(self, request: Dict[str, Any]) -> ResponseStream:
+        time.sleep(self.latency)
+        return self._start(request)
+
+    async def astream(self, request: Dict[str, Any]) -> ResponseStream:
+        await asyncio.sleep(self.latency)
+        return self._start(request)
+
+class StageTimer:
+    """
+    Accumulates the time spent in each stage and the per-row latency and attempts.
+    Stage times are summed over all workers, so with concurrency they can add up to more
+    than the wall-clock time of the run.
+    """
+
+    def __init__(self):
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.calls = {stage: 0 for stage in STAGES}
+        self.row_latencies = []
+        self.row_attempts = []
+        # The attempt counter of the row the current asyncio task is working on
+        self.current_attempts = contextvars.ContextVar("current_attempts", default=None)
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] += seconds
+        self.calls[stage] += 1
+
+    def wrap_sync(self, stage: str, function):
+        """
+        Return a version of `function` whose run time counts towards `stage`.
+        """
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_stream(self, function):
+        """
+        Return a version of stream_narrative that is timed and counts the attempts of the row.
+        """
+        async def timed(*args, **kwargs):
+            attempts = self.current_attempts.get()
+            if attempts is not None:
+                attempts[0] += 1
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.add("streaming", time.perf_counter() - start)
+        return timed
+
+    def wrap_row(self, function):
+        """
+        Return a version of generate_patient_narrative that records the latency and attempts of each row.
+        """
+        async def timed(*args, **kwargs):
+            # Each row runs in its own worker task, so the context variable is private to it
+            attempts = [0]
+            self.current_attempts.set(attempts)
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.row_latencies.append(time.perf_counter() - start)
+                self.row_attempts.append(attempts[0])
+        return timed
+
+def percentile(values: List[float], q: float):
+    """
+    Return the q-th percentile (0-100) of the values, using the nearest-rank method.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process in MB, or None where it cannot be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+
+def format_mb(value: float, sign: str = ""):
+    """
+    Format a memory size in MB for the summary lines, e.g. "94 MB", or "n/a" where
+    peak_rss_mb could not measure it (e.g. on Windows).
+    Args:
+        value: The size in MB, or None
+        sign: "+" to show the size as an increase
+    """
+    return "n/a" if value is None else f"{sign}{value:.0f} MB"
+
+def run_case(mode: str, num_rows: int, concurrency: int, backend_options: Dict[str, Any]):
+    """
+    Benchmark one mode at one input size. Runs in a fresh process, so the peak memory and
+    the module state (circuit breaker, token accounting) belong to this case only.
+    Args:
+        mode: One of BENCHMARK_MODES
+        num_rows: The number of synthetic patients to generate narratives for
+        concurrency: The number of narratives generated at the same time
+        backend_options: Keyword arguments for FakeBackend
+    Returns:
+        A dictionary with the measurements of the case.
+    """
+    os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark-key")
+    import narrative_generator5
+    import run_checkpoint
+
+    work_dir = tempfile.mkdtemp(prefix="narrative_benchmark_")
+    input_path = os.path.join(work_dir, "patients.csv")
+    rows = write_synthetic_patients(input_path, num_rows)
+
+    fake_backend = FakeBackend(**backend_options)
+    narrative_generator5.backend = fake_backend
+    # The fake backend has no rate limits, so the scheduler should never hold requests back
+    narrative_generator5.REQUESTS_PER_MINUTE = 10 ** 9
+    narrative_generator5.INPUT_TOKENS_PER_MINUTE = 10 ** 12
+    narrative_generator5.OUTPUT_TOKENS_PER_MINUTE = 10 ** 12
+    narrative_generator5.CSV_FILE_PATH = input_path
+    narrative_generator5.OUTPUT_CSV_FILE_PATH = os.path.join(work_dir, "patients_with_narratives.csv")
+    narrative_generator5.CHECKPOINT_FILE_PATH = os.path.join(work_dir, "patients_with_narratives.checkpoint.jsonl")
+    narrative_generator5.TOKEN_USAGE_FILE_PATH = os.path.join(work_dir, "patients_with_narratives.usage.json")
+
+    # The functions are looked up as module globals at call time, so replacing them
+    # here times every call the pipeline makes
+    timer = StageTimer()
+    narrative_generator5.build_narrative_request = timer.wrap_sync("prompt_building", narrative_generator5.build_narrative_request)
+    narrative_generator5.parse_narrative_response = timer.wrap_sync("json_extraction", narrative_generator5.parse_narrative_response)
+    narrative_generator5.stream_narrative = timer.wrap_stream(narrative_generator5.stream_narrative)
+    narrative_generator5.generate_patient_narrative = timer.wrap_row(narrative_generator5.generate_patient_narrative)
+    run_checkpoint.CheckpointedOutput.complete = timer.wrap_sync("csv_writing", run_checkpoint.CheckpointedOutput.complete)
+
+    # The progress output is part of the cost of a row, so it is still produced, but not shown
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if mode == "main":
+            narrative_generator5.main(concurrency=concurrency)
+        else:
+            patient_data_list = narrative_generator5.load_patient_data(input_path)
+            asyncio.run(_generate_without_output(narrative_generator5, patient_data_list, concurrency))
+        elapsed = time.perf_counter() - start
+
+    rows_done = len(timer.row_latencies)
+    return {
+        "mode": mode,
+        "input_rows": rows,
+        "rows": rows_done,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "rows_per_second": rows_done / elapsed if elapsed else 0.0,
+        "latency_seconds": {
+            "p50": percentile(timer.row_latencies, 50),
+            "p95": percentile(timer.row_latencies, 95),
+            "p99": percentile(timer.row_latencies, 99),
+        },
+        "retries_per_row": sum(max(0, a - 1) for a in timer.row_attempts) / rows_done if rows_done else 0.0,
+        "requests": fake_backend.requests,
+        "peak_rss_mb": peak_rss_mb(),
+        "stage_seconds": timer.seconds,
+        "stage_calls": timer.calls,
+    }
+
+async def _generate_without_output(narrative_generator5, patient_data_list: List[Dict[str, Any]], concurrency: int):
+    """
+    Run generate_patient_narrative over every row from a pool of workers, without writing output.
+    """
+    # Like generate_narratives, only the narratives the prompt shows are kept
+    existing_narratives = collections.deque(maxlen=narrative_generator5.NARRATIVE_EXAMPLES)
+    rows = iter(patient_data_list)
+
+    async def worker():
+        for patient_data in rows:
+            try:
+                narrative_json = await narrative_generator5.generate_patient_narrative(
+                    dict(patient_data), existing_narratives, echo=concurrency == 1
+                )
+            except ValueError:
+                continue
+            existing_narratives.append(json.loads(narrative_json)["narrative"])
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+
+def get_git_commit():
+    """
+    Return the short hash of the checked out commit, or "unknown" outside a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run_benchmarks(row_counts: List[int], modes: List[str], concurrency: int, backend_options: Dict[str, Any]):
+    """
+    Run every mode at every input size, each case in its own process.
+    Returns:
+        A list with the result dictionary of each case.
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for num_rows in row_counts:
+        for mode in modes:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_case, mode, num_rows, concurrency, backend_options).result()
+            latency = result["latency_seconds"]
+            print(f"{mode:>9} {result['rows']:>6} rows: {result['rows_per_second']:8.1f} rows/s, "
+                  f"p50 {latency['p50']:.3f}s p95 {latency['p95']:.3f}s p99 {latency['p99']:.3f}s, "
+                  f"{result['retries_per_row']:.2f} retries/row, peak RSS {format_mb(result['peak_rss_mb'])}")
+            print("          " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result["stage_seconds"].items()))
+            results.append(result)
+    return results
+
+def save_results(results: List[Dict[str, Any]], config: Dict[str, Any], output_dir: str = BENCHMARK_RESULTS_DIR):
+    """
+    Save the results of a benchmark run as JSON.
+    Returns:
+        The path of the saved file. Its name holds the time and the commit, so the files of
+        different commits can be compared side by side.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    commit = get_git_commit()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = os.path.join(output_dir, f"narrative_benchmark_{timestamp}_{commit}.json")
+    with open(path, "w") as results_file:
+        json.dump({"commit": commit, "timestamp": timestamp, "config": config, "results": results}, results_file, indent=2)
+    return path
+
+def parse_args():
+    """
+    Parse the command line options of the benchmark.
+    Returns:
+        An argparse.Namespace with the parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Throughput and latency benchmarks of the narrative pipeline.")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROW_COUNTS, help="Input sizes to benchmark")
+    parser.add_argument("--modes", nargs="+", choices=BENCHMARK_MODES, default=BENCHMARK_MODES, help="Ways to drive the pipeline")
+    parser.add_argument("--concurrency", type=int, default=16, help="Narratives generated at the same time (default: 16)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake seconds until a response starts")
+    parser.add_argument("--ttft", type=float, default=0.05, help="Fake seconds from the response start to the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Fake token rate, 0 for no pacing")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with a 529")
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="Share of responses that are not valid JSON")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fake backend")
+    parser.add_argument("--output-dir", default=BENCHMARK_RESULTS_DIR, help="Directory for the JSON results")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    backend_options = {
+        "latency": args.latency, "time_to_first_token": args.ttft, "tokens_per_second": args.tokens_per_second,
+        "error_rate": args.error_rate, "invalid_rate": args.invalid_rate, "seed": args.seed,
+    }
+    results = run_benchmarks(args.rows, args.modes, args.concurrency, backend_options)
+    path = save_results(results, {"concurrency": args.concurrency, **backend_options}, args.output_dir)
+    print(f"\nSaved the benchmark results to {path}")
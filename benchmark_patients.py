@@ -0,0 +1,219 @@
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, Any, List
+
+from benchmark_narratives import BENCHMARK_RESULTS_DIR, format_mb, get_git_commit, peak_rss_mb
+
+# Scaling benchmarks of patient_generator3, from a thousand to ten million patients. Every
+# stage of a design (planning the group sizes, generating, saving, verifying) is timed on
+# its own, together with the peak memory and the bytes written per row, so we can see
+# where the dictionary-per-patient design stops scaling and compare it with the columnar
+# backend. Every run is appended to a history file and compared with earlier runs.
+
+# The design sizes benchmarked by default
+DEFAULT_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+# The two ways a design is generated:
+# - patients: one dictionary per patient (generate_stratified_patients, save_patients_to_csv,
+#   verify_stratification)
+# - cells: one byte per patient (generate_stratified_cells, save_cells_to_csv,
+#   verify_cell_stratification)
+BENCHMARK_BACKENDS = ["patients", "cells"]
+
+# The stages of a design we time separately
+STAGES = ["group_sizes", "generate", "save", "verify"]
+
+# Every run is appended to this file as one JSON line
+HISTORY_PATH = os.path.join(BENCHMARK_RESULTS_DIR, "patient_benchmark_history.jsonl")
+
+# A stage is flagged as a regression when it takes this many times the median of the
+# same case over the last HISTORY_WINDOW runs of other commits...
+REGRESSION_FACTOR = 1.25
+
+# ...and at least this many seconds more, so noise on millisecond stages is not flagged
+REGRESSION_MIN_SECONDS = 0.05
+
+# The number of earlier runs the median is taken over
+HISTORY_WINDOW = 5
+
+def run_case(backend: str, num_patients: int, seed: int):
+    """
+    Benchmark one design size with one backend. Runs in its own process so the peak
+    memory is that of this case alone.
+    Returns:
+        A dictionary with the timings, memory and output size of the case.
+    """
+    import patient_generator3
+
+    baseline_rss_mb = peak_rss_mb()
+    output_dir = tempfile.mkdtemp(prefix="patient_benchmark_")
+    seconds = {}
+
+    @contextlib.contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        yield
+        seconds[name] = time.perf_counter() - start
+
+    try:
+        with stage("group_sizes"):
+            patient_generator3.calculate_group_sizes(num_patients)
+        # The stratification report is printed for every race, which we do not want to time
+        # against the terminal
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            if backend == "patients":
+                with stage("generate"):
+                    design = patient_generator3.generate_stratified_patients(num_patients, seed)
+                with stage("save"):
+                    path = patient_generator3.save_patients_to_csv(design, output_dir)
+                with stage("verify"):
+                    patient_generator3.verify_stratification(design)
+            else:
+                with stage("generate"):
+                    design = patient_generator3.generate_stratified_cells(num_patients, seed)
+                with stage("save"):
+                    path = patient_generator3.save_cells_to_csv(design, output_dir)
+                with stage("verify"):
+                    patient_generator3.verify_cell_stratification(design)
+        rows = len(design)
+        bytes_written = os.path.getsize(path)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    total = sum(seconds.values())
+    return {
+        "backend": backend,
+        "requested": num_patients,
+        "rows": rows,
+        "stage_seconds": seconds,
+        "total_seconds": total,
+        "rows_per_second": rows / total if total else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        # The memory the case itself needed on top of the interpreter and its imports
+        "peak_rss_increase_mb": peak_rss_mb() - baseline_rss_mb if baseline_rss_mb is not None else None,
+        "bytes_written": bytes_written,
+        "bytes_per_row": bytes_written / rows if rows else 0.0,
+    }
+
+def run_benchmarks(sizes: List[int], backends: List[str], seed: int):
+    """
+    Run every backend at every design size, each case in its own process.
+    The processes exist only to isolate peak RSS, which is a high-water mark of the whole
+    process: a fresh "spawn" process per case (not a forked copy of this one) makes each
+    case's peak memory its own. The timings would be the same in-process.
+    Returns:
+        A list with the result dictionary of each case.
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for num_patients in sizes:
+        for backend in backends:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                try:
+                    result = executor.submit(run_case, backend, num_patients, seed).result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    # Most likely killed for running out of memory, which is a result too
+                    print(f"{backend:>8} {num_patients:>9} patients: the benchmark process died (out of memory?)")
+                    results.append({"backend": backend, "requested": num_patients, "failed": True})
+                    continue
+            print(f"{backend:>8} {result['rows']:>9} patients: {result['total_seconds']:7.2f}s "
+                  f"({result['rows_per_second']:,.0f} rows/s), peak RSS {format_mb(result['peak_rss_mb'])} "
+                  f"({format_mb(result['peak_rss_increase_mb'], '+')}), {result['bytes_per_row']:.1f} bytes/row")
+            print("          " + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in result["stage_seconds"].items()))
+            results.append(result)
+    return results
+
+def load_history(path: str = HISTORY_PATH):
+    """
+    Read the earlier benchmark runs, oldest first. Returns an empty list if there are none.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as history_file:
+        return [json.loads(line) for line in history_file if line.strip()]
+
+def find_regressions(results: List[Dict[str, Any]], history: List[Dict[str, Any]], commit: str):
+    """
+    Compare the results of this run with the median of the same cases in earlier runs.
+    Runs of the same commit are left out, so rerunning a benchmark does not hide a regression.
+    Returns:
+        A list of messages, one per stage or memory peak that got worse.
+    """
+    earlier = [run for run in history if run.get("commit") != commit][-HISTORY_WINDOW:]
+    regressions = []
+    for result in results:
+        if result.get("failed"):
+            continue
+        previous = [
+            case for run in earlier for case in run["results"]
+            if case.get("backend") == result["backend"] and case.get("requested") == result["requested"] and not case.get("failed")
+        ]
+        if not previous:
+            continue
+        label = f"{result['backend']} at {result['requested']} patients"
+        for stage, seconds in result["stage_seconds"].items():
+            earlier_seconds = [case["stage_seconds"][stage] for case in previous if stage in case["stage_seconds"]]
+            if not earlier_seconds:
+                continue
+            baseline = statistics.median(earlier_seconds)
+            if seconds > baseline * REGRESSION_FACTOR and seconds - baseline > REGRESSION_MIN_SECONDS:
+                regressions.append(f"{label}: {stage} took {seconds:.3f}s, median of earlier runs {baseline:.3f}s")
+        memory = [case["peak_rss_increase_mb"] for case in previous if case.get("peak_rss_increase_mb") is not None]
+        if memory and result["peak_rss_increase_mb"] is not None:
+            baseline = statistics.median(memory)
+            if result["peak_rss_increase_mb"] > baseline * REGRESSION_FACTOR and result["peak_rss_increase_mb"] - baseline > 10:
+                regressions.append(f"{label}: peak memory +{result['peak_rss_increase_mb']:.0f} MB, median of earlier runs +{baseline:.0f} MB")
+    return regressions
+
+def append_history(results: List[Dict[str, Any]], config: Dict[str, Any], regressions: List[str], path: str = HISTORY_PATH):
+    """
+    Append this run to the history file.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    run = {
+        "commit": get_git_commit(),
+        "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
+        "config": config,
+        "results": results,
+        "regressions": regressions,
+    }
+    with open(path, "a") as history_file:
+        history_file.write(json.dumps(run) + "\n")
+
+def parse_args():
+    """
+    Parse the command line options of the benchmark.
+    Returns:
+        An argparse.Namespace with the parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Scaling benchmarks of the stratified patient generator.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Design sizes to benchmark")
+    parser.add_argument("--backends", nargs="+", choices=BENCHMARK_BACKENDS, default=BENCHMARK_BACKENDS, help="Ways to generate the design")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the designs")
+    parser.add_argument("--history", default=HISTORY_PATH, help="The JSON lines file runs are appended to and compared with")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if a regression is found")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmarks(args.sizes, args.backends, args.seed)
+    regressions = find_regressions(results, load_history(args.history), get_git_commit())
+    append_history(results, {"seed": args.seed}, regressions, args.history)
+    print(f"\nAppended the results to {args.history}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) against earlier runs:")
+        for message in regressions:
+            print(f"  {message}")
+        if args.fail_on_regression:
+            raise SystemExit(1)
+    else:
+        print("No regressions against earlier runs")
@@ -0,0 +1,216 @@
+import json
+import math
+from fractions import Fraction
+from itertools import product
+from typing import Any, Dict, List, Tuple
+
+# How a requested design size is turned into cell counts:
+# "exact" uses exactly the requested number of patients. Every stratum gets its share by
+# the largest-remainder rule, and a stratum that is not a whole number of complete sets
+# gives its leftover patients to distinct cells, so cell counts differ by at most one.
+# "complete" only uses complete sets of the crossed combinations, so every cell of a
+# stratum has the same count, and discards the rest of the request.
+ALLOCATION_MODES = ("exact", "complete")
+
+# The denominator limit used to turn stratum proportions like 0.25 into exact fractions
+MAX_PROPORTION_DENOMINATOR = 10_000
+
+def largest_remainder(total: int, weights: List[float]):
+    """
+    Split an integer total in proportion to weights (Hamilton's largest-remainder method).
+    Every share gets the floor of its quota, and the units left over go to the shares with
+    the largest fractional parts (ties to the earlier share).
+    Returns:
+        A list of non-negative integers that sum to total.
+    """
+    weight_sum = sum(weights)
+    if total <= 0 or weight_sum <= 0:
+        return [0] * len(weights)
+    quotas = [Fraction(total) * Fraction(weight).limit_denominator(MAX_PROPORTION_DENOMINATOR) for weight in weights]
+    quota_sum = sum(quotas)
+    quotas = [quota * total / quota_sum for quota in quotas]
+    shares = [math.floor(quota) for quota in quotas]
+    by_remainder = sorted(range(len(weights)), key=lambda i: (-(quotas[i] - shares[i]), i))
+    for i in by_remainder[:total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+def balanced_order(sizes: List[int]):
+    """
+    Order the cells of a mixed-radix grid so that every prefix is as balanced as possible.
+    Cell k of the order is the cell whose digits are those of k reversed, so the first
+    factor varies fastest: the first cells alternate between the levels of the first factor,
+    then the second, and so on. Leftover patients handed out in this order keep the
+    marginals of the crossed factors close to even.
+    Returns:
+        A list of cell indices (first factor varying slowest, as in itertools.product).
+    """
+    strides = [math.prod(sizes[i + 1:]) for i in range(len(sizes))]
+    order = []
+    for k in range(math.prod(sizes)):
+        index = 0
+        for size, stride in zip(sizes, strides):
+            k, digit = divmod(k, size)
+            index += digit * stride
+        order.append(index)
+    return order
+
+class DesignConfig:
+    """
+    The factors of a stratified design.
+
+    One factor is the stratification factor: it has a "distribution" of proportions and
+    splits the design into strata (race in our study). Every other factor is fully crossed
+    within each stratum, so each stratum is made of complete sets of their combinations.
+    Any number of factors and levels can be used.
+    """
+
+    def __init__(self, characteristics: Dict[str, Any], allocation: str = "exact"):
+        """
+        Args:
+            characteristics: A dictionary in the shape of patient_generator3.CHARACTERISTICS:
+                exactly one factor maps to {"distribution": {level: proportion}}, the others
+                map to a list of levels
+            allocation: "exact" or "complete", see ALLOCATION_MODES
+        """
+        if allocation not in ALLOCATION_MODES:
+            raise ValueError(f"Unknown allocation '{allocation}', expected one of {ALLOCATION_MODES}")
+        strata = [field for field, spec in characteristics.items() if isinstance(spec, dict)]
+        if len(strata) != 1:
+            raise ValueError(f"Exactly one factor must have a 'distribution', found {len(strata)}")
+        self.stratum_field = strata[0]
+        self.proportions = dict(characteristics[self.stratum_field]['distribution'])
+        self.crossed = [(field, list(levels)) for field, levels in characteristics.items() if field != self.stratum_field]
+        for field, levels in [(self.stratum_field, list(self.proportions))] + self.crossed:
+            if not levels:
+                raise ValueError(f"Factor '{field}' has no levels")
+            if len(set(levels)) != len(levels):
+                raise ValueError(f"Factor '{field}' has duplicate levels")
+        if any(proportion < 0 for proportion in self.proportions.values()) or sum(self.proportions.values()) <= 0:
+            raise ValueError(f"The proportions of '{self.stratum_field}' must be non-negative and not all zero")
+        self.allocation = allocation
+        self.cells_per_stratum = math.prod(len(levels) for _, levels in self.crossed)
+        self.cell_order = balanced_order([len(levels) for _, levels in self.crossed])
+
+    def levels(self) -> List[Tuple[str, List[str]]]:
+        """
+        List the levels of every factor: the stratification factor first, then the crossed
+        factors, which is also the order of the joint cell codes.
+        """
+        return [(self.stratum_field, list(self.proportions))] + [(field, list(levels)) for field, levels in self.crossed]
+
+    def balanced_unit(self):
+        """
+        The smallest design size that is perfectly balanced: every stratum gets exactly its
+        proportion and is a whole number of complete sets. It is the number of crossed
+        combinations times the least common multiple of the proportions' denominators.
+        Every perfectly balanced design is a multiple of it.
+        """
+        total = sum(Fraction(p).limit_denominator(MAX_PROPORTION_DENOMINATOR) for p in self.proportions.values())
+        denominators = [
+            (Fraction(p).limit_denominator(MAX_PROPORTION_DENOMINATOR) / total).denominator
+            for p in self.proportions.values()
+        ]
+        return self.cells_per_stratum * math.lcm(*denominators)
+
+def load_design_config(path: str):
+    """
+    Load a design from a JSON config file such as
+    {"allocation": "exact", "factors": {"race": {"distribution": {"Black": 0.5, "White": 0.5}},
+    "gender": ["Male", "Female"], "pain_intensity": ["low", "moderate", "high"]}}.
+    Args:
+        path: The path of the config file
+    Returns:
+        A DesignConfig.
+    """
+    with open(path, "r") as config_file:
+        config = json.load(config_file)
+    return DesignConfig(config['factors'], config.get('allocation', "exact"))
+
+class DesignPlan:
+    """
+    The cell counts of a design of a requested size, computed before any patient is generated.
+
+    Every stratum i holds full_sets[i] complete sets of the crossed combinations followed by
+    one patient in each cell of extra_cells[i]. The extra cells of successive strata continue
+    through DesignConfig.cell_order where the previous stratum stopped, so leftovers are
+    spread over the cells instead of piling up on the first ones.
+    """
+
+    def __init__(self, config: DesignConfig, num_patients: int):
+        """
+        Args:
+            config: The DesignConfig of the design
+            num_patients: The number of patients requested
+        """
+        self.config = config
+        self.requested = num_patients
+        cells = config.cells_per_stratum
+        weights = list(config.proportions.values())
+        if config.allocation == "complete":
+            sizes = [sets * cells for sets in largest_remainder(num_patients // cells, weights)]
+        else:
+            sizes = largest_remainder(num_patients, weights)
+        self.stratum_sizes = dict(zip(config.proportions, sizes))
+        self.full_sets = []
+        self.extra_cells = []
+        offset = 0
+        for size in sizes:
+            sets, extra = divmod(size, cells)
+            self.full_sets.append(sets)
+            self.extra_cells.append([config.cell_order[(offset + k) % cells] for k in range(extra)])
+            offset += extra
+        self.total = sum(sizes)
+        # Rows of the request that the design does not use. Each would have been an API call
+        self.discarded = num_patients - self.total
+
+    def stratum_cells(self, stratum_index: int):
+        """
+        List the crossed cell of every patient of a stratum, in design order.
+        """
+        return list(range(self.config.cells_per_stratum)) * self.full_sets[stratum_index] + self.extra_cells[stratum_index]
+
+    def cell_counts(self):
+        """
+        Return the joint cell counts as a list indexed by cell code (stratum first).
+        """
+        cells = self.config.cells_per_stratum
+        counts = []
+        for sets, extra_cells in zip(self.full_sets, self.extra_cells):
+            stratum_counts = [sets] * cells
+            for cell in extra_cells:
+                stratum_counts[cell] += 1
+            counts.extend(stratum_counts)
+        return counts
+
+    def is_perfectly_balanced(self):
+        """
+        Whether every stratum matches its proportion exactly and all its cells have the same count.
+        """
+        return not any(self.extra_cells) and self.total % self.config.balanced_unit() == 0
+
+    def report(self):
+        """
+        Describe the allocation of the design before it is generated.
+        Returns:
+            A list of lines to print.
+        """
+        config = self.config
+        unit = config.balanced_unit()
+        lines = [
+            f"Design: {len(config.proportions)} {config.stratum_field} strata x {config.cells_per_stratum} combinations "
+            f"of {', '.join(field for field, _ in config.crossed)} ({config.allocation} allocation)",
+            f"Requested {self.requested} patients, allocated {self.total}, discarded {self.discarded}",
+        ]
+        for (stratum, size), sets, extra_cells in zip(self.stratum_sizes.items(), self.full_sets, self.extra_cells):
+            extra = f" + {len(extra_cells)} leftover patients in distinct cells" if extra_cells else ""
+            lines.append(f"  {stratum}: {size} patients ({sets} complete sets{extra})")
+        if self.is_perfectly_balanced():
+            lines.append("Every cell of every stratum has the same count")
+        else:
+            below = (self.requested // unit) * unit
+            lines.append(
+                f"Perfectly balanced designs are multiples of {unit} patients: "
+                f"the nearest are {below} and {below + unit}"
+            )
+        return lines
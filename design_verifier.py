@@ -0,0 +1,324 @@
+import argparse
+import csv
+import math
+from itertools import combinations, product
+from typing import Any, Dict, Iterable, List, Tuple
+
+# NumPy makes counting code arrays (columnar designs, Parquet and Arrow files) vectorized
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Parquet and Arrow IPC files are counted batch by batch with pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from patient_tables import file_format_from_path
+
+# The number of rows counted per step when reading a file
+BATCH_SIZE = 1_000_000
+
+def chi_square_p_value(statistic: float, df: int):
+    """
+    The probability of a chi-square statistic at least this large with df degrees of freedom,
+    i.e. the regularized upper incomplete gamma function Q(df / 2, statistic / 2).
+    Uses the series expansion below a + 1 and the continued fraction above it, which both
+    converge quickly there, so SciPy is not needed.
+    """
+    if df <= 0 or statistic <= 0:
+        return 1.0
+    a = df / 2.0
+    x = statistic / 2.0
+    log_prefactor = -x + a * math.log(x) - math.lgamma(a)
+    if x < a + 1:
+        term = total = 1.0 / a
+        n = a
+        for _ in range(10_000):
+            n += 1
+            term *= x / n
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return min(1.0, max(0.0, 1.0 - total * math.exp(log_prefactor)))
+    # Modified Lentz's method
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    result = d
+    for i in range(1, 10_000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        result *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return min(1.0, max(0.0, result * math.exp(log_prefactor)))
+
+def chi_square_test(name: str, observed: List[int], expected: List[float], df: int):
+    """
+    Pearson's chi-square test of observed counts against expected counts.
+    Cells with an expected count of 0 are left out.
+    Returns:
+        A dictionary with the name, statistic, df and p_value of the test.
+    """
+    statistic = sum((o - e) ** 2 / e for o, e in zip(observed, expected) if e > 0)
+    return {"name": name, "statistic": statistic, "df": df, "p_value": chi_square_p_value(statistic, df)}
+
+class StratificationCounter:
+    """
+    Counts every joint cell of a design with any number of factors in a single pass.
+
+    The joint counts are kept as one flat list indexed by the mixed-radix code of the cell,
+    with the first factor varying slowest (the cell codes of patient_generator3 use the same
+    order). Every marginal and every pairwise table is summed from the joint counts, which
+    are tiny next to the design, so no second pass over the patients is ever needed.
+    Rows can be added in any number of calls, so streamed designs never have to be in memory.
+    """
+
+    def __init__(self, factors: List[Tuple[str, List[str]]], expected: Dict[str, List[float]] = None):
+        """
+        Args:
+            factors: A list of (field name, levels) tuples, e.g. patient_generator3.get_cell_levels()
+            expected: Optional expected proportions of the levels of some factors, for the
+                marginal tests. Factors without expected proportions are expected to be uniform
+        """
+        self.factors = factors
+        self.fields = [field for field, _ in factors]
+        self.sizes = [len(values) for _, values in factors]
+        self.level_codes = {field: {value: code for code, value in enumerate(values)} for field, values in factors}
+        self.strides = [math.prod(self.sizes[i + 1:]) for i in range(len(self.sizes))]
+        self.num_cells = math.prod(self.sizes)
+        self.expected = expected or {}
+        self.counts = [0] * self.num_cells
+        self.total = 0
+
+    def _cell_index(self, values):
+        try:
+            return sum(self.level_codes[field][value] * stride for field, value, stride in zip(self.fields, values, self.strides))
+        except KeyError as e:
+            raise ValueError(f"Unknown level {e.args[0]!r} in a design with factors {self.fields}") from None
+
+    def update_rows(self, rows: Iterable[Dict[str, Any]]):
+        """
+        Count patient dictionaries, e.g. a list, a csv.DictReader or a StratifiedDesign.
+        """
+        tally = {}
+        for row in rows:
+            key = tuple([row[field] for field in self.fields])
+            tally[key] = tally.get(key, 0) + 1
+        # Only distinct combinations are translated to cell indices
+        for key, count in tally.items():
+            self.counts[self._cell_index(key)] += count
+            self.total += count
+
+    def update_cells(self, cells):
+        """
+        Count an array of joint cell codes, e.g. from patient_generator3.generate_stratified_cells.
+        """
+        counts = np.bincount(np.asarray(cells).ravel(), minlength=self.num_cells)
+        if len(counts) > self.num_cells:
+            raise ValueError(f"Cell code {len(counts) - 1} is out of range for {self.num_cells} cells")
+        for index, count in enumerate(counts.tolist()):
+            self.counts[index] += count
+        self.total += int(counts.sum())
+
+    def update_codes(self, codes: Dict[str, Any]):
+        """
+        Count a design given as one integer code array per factor, indexing the factor's
+        levels (e.g. patient_generator3.decode_cells without the levels).
+        """
+        cells = np.zeros(len(codes[self.fields[0]]), dtype=np.int64)
+        for field, stride in zip(self.fields, self.strides):
+            cells += np.asarray(codes[field], dtype=np.int64) * stride
+        self.update_cells(cells)
+
+    def update_table_batch(self, batch):
+        """
+        Count a pyarrow RecordBatch or Table whose columns include every factor.
+        Dictionary-encoded columns are counted through their codes, so no strings are
+        created per row.
+        """
+        codes = {}
+        for field in self.fields:
+            column = batch.column(batch.schema.get_field_index(field))
+            chunks = column.chunks if hasattr(column, "chunks") else [column]
+            field_codes = []
+            for chunk in chunks:
+                if not pa.types.is_dictionary(chunk.type):
+                    chunk = chunk.dictionary_encode()
+                if chunk.null_count:
+                    raise ValueError(f"Column '{field}' contains missing values")
+                # Translate the chunk's own dictionary to our level codes
+                try:
+                    lookup = np.array([self.level_codes[field][value] for value in chunk.dictionary.to_pylist()], dtype=np.int64)
+                except KeyError as e:
+                    raise ValueError(f"Unknown level {e.args[0]!r} in column '{field}'") from None
+                indices = chunk.indices.to_numpy(zero_copy_only=False)
+                field_codes.append(lookup[indices] if len(lookup) else indices.astype(np.int64))
+            codes[field] = np.concatenate(field_codes) if field_codes else np.zeros(0, dtype=np.int64)
+        self.update_codes(codes)
+
+    def update_file(self, path: str, batch_size: int = BATCH_SIZE):
+        """
+        Count a CSV, Parquet or Arrow IPC patient file, one batch at a time.
+        """
+        file_format = file_format_from_path(path)
+        if file_format == "csv":
+            with open(path, "r", newline='') as csv_file:
+                self.update_rows(csv.DictReader(csv_file))
+            return
+        if pa is None or np is None:
+            raise ImportError("Counting Parquet and Arrow files requires pyarrow and numpy")
+        if file_format == "parquet":
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=self.fields):
+                self.update_table_batch(batch)
+        else:
+            with pa.memory_map(path, "r") as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    self.update_table_batch(reader.get_batch(i))
+
+    def _levels_of(self, index):
+        return [(index // stride) % size for stride, size in zip(self.strides, self.sizes)]
+
+    def table(self, fields: List[str]):
+        """
+        Sum the joint counts over every factor not in fields.
+        Returns:
+            A dictionary mapping each combination of levels of fields, in factor order, to its count.
+        """
+        positions = [self.fields.index(field) for field in fields]
+        counts = {
+            tuple(values): 0
+            for values in product(*(self.factors[position][1] for position in positions))
+        }
+        for index, count in enumerate(self.counts):
+            codes = self._levels_of(index)
+            counts[tuple(self.factors[position][1][codes[position]] for position in positions)] += count
+        return counts
+
+    def marginal(self, field: str):
+        """
+        Return a dictionary mapping each level of a factor to its count.
+        """
+        return {key[0]: count for key, count in self.table([field]).items()}
+
+    def joint(self):
+        """
+        Return a dictionary mapping every combination of all factors to its count.
+        """
+        return {
+            tuple(values): self.counts[self._cell_index(values)]
+            for values in product(*(values for _, values in self.factors))
+        }
+
+    def stratum_counts(self, stratum_field: str):
+        """
+        Split the joint counts by the levels of the stratification factor.
+        Returns:
+            A dictionary mapping each level of stratum_field to a dictionary that maps every
+            combination of the other factors to its count.
+        """
+        others = [field for field in self.fields if field != stratum_field]
+        table = self.table([stratum_field] + others)
+        strata = {level: {} for level in self.factors[self.fields.index(stratum_field)][1]}
+        for key, count in table.items():
+            strata[key[0]][key[1:]] = count
+        return strata
+
+    def balance_tests(self, stratum_field: str = None):
+        """
+        Chi-square tests of the balance of the design:
+        - each factor's marginal against its expected proportions (uniform by default),
+        - the independence of every pair of factors,
+        - if stratum_field is given, the uniformity of the combinations of the other factors
+          within each of its levels, which is what perfect stratification means.
+        A perfectly balanced design has every statistic 0 and every p-value 1.
+        Returns:
+            A list of dictionaries with the name, statistic, df and p_value of each test.
+        """
+        tests = []
+        if not self.total:
+            return tests
+        for field, values in self.factors:
+            observed = list(self.marginal(field).values())
+            proportions = self.expected.get(field) or [1.0 / len(values)] * len(values)
+            tests.append(chi_square_test(
+                f"{field} marginal", observed, [p * self.total for p in proportions], len(values) - 1,
+            ))
+        for first, second in combinations(self.fields, 2):
+            table = self.table([first, second])
+            first_totals = self.marginal(first)
+            second_totals = self.marginal(second)
+            expected = [first_totals[a] * second_totals[b] / self.total for a, b in table]
+            df = (len(first_totals) - 1) * (len(second_totals) - 1)
+            tests.append(chi_square_test(f"{first} x {second} independence", list(table.values()), expected, df))
+        if stratum_field is not None:
+            for level, cells in self.stratum_counts(stratum_field).items():
+                stratum_total = sum(cells.values())
+                if not stratum_total:
+                    continue
+                expected = [stratum_total / len(cells)] * len(cells)
+                tests.append(chi_square_test(
+                    f"cells within {stratum_field}={level}", list(cells.values()), expected, len(cells) - 1,
+                ))
+        return tests
+
+def print_stratification_report(counter: StratificationCounter, stratum_field: str = "race"):
+    """
+    Print the per-stratum verification of a design and its chi-square balance tests.
+    Args:
+        counter: A StratificationCounter holding the counts of the design
+        stratum_field: The factor the design is stratified by
+    """
+    for level, cells in counter.stratum_counts(stratum_field).items():
+        stratum_total = sum(cells.values())
+        if not stratum_total:
+            continue
+
+        print(f"\nVerification for {level} group ({stratum_total} patients):")
+        # Perfect when every combination of the other factors appears equally often
+        spread = max(cells.values()) - min(cells.values())
+        if spread == 0:
+            print("Perfect stratification: Yes")
+        elif spread == 1:
+            # The best possible when the group is not a whole number of complete sets
+            print("Perfect stratification: No (cell counts differ by at most one)")
+        else:
+            print("Perfect stratification: No")
+        for combination, count in cells.items():
+            print(f"  {', '.join(combination)} ({count/stratum_total*100:.1f}%)")
+
+    print("\nBalance tests (chi-square):")
+    for test in counter.balance_tests(stratum_field):
+        print(f"  {test['name']}: chi2={test['statistic']:.3f}, df={test['df']}, p={test['p_value']:.4f}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Verify the stratification of a patient design file.")
+    parser.add_argument("path", help="A CSV, Parquet or Arrow IPC patient file")
+    parser.add_argument("--stratum", default=None, help="The factor the design is stratified by (default: that of the design config)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    # Imported here because patient_generator3 imports this module for its own verification
+    from patient_generator3 import make_stratification_counter
+
+    args = parse_args(argv)
+    counter = make_stratification_counter()
+    counter.update_file(args.path)
+    print(f"{counter.total} patients in {args.path}")
+    print_stratification_report(counter, args.stratum or counter.fields[0])
+
+if __name__ == "__main__":
+    main()
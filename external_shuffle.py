@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+
+# The external shuffle works on NumPy code arrays
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The number of rows a spill bucket holds on average. A bucket is the largest thing the
+# shuffle keeps in memory, so this bounds its peak memory (about 10 MB for uint8 codes)
+BUCKET_ROWS = 10_000_000
+
+class ExternalShuffler:
+    """
+    Shuffles more codes than fit in memory, using spill buckets on disk.
+
+    Every code that is added goes to a uniformly random bucket file. Reading the buckets
+    back one at a time and shuffling each one in memory gives a uniformly random permutation
+    of everything that was added, while memory only ever holds one bucket. The codes
+    themselves are never changed, so a stratified design keeps its exact cell counts.
+
+    Use it as a context manager so the spill files are removed even if writing fails.
+    """
+
+    def __init__(self, num_rows, dtype, seed, bucket_rows=BUCKET_ROWS, spill_dir=None):
+        """
+        Args:
+            num_rows: The number of codes that will be added, used to size the buckets
+            dtype: The NumPy dtype of the codes
+            seed: Seed of the bucket assignment and of the in-bucket shuffles
+            bucket_rows: The average number of codes per bucket
+            spill_dir: The directory the spill files are created in. Defaults to the
+                system temporary directory; it needs room for the whole design
+        """
+        if np is None:
+            raise ImportError("The external shuffle requires NumPy (pip install numpy)")
+        self.dtype = np.dtype(dtype)
+        self.num_buckets = max(1, -(-num_rows // bucket_rows))
+        # One stream assigns buckets and another shuffles within them, so the two are
+        # independent of how the codes were chunked when they were added
+        self.assign_rng, self.shuffle_rng = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(2)]
+        self.spill_dir = tempfile.mkdtemp(prefix="design_shuffle_", dir=spill_dir)
+        self.paths = [os.path.join(self.spill_dir, f"bucket_{i}.bin") for i in range(self.num_buckets)]
+        self.files = [open(path, 'wb') for path in self.paths]
+        self.num_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, codes):
+        """
+        Spill a chunk of codes to randomly chosen buckets.
+        """
+        codes = np.asarray(codes, dtype=self.dtype)
+        if self.num_buckets == 1:
+            self.files[0].write(codes.tobytes())
+        else:
+            buckets = self.assign_rng.integers(0, self.num_buckets, size=len(codes))
+            # Group the chunk by bucket with one sort, then append each run to its file
+            order = np.argsort(buckets, kind='stable')
+            bounds = np.concatenate(([0], np.cumsum(np.bincount(buckets, minlength=self.num_buckets))))
+            grouped = codes[order]
+            for bucket, file in enumerate(self.files):
+                if bounds[bucket + 1] > bounds[bucket]:
+                    file.write(grouped[bounds[bucket]:bounds[bucket + 1]].tobytes())
+        self.num_rows += len(codes)
+
+    def shuffled_chunks(self):
+        """
+        Read the buckets back one at a time, each shuffled in memory.
+        Every bucket file is deleted as soon as it has been read.
+        Yields:
+            NumPy arrays of codes. Concatenated, they are a uniform random permutation
+            of every code that was added.
+        """
+        for file in self.files:
+            file.close()
+        for path in self.paths:
+            bucket = np.fromfile(path, dtype=self.dtype)
+            os.remove(path)
+            self.shuffle_rng.shuffle(bucket)
+            yield bucket
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,320 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+import urllib.request
+from typing import Dict, Any, List, Optional
+
+# The usage fields we keep for every response. Backends that do not report a field leave it out
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+def usage_to_dict(usage):
+    """
+    Convert an Anthropic usage object into a plain dictionary of token counts.
+    Args:
+        usage: The usage object of a message or stream event, or None
+    Returns:
+        A dictionary with the usage fields the object reports.
+    """
+    if usage is None:
+        return {}
+    return {field: getattr(usage, field) for field in USAGE_FIELDS if getattr(usage, field, None) is not None}
+
+def content_to_text(content):
+    """
+    Join the content blocks of an Anthropic message into the response text.
+    Args:
+        content: The content blocks of a message
+    Returns:
+        The text of the text blocks. A tool_use block (structured output) contributes its
+        input as JSON, so callers parse it like a JSON text response.
+    """
+    parts = []
+    for block in content:
+        if block.type == "text":
+            parts.append(block.text)
+        elif block.type == "tool_use":
+            parts.append(json.dumps(block.input))
+    return "".join(parts)
+
+class LLMResponse:
+    """
+    The complete (non-streamed) response of a backend.
+    """
+
+    def __init__(self, text: str, usage: Dict[str, int] = None, headers=None):
+        self.text = text
+        self.usage = usage or {}
+        self.headers = headers or {}
+
+class ResponseStream:
+    """
+    A streamed response of a backend. Iterating over it yields the text chunks as they
+    arrive. The response headers are available straight away, and `usage` is filled in
+    while the stream is consumed.
+    """
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.usage = {}
+
+    async def aclose(self):
+        """
+        Stop a stream early and release its connection, e.g. when the response turned out to be unusable.
+        """
+        pass
+
+class LLMBackend(ABC):
+    """
+    The interface every LLM provider implements.
+
+    Requests are passed in the Messages API shape used throughout the generators:
+    a dictionary with model, max_tokens, temperature, system and messages. Each backend
+    translates it into its own API. A backend that misses one of the methods cannot be
+    created, so it fails at startup instead of in the middle of a run.
+    """
+
+    @abstractmethod
+    def create(self, request: Dict[str, Any]) -> LLMResponse:
+        """
+        Send a request and wait for the complete response.
+        """
+
+    @abstractmethod
+    def stream(self, request: Dict[str, Any]) -> ResponseStream:
+        """
+        Send a request and return a stream that yields the response text as it is generated.
+        """
+
+    @abstractmethod
+    async def astream(self, request: Dict[str, Any]) -> ResponseStream:
+        """
+        The asyncio version of stream. The returned stream is consumed with `async for`.
+        """
+
+class _AnthropicStream(ResponseStream):
+    """
+    Text chunks of a (sync or async) Anthropic Messages stream.
+    """
+
+    def __init__(self, events):
+        # The stream keeps the underlying HTTP response, whose headers carry the rate limits
+        response = getattr(events, "response", None)
+        super().__init__(getattr(response, "headers", None))
+        self.events = events
+
+    def _handle(self, event):
+        event_type = getattr(event, "type", None)
+        # The message_start event carries the input token usage, including prompt cache hits,
+        # and the message_delta event the number of output tokens actually generated
+        if event_type == "message_start":
+            self.usage.update(usage_to_dict(event.message.usage))
+        elif event_type == "message_delta":
+            self.usage["output_tokens"] = event.usage.output_tokens
+        if hasattr(event, "delta") and hasattr(event.delta, "text"):
+            return event.delta.text
+        # A forced tool call streams its input as pieces of JSON text
+        if hasattr(event, "delta") and hasattr(event.delta, "partial_json"):
+            return event.delta.partial_json
+        return None
+
+    def __iter__(self):
+        for event in self.events:
+            text = self._handle(event)
+            if text:
+                yield text
+
+    async def __aiter__(self):
+        async for event in self.events:
+            text = self._handle(event)
+            if text:
+                yield text
+
+    async def aclose(self):
+        # The sync SDK stream closes synchronously, the async one has to be awaited
+        result = self.events.close()
+        if asyncio.iscoroutine(result):
+            await result
+
+class AnthropicBackend(LLMBackend):
+    """
+    The hosted Anthropic Messages API, used for production runs.
+    """
+
+    def __init__(self, client=None, async_client=None):
+        """
+        Args:
+            client: An anthropic.Client for create and stream
+            async_client: An anthropic.AsyncClient for astream
+        """
+        self.client = client
+        self.async_client = async_client
+
+    def create(self, request: Dict[str, Any]) -> LLMResponse:
+        message = self.client.messages.create(**request)
+        return LLMResponse(content_to_text(message.content), usage_to_dict(message.usage))
+
+    def stream(self, request: Dict[str, Any]) -> ResponseStream:
+        return _AnthropicStream(self.client.messages.create(stream=True, **request))
+
+    async def astream(self, request: Dict[str, Any]) -> ResponseStream:
+        return _AnthropicStream(await self.async_client.messages.create(stream=True, **request))
+
+def _flatten_text(content):
+    """
+    Join the text of a string or a list of Messages API content blocks.
+    """
+    if isinstance(content, str):
+        return content
+    return "\n".join(block.get("text", "") for block in content if block.get("type", "text") == "text")
+
+def to_chat_completions_messages(request: Dict[str, Any]) -> List[Dict[str, str]]:
+    """
+    Translate the system prompt and messages of a Messages API request into the
+    OpenAI chat completions message list.
+    """
+    messages = []
+    system = _flatten_text(request.get("system", ""))
+    if system:
+        messages.append({"role": "system", "content": system})
+    for message in request.get("messages", []):
+        messages.append({"role": message["role"], "content": _flatten_text(message["content"])})
+    return messages
+
+class _ChatCompletionsStream(ResponseStream):
+    """
+    Text chunks of an OpenAI-compatible server-sent events stream.
+    """
+
+    def __init__(self, response):
+        super().__init__(response.headers)
+        self.response = response
+
+    def close(self):
+        self.response.close()
+
+    def __iter__(self):
+        with self.response:
+            for raw_line in self.response:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage"):
+                    self.usage["input_tokens"] = chunk["usage"].get("prompt_tokens", 0)
+                    self.usage["output_tokens"] = chunk["usage"].get("completion_tokens", 0)
+                for choice in chunk.get("choices", []):
+                    delta = choice.get("delta") or {}
+                    text = delta.get("content")
+                    if text:
+                        yield text
+                    # The arguments of a forced tool call arrive as pieces of JSON text
+                    for tool_call in delta.get("tool_calls") or []:
+                        arguments = (tool_call.get("function") or {}).get("arguments")
+                        if arguments:
+                            yield arguments
+
+class _ThreadedAsyncStream(ResponseStream):
+    """
+    Adapts a blocking stream for asyncio by reading each chunk in a worker thread.
+    """
+
+    def __init__(self, stream: ResponseStream):
+        super().__init__(stream.headers)
+        self.stream = stream
+        # The usage dictionary is shared, so it fills in as the wrapped stream is consumed
+        self.usage = stream.usage
+        self.iterator = iter(stream)
+
+    def __aiter__(self):
+        return self
+
+    async def aclose(self):
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+    async def __anext__(self):
+        done = object()
+        text = await asyncio.to_thread(next, self.iterator, done)
+        if text is done:
+            raise StopAsyncIteration
+        return text
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Any server that implements the OpenAI chat completions API, such as a llama.cpp or
+    vLLM server running a local model. Used for pilot runs and load tests at no cost.
+    """
+
+    def __init__(self, base_url: str, model: Optional[str] = None, api_key: Optional[str] = None, timeout: float = 600.0):
+        """
+        Args:
+            base_url: The server address, e.g. "http://localhost:8080"
+            model: The model name to send instead of the one in the request. Local servers
+                usually serve a single model under their own name
+            api_key: A bearer token, if the server requires one
+            timeout: The number of seconds to wait for the server
+        """
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def _open(self, request: Dict[str, Any], stream: bool):
+        body = {
+            "model": self.model or request["model"],
+            "messages": to_chat_completions_messages(request),
+            "max_tokens": request["max_tokens"],
+            "temperature": request.get("temperature", 1.0),
+            "stream": stream,
+        }
+        if stream:
+            body["stream_options"] = {"include_usage": True}
+        if request.get("tools"):
+            # Messages API tools map onto chat completions functions with the same JSON schema
+            body["tools"] = [
+                {"type": "function", "function": {
+                    "name": tool["name"], "description": tool.get("description", ""), "parameters": tool["input_schema"],
+                }}
+                for tool in request["tools"]
+            ]
+            tool_choice = request.get("tool_choice") or {}
+            if tool_choice.get("type") == "tool":
+                body["tool_choice"] = {"type": "function", "function": {"name": tool_choice["name"]}}
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        http_request = urllib.request.Request(
+            f"{self.base_url}/v1/chat/completions",
+            data=json.dumps(body).encode("utf-8"),
+            headers=headers,
+            method="POST",
+        )
+        # urllib raises HTTPError for error responses. It carries the status code and headers,
+        # so the retry policy classifies it like an Anthropic API error
+        return urllib.request.urlopen(http_request, timeout=self.timeout)
+
+    def create(self, request: Dict[str, Any]) -> LLMResponse:
+        with self._open(request, stream=False) as response:
+            data = json.loads(response.read())
+            headers = response.headers
+        usage = data.get("usage") or {}
+        message = data["choices"][0]["message"]
+        # A tool call's arguments are already the JSON text of the structured output
+        tool_calls = message.get("tool_calls") or []
+        text = tool_calls[0]["function"]["arguments"] if tool_calls else message.get("content") or ""
+        return LLMResponse(
+            text,
+            {"input_tokens": usage.get("prompt_tokens", 0), "output_tokens": usage.get("completion_tokens", 0)},
+            headers,
+        )
+
+    def stream(self, request: Dict[str, Any]) -> ResponseStream:
+        return _ChatCompletionsStream(self._open(request, stream=True))
+
+    async def astream(self, request: Dict[str, Any]) -> ResponseStream:
+        stream = await asyncio.to_thread(self.stream, request)
+        return _ThreadedAsyncStream(stream)
@@ -0,0 +1,648 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A local stand-in for the Messages API, used to measure the narrative generator's
+# throughput without spending money or depending on the network. It speaks the same
+# server-sent events protocol as the real API, so the unmodified Anthropic client and
+# narrative_generator5 can run against it. It also emulates the Message Batches API,
+# so the batch mode of narrative_batches can be run offline too.
+
+# The sentences the canned narratives are assembled from. Each narrative uses a seeded
+# selection of them, so runs are reproducible but narratives differ from each other
+CANNED_SENTENCES = [
+    "I have thought about this decision for a long time.",
+    "My family has listened to me and they support my choice.",
+    "Every morning feels heavier than the one before.",
+    "I want to decide how my story ends while I still can.",
+    "My children told me they will stand beside me.",
+    "I am not afraid of what comes next.",
+    "The pain has become the loudest voice in my life.",
+    "I have made peace with the people I love.",
+    "My spouse and I have talked about this many times.",
+    "I ask for the chance to leave with dignity.",
+    "There are days when I barely recognise myself.",
+    "I have said everything I needed to say.",
+    "My brother held my hand when I told him, and he agreed.",
+    "I do not want my last months to be only suffering.",
+    "I have weighed this against every other option I was given.",
+    "My daughter understands why I am asking for this.",
+    "Waiting longer would only take more from me.",
+    "I have lived a full life and I am grateful for it.",
+    "My family gave me their blessing after many long conversations.",
+    "This is the most important choice I will ever make.",
+    "I want my grandchildren to remember me as I am now.",
+    "I feel calm when I think about this decision.",
+    "The doctors have been honest with me about what lies ahead.",
+    "I have no doubt left in my mind.",
+    "My partner said that my wishes come first.",
+    "I would rather say goodbye than slowly disappear.",
+    "Nobody has pushed me toward this choice.",
+    "My sister cried, and then she told me she understood.",
+    "I have spent my life caring for others, and now I ask for care.",
+    "The pain medication no longer gives me real relief.",
+    "I am ready, and the people I love know that I am ready.",
+    "I want to be in control of the time I have left.",
+]
+
+# The words swapped into the canned sentences, so that narratives drawn from the same
+# sentences still differ the way real ones do and pass the near-duplicate gate
+CANNED_WORDS = [
+    "quietly", "honestly", "slowly", "always", "truly", "still", "deeply", "simply", "gently", "finally",
+    "today", "again", "together", "clearly", "calmly", "openly", "fully", "often", "rarely", "now",
+]
+
+def make_canned_narrative(rng: random.Random, num_sentences: int = 4):
+    """
+    Assemble a narrative from canned sentences with some of their words swapped out.
+    Args:
+        rng: The random generator to draw from
+        num_sentences: The number of sentences in the narrative
+    Returns:
+        The narrative text.
+    """
+    words = " ".join(rng.sample(CANNED_SENTENCES, num_sentences)).split()
+    return " ".join(rng.choice(CANNED_WORDS) if rng.random() < 0.3 else word for word in words)
+
+class MockServerConfig:
+    """
+    The timing and failure behaviour of the mock server.
+    """
+
+    def __init__(self, latency: float = 0.5, time_to_first_token: float = 0.3, tokens_per_second: float = 60.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, retry_after: float = 1.0,
+                 requests_per_minute: int = 4000, input_tokens_per_minute: int = 400000,
+                 output_tokens_per_minute: int = 80000, batch_processing_time: float = 1.0, seed: int = 0):
+        """
+        Args:
+            latency: Seconds before the response headers are sent
+            time_to_first_token: Seconds between the headers and the first text token
+            tokens_per_second: The rate at which text tokens are streamed
+            error_rate: The share (0-1) of requests answered with a 529 overloaded error
+            rate_limit_rate: The share (0-1) of requests answered with a 429 rate limit error
+            retry_after: The retry-after header (in seconds) sent with 429 responses
+            requests_per_minute: The requests limit reported in the rate limit headers
+            input_tokens_per_minute: The input tokens limit reported in the rate limit headers
+            output_tokens_per_minute: The output tokens limit reported in the rate limit headers
+            batch_processing_time: Seconds a Message Batch stays in progress before it ends
+            seed: The seed of the random choices, so runs are reproducible
+        """
+        self.latency = latency
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.input_tokens_per_minute = input_tokens_per_minute
+        self.output_tokens_per_minute = output_tokens_per_minute
+        self.batch_processing_time = batch_processing_time
+        self.seed = seed
+
+class MockAnthropicServer(ThreadingHTTPServer):
+    """
+    A threaded HTTP server that emulates POST /v1/messages, streamed and non-streamed,
+    and the Message Batches endpoints: create, retrieve and results.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, config: MockServerConfig, host: str = "127.0.0.1", port: int = 0):
+        """
+        Args:
+            config: The timing and failure behaviour
+            host: The address to listen on
+            port: The port to listen on. 0 picks a free port
+        """
+        super().__init__((host, port), MockMessagesHandler)
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.status_counts = {}
+        # The submitted Message Batches by id, each with its creation time and results
+        self.batches = {}
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        """
+        Serve requests on a background thread and return the server.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def next_outcome(self):
+        """
+        Draw the outcome of the next request: its number, the status code and the narrative.
+        The draws happen under a lock, so the sequence only depends on the seed.
+        """
+        with self.lock:
+            self.request_count += 1
+            draw = self.random.random()
+            if draw < self.config.rate_limit_rate:
+                status = 429
+            elif draw < self.config.rate_limit_rate + self.config.error_rate:
+                status = 529
+            else:
+                status = 200
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            narrative = make_canned_narrative(self.random)
+            gender = self.random.choice(["Male", "Female"])
+        return self.request_count, status, json.dumps({"gender": gender, "narrative": narrative})
+
+def build_mock_message(request: Dict[str, Any], request_number: int, text: str):
+    """
+    Build the parts of a mock Messages API response.
+    Args:
+        request: The Messages API request
+        request_number: The number of the request, used in the message and tool call ids
+        text: The JSON text of the narrative to answer with
+    Returns:
+        A tuple of the message (without content, as sent in message_start), the empty
+        content block, the stop reason, the text split into tokens and the final usage.
+    """
+    # We count roughly 4 characters per token, like the real tokenizer does on English text
+    input_tokens = len(json.dumps(request.get("system", "")) + json.dumps(request["messages"])) // 4
+    tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+    usage = {"input_tokens": input_tokens, "output_tokens": len(tokens),
+             "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+    message = {
+        "id": f"msg_mock_{request_number}", "type": "message", "role": "assistant",
+        "model": request["model"], "content": [], "stop_reason": None, "stop_sequence": None,
+        "usage": {**usage, "output_tokens": 1},
+    }
+
+    # A forced tool call (structured output) answers with a tool_use block instead of text
+    tool_choice = request.get("tool_choice") or {}
+    tool_name = tool_choice.get("name") if tool_choice.get("type") == "tool" else None
+    if tool_name:
+        content_block = {"type": "tool_use", "id": f"toolu_mock_{request_number}", "name": tool_name, "input": {}}
+        stop_reason = "tool_use"
+    else:
+        content_block = {"type": "text", "text": ""}
+        stop_reason = "end_turn"
+    return message, content_block, stop_reason, tokens, usage
+
+def complete_mock_message(request: Dict[str, Any], request_number: int, text: str):
+    """
+    Build a complete (non-streamed) mock Messages API response.
+    Args:
+        request: The Messages API request
+        request_number: The number of the request
+        text: The JSON text of the narrative to answer with
+    Returns:
+        A tuple of the message and the number of output tokens in it.
+    """
+    message, content_block, stop_reason, tokens, usage = build_mock_message(request, request_number, text)
+    if content_block["type"] == "tool_use":
+        content_block["input"] = json.loads(text)
+    else:
+        content_block["text"] = text
+    message.update(content=[content_block], stop_reason=stop_reason, usage=usage)
+    return message, len(tokens)
+
+class MockMessagesHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of MockAnthropicServer.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Per-request logging would swamp the generator's own output
+        pass
+
+    def _rate_limit_headers(self):
+        config = self.server.config
+        reset = (datetime.now(timezone.utc) + timedelta(seconds=60)).isoformat().replace("+00:00", "Z")
+        headers = {}
+        for name, limit in (("requests", config.requests_per_minute),
+                            ("input-tokens", config.input_tokens_per_minute),
+                            ("output-tokens", config.output_tokens_per_minute)):
+            headers[f"anthropic-ratelimit-{name}-limit"] = str(limit)
+            headers[f"anthropic-ratelimit-{name}-remaining"] = str(limit)
+            headers[f"anthropic-ratelimit-{name}-reset"] = reset
+        return headers
+
+    def _send_json(self, status: int, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_event(self, event_type: str, data):
+        self.wfile.write(f"event: {event_type}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _create_batch(self, request):
+        # Every request of the batch is answered straight away with the same draws as a
+        # Messages request, so 429 and 529 draws turn into errored results
+        config = self.server.config
+        results = []
+        for batch_request in request["requests"]:
+            request_number, status, text = self.server.next_outcome()
+            if status == 200:
+                message, _ = complete_mock_message(batch_request["params"], request_number, text)
+                result = {"type": "succeeded", "message": message}
+            else:
+                error_type = "rate_limit_error" if status == 429 else "overloaded_error"
+                result = {"type": "errored", "error": {"type": "error", "error": {"type": error_type, "message": error_type}}}
+            results.append({"custom_id": batch_request["custom_id"], "result": result})
+        with self.server.lock:
+            batch_id = f"msgbatch_mock_{len(self.server.batches) + 1}"
+            # Like the real API, the results file is not in request order
+            self.server.random.shuffle(results)
+            self.server.batches[batch_id] = {
+                "submitted": time.monotonic(),
+                "created_at": datetime.now(timezone.utc),
+                "results": results,
+            }
+        time.sleep(config.latency)
+        self._send_json(200, self._batch_status(batch_id))
+
+    def _batch_status(self, batch_id: str):
+        batch = self.server.batches[batch_id]
+        ended = time.monotonic() - batch["submitted"] >= self.server.config.batch_processing_time
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        if ended:
+            for entry in batch["results"]:
+                counts[entry["result"]["type"]] += 1
+        else:
+            counts["processing"] = len(batch["results"])
+        created_at = batch["created_at"]
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": counts,
+            "created_at": created_at.isoformat(),
+            "expires_at": (created_at + timedelta(hours=24)).isoformat(),
+            "ended_at": datetime.now(timezone.utc).isoformat() if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{self.server.base_url}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def do_GET(self):
+        # Only the Message Batches retrieve and results endpoints are emulated
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[:3] != ["v1", "messages", "batches"] or len(parts) not in (4, 5) or parts[3] not in self.server.batches:
+            self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": "Not found"}})
+            return
+        status = self._batch_status(parts[3])
+        if len(parts) == 4:
+            self._send_json(200, status)
+            return
+        if parts[4] != "results" or status["processing_status"] != "ended":
+            self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": "No results"}})
+            return
+        data = "".join(json.dumps(entry) + "\n" for entry in self.server.batches[parts[3]]["results"]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "application/binary")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        # Chat completions requests (OpenAI-compatible backend) get the same 429 and 529
+        # responses, so the scheduler can be checked with both backends. Only the
+        # Messages API is emulated beyond that
+        chat_completions = self.path.startswith("/v1/chat/completions")
+        if not self.path.startswith("/v1/messages") and not chat_completions:
+            self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": "Not found"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+        if self.path.split("?")[0] == "/v1/messages/batches":
+            self._create_batch(request)
+            return
+        config = self.server.config
+        request_number, status, text = self.server.next_outcome()
+        time.sleep(config.latency)
+
+        if status == 429:
+            self._send_json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "Rate limited"}},
+                            {"retry-after": str(config.retry_after), **self._rate_limit_headers()})
+            return
+        if status == 529:
+            self._send_json(529, {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})
+            return
+        if chat_completions:
+            self._send_json(404, {"type": "error", "error": {"type": "not_found_error",
+                                                             "message": "Only error responses are emulated for chat completions"}})
+            return
+
+        if not request.get("stream"):
+            message, output_tokens = complete_mock_message(request, request_number, text)
+            time.sleep(config.time_to_first_token + output_tokens / config.tokens_per_second)
+            self._send_json(200, message, self._rate_limit_headers())
+            return
+
+        message, content_block, stop_reason, tokens, usage = build_mock_message(request, request_number, text)
+        tool_name = content_block.get("name")
+
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("cache-control", "no-cache")
+        # The stream ends when we close the connection, as we do not know its length up front
+        self.send_header("connection", "close")
+        for name, value in self._rate_limit_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        self._send_event("message_start", {"type": "message_start", "message": message})
+        self._send_event("content_block_start", {"type": "content_block_start", "index": 0,
+                                                 "content_block": content_block})
+        time.sleep(config.time_to_first_token)
+        for token in tokens:
+            if tool_name:
+                delta = {"type": "input_json_delta", "partial_json": token}
+            else:
+                delta = {"type": "text_delta", "text": token}
+            self._send_event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": delta})
+            time.sleep(1.0 / config.tokens_per_second)
+        self._send_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self._send_event("message_delta", {"type": "message_delta",
+                                           "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                                           "usage": {"output_tokens": len(tokens)}})
+        self._send_event("message_stop", {"type": "message_stop"})
+        self.close_connection = True
+
+def write_synthetic_patients(csv_file_path: str, num_patients: int):
+    """
+    Write a stratified patient design to use as the input of a load test.
+    Args:
+        csv_file_path: The path of the CSV file to write
+        num_patients: The number of patients to request from the patient generator
+    Returns:
+        The number of patient rows written.
+    """
+    from patient_generator3 import generate_stratified_patients
+
+    patients = generate_stratified_patients(num_patients)
+    with open(csv_file_path, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=["race", "gender", "age_group", "pain_intensity"])
+        writer.writeheader()
+        writer.writerows(patients)
+    return len(patients)
+
+def run_narrative_generator(config: MockServerConfig, num_patients: int = 64, concurrency: int = 16, **main_kwargs):
+    """
+    Run narrative_generator5.main() end to end against a mock server.
+    Args:
+        config: The timing and failure behaviour of the mock server
+        num_patients: The number of synthetic patients to generate narratives for
+        concurrency: The concurrency to run the generator with
+        main_kwargs: Further keyword arguments for narrative_generator5.main()
+    Returns:
+        A dictionary with the rows written, the wall-clock time, the rows per second and
+        the number of requests the server answered with each status code.
+    """
+    # narrative_generator5 builds its clients on import. The mock server ignores the key,
+    # but the client needs one when no api_key.py file is present
+    os.environ.setdefault("ANTHROPIC_API_KEY", "mock-key")
+    import anthropic
+    import narrative_generator5
+    from llm_backends import AnthropicBackend
+
+    server = MockAnthropicServer(config).start()
+    work_dir = tempfile.mkdtemp(prefix="narrative_load_test_")
+    rows = write_synthetic_patients(os.path.join(work_dir, "patients.csv"), num_patients)
+
+    # We point the generator at the mock server and a scratch directory, and put the
+    # original settings back afterwards
+    saved = {name: getattr(narrative_generator5, name)
+             for name in ("backend", "CSV_FILE_PATH", "OUTPUT_CSV_FILE_PATH", "CHECKPOINT_FILE_PATH",
+                           "TOKEN_USAGE_FILE_PATH")}
+    narrative_generator5.backend = AnthropicBackend(
+        async_client=anthropic.AsyncClient(api_key="mock-key", base_url=server.base_url, max_retries=0)
+    )
+    narrative_generator5.CSV_FILE_PATH = os.path.join(work_dir, "patients.csv")
+    narrative_generator5.OUTPUT_CSV_FILE_PATH = os.path.join(work_dir, "patients_with_narratives.csv")
+    narrative_generator5.CHECKPOINT_FILE_PATH = os.path.join(work_dir, "patients_with_narratives.checkpoint.jsonl")
+    narrative_generator5.TOKEN_USAGE_FILE_PATH = os.path.join(work_dir, "patients_with_narratives.usage.json")
+    try:
+        start = time.perf_counter()
+        narrative_generator5.main(concurrency=concurrency, **main_kwargs)
+        elapsed = time.perf_counter() - start
+    finally:
+        for name, value in saved.items():
+            setattr(narrative_generator5, name, value)
+        server.shutdown()
+        server.server_close()
+
+    with open(os.path.join(work_dir, "patients_with_narratives.csv"), newline="") as csv_file:
+        rows_written = sum(1 for _ in csv.DictReader(csv_file))
+    return {
+        "input_rows": rows,
+        "rows_written": rows_written,
+        "seconds": elapsed,
+        "rows_per_second": rows_written / elapsed if elapsed else 0.0,
+        "status_counts": dict(server.status_counts),
+        "output_dir": work_dir,
+    }
+
+def check_scheduler_backoff(retry_after: float = 2.0):
+    """
+    Check the request scheduler's reaction to overload against a mock server that answers
+    every request with a 429 (with a retry-after header) or a 529 (without one), through
+    both the Anthropic backend and the OpenAI-compatible backend.
+    Args:
+        retry_after: The retry-after seconds the mock server sends with its 429 responses
+    Returns:
+        A list of the checks that passed, one line each.
+    Raises:
+        AssertionError: If the concurrency limit is not halved on an overload, or the
+            pause does not follow the retry-after time (1 second without one)
+    """
+    os.environ.setdefault("ANTHROPIC_API_KEY", "mock-key")
+    import anthropic
+    from llm_backends import AnthropicBackend, OpenAICompatibleBackend
+    from request_scheduler import RequestScheduler
+    from retry_policy import get_status_code
+
+    request = {"model": "claude-4-sonnet-20250514", "max_tokens": 100, "temperature": 0.7, "system": "",
+               "messages": [{"role": "user", "content": "Hello"}]}
+
+    async def send(scheduler, make_backend):
+        # The Anthropic client belongs to the event loop it was created on
+        backend = make_backend()
+        try:
+            async with scheduler.slot(10, request["max_tokens"]):
+                await backend.astream(request)
+        except Exception as e:
+            return get_status_code(e)
+        return None
+
+    passed = []
+    for status, config, expected_pause in (
+        (429, MockServerConfig(latency=0.0, rate_limit_rate=1.0, retry_after=retry_after), retry_after),
+        (529, MockServerConfig(latency=0.0, error_rate=1.0), 1.0),
+    ):
+        server = MockAnthropicServer(config).start()
+        backends = {
+            "anthropic": lambda: AnthropicBackend(async_client=anthropic.AsyncClient(
+                api_key="mock-key", base_url=server.base_url, max_retries=0)),
+            "openai": lambda: OpenAICompatibleBackend(server.base_url),
+        }
+        try:
+            for name, make_backend in backends.items():
+                scheduler = RequestScheduler(8, 10 ** 6, 10 ** 9, 10 ** 9)
+                for expected_limit in (4.0, 2.0):
+                    # The scheduler is paused after an overload, so the pause is lifted to send the next request
+                    scheduler.paused_until = 0.0
+                    status_code = asyncio.run(send(scheduler, make_backend))
+                    pause = scheduler.paused_until - time.monotonic()
+                    assert status_code == status, f"{name}: expected a {status} response, got {status_code}"
+                    assert scheduler.concurrency_limit == expected_limit, (
+                        f"{name}: concurrency limit {scheduler.concurrency_limit} after a {status}, expected {expected_limit}")
+                    assert expected_pause - 0.5 < pause <= expected_pause, (
+                        f"{name}: paused {pause:.2f}s after a {status}, expected {expected_pause:.2f}s")
+                passed.append(f"{name} backend, {status}: concurrency halved 8 -> 4 -> 2, paused {expected_pause:.1f}s")
+        finally:
+            server.shutdown()
+            server.server_close()
+    return passed
+
+def check_batch_mode(num_patients: int = 24, error_rate: float = 0.25, max_batch_requests: int = 10):
+    """
+    Run narrative_batches.main() against the mock server's Message Batches emulation and
+    check its output against a streamed narrative_generator5.main() run on the same input.
+    Some batch requests are answered with errored results, the requests are split over
+    several batches, and the results come back out of order.
+    Args:
+        num_patients: The number of synthetic patients to request from the patient generator
+        error_rate: The share (0-1) of batch requests that end as errored results
+        max_batch_requests: The batch size limit to use, so the requests are split over several batches
+    Returns:
+        A list of the checks that passed, one line each.
+    Raises:
+        AssertionError: If the batch output differs from the streamed output in its columns
+            or row order, or a narrative ends up on another row than the result it came from
+    """
+    os.environ.setdefault("ANTHROPIC_API_KEY", "mock-key")
+    import anthropic
+    import narrative_batches
+    from narrative_generator5 import OUTPUT_FIELDNAMES
+
+    def read_csv(csv_file_path):
+        with open(csv_file_path, newline="") as csv_file:
+            reader = csv.DictReader(csv_file)
+            return reader.fieldnames, list(reader)
+
+    def row_keys(rows):
+        return [(row["age_group"], row["race"], row["pain_intensity"]) for row in rows]
+
+    # The streamed run writes its rows in input order when it generates one row at a time
+    fast = dict(latency=0.0, time_to_first_token=0.0, tokens_per_second=10000.0)
+    streamed = run_narrative_generator(MockServerConfig(**fast), num_patients=num_patients, concurrency=1)
+    work_dir = streamed["output_dir"]
+    _, input_rows = read_csv(os.path.join(work_dir, "patients.csv"))
+    streamed_fieldnames, streamed_rows = read_csv(os.path.join(work_dir, "patients_with_narratives.csv"))
+
+    server = MockAnthropicServer(MockServerConfig(error_rate=error_rate, batch_processing_time=0.5, **fast)).start()
+    saved = {name: getattr(narrative_batches, name)
+             for name in ("CSV_FILE_PATH", "OUTPUT_CSV_FILE_PATH", "TOKEN_USAGE_FILE_PATH", "MAX_BATCH_REQUESTS")}
+    narrative_batches.CSV_FILE_PATH = os.path.join(work_dir, "patients.csv")
+    narrative_batches.OUTPUT_CSV_FILE_PATH = os.path.join(work_dir, "patients_batched_with_narratives.csv")
+    narrative_batches.TOKEN_USAGE_FILE_PATH = os.path.join(work_dir, "patients_batched_with_narratives.usage.json")
+    narrative_batches.MAX_BATCH_REQUESTS = max_batch_requests
+    try:
+        narrative_batches.main(poll_interval=0.1, batch_client=anthropic.Client(
+            api_key="mock-key", base_url=server.base_url, max_retries=0))
+    finally:
+        for name, value in saved.items():
+            setattr(narrative_batches, name, value)
+        server.shutdown()
+        server.server_close()
+
+    batched_fieldnames, batched_rows = read_csv(os.path.join(work_dir, "patients_batched_with_narratives.csv"))
+    results = {entry["custom_id"]: entry["result"] for batch in server.batches.values() for entry in batch["results"]}
+    succeeded = [row for row in range(1, len(input_rows) + 1) if results[f"row-{row}"]["type"] == "succeeded"]
+    expected_batches = -(-len(input_rows) // max_batch_requests)
+
+    passed = []
+    assert len(server.batches) == expected_batches, f"{len(server.batches)} batches submitted, expected {expected_batches}"
+    passed.append(f"{len(input_rows)} requests split over {expected_batches} batches of at most {max_batch_requests}")
+    assert 0 < len(succeeded) < len(input_rows), "the batch results should mix succeeded and errored requests"
+    assert batched_fieldnames == streamed_fieldnames == OUTPUT_FIELDNAMES, (
+        f"batch columns {batched_fieldnames}, streamed columns {streamed_fieldnames}")
+    passed.append(f"batch and streamed outputs share the columns {', '.join(OUTPUT_FIELDNAMES)}")
+    assert row_keys(streamed_rows) == row_keys(input_rows), "the streamed output is not in input order"
+    assert row_keys(batched_rows) == [row_keys(input_rows)[row - 1] for row in succeeded], (
+        "the batch output is not in input order without its errored rows")
+    for row, output_row in zip(succeeded, batched_rows):
+        narrative = json.loads(results[f"row-{row}"]["message"]["content"][0]["text"])["narrative"]
+        assert output_row["narrative"] == narrative, f"row {row} did not get the narrative of result row-{row}"
+    passed.append(f"{len(succeeded)} succeeded rows in input order with their own results, "
+                  f"{len(input_rows) - len(succeeded)} errored rows left out")
+    with open(os.path.join(work_dir, "patients_batched_with_narratives.usage.json")) as usage_file:
+        usage = json.load(usage_file)
+    assert usage["run"]["calls"] == len(succeeded), f"{usage['run']['calls']} calls in the usage file, expected {len(succeeded)}"
+    passed.append(f"usage file records {usage['run']['calls']} calls costing ${usage['run']['cost']:.4f} at batch prices")
+    return passed
+
+def parse_args():
+    """
+    Parse the command line options of the mock server.
+    Returns:
+        An argparse.Namespace with the parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Mock Messages API server for offline load tests of the narrative generator.")
+    parser.add_argument("--serve", action="store_true", help="Only run the server (until Ctrl-C) instead of a load test")
+    parser.add_argument("--port", type=int, default=8765, help="Port to serve on with --serve (default: 8765)")
+    parser.add_argument("--patients", type=int, default=64, help="Number of synthetic patients for the load test")
+    parser.add_argument("--concurrency", type=int, default=16, help="Generator concurrency for the load test")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the response headers")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Seconds from the headers to the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0, help="Streaming rate of the text tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 529")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after seconds sent with 429s")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the server's random choices")
+    parser.add_argument("--check-scheduler", action="store_true",
+                        help="Check the request scheduler's backoff against injected 429 (retry-after 2s) and 529 responses instead of a load test")
+    parser.add_argument("--check-batches", action="store_true",
+                        help="Check the batch mode of narrative_batches against the Message Batches emulation instead of a load test")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = MockServerConfig(
+        latency=args.latency, time_to_first_token=args.ttft, tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    if args.check_scheduler:
+        # The check uses its own retry-after time, which has to differ from the 1 second
+        # the scheduler falls back to without one
+        for line in check_scheduler_backoff():
+            print(f"OK  {line}")
+    elif args.check_batches:
+        for line in check_batch_mode():
+            print(f"OK  {line}")
+    elif args.serve:
+        server = MockAnthropicServer(config, port=args.port)
+        print(f"Mock Messages API listening on {server.base_url}. Set ANTHROPIC_BASE_URL to use it.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    else:
+        result = run_narrative_generator(config, num_patients=args.patients, concurrency=args.concurrency)
+        print(json.dumps(result, indent=2))
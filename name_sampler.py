@@ -0,0 +1,219 @@
+import bisect
+import itertools
+import random
+import re
+import unicodedata
+from typing import Dict, Optional, Set
+
+# Name frequency tables for the races, genders and age cohorts of the patient designs.
+# The weights are relative frequencies, loosely based on US census surname counts and
+# birth-year first name popularity. Middle aged patients were born around 1960-1980 and
+# old aged patients around 1935-1955, which is why their first names differ.
+# Each table can be replaced with fuller data of the same shape.
+FIRST_NAMES = {
+    ("Black", "Male", "middle aged"): {
+        "Michael": 10, "Anthony": 8, "Darnell": 6, "Terrence": 6, "Marcus": 7, "Derrick": 6, "Kevin": 7,
+        "Reginald": 5, "Tyrone": 5, "Andre": 6, "Jerome": 5, "Cedric": 4, "Maurice": 5, "Dwayne": 5,
+        "Lamont": 4, "Curtis": 4, "Rodney": 5, "Kenneth": 6, "Darryl": 5, "Gregory": 5, "Jamal": 4,
+        "Calvin": 4, "Vincent": 4, "Troy": 4, "Byron": 3,
+    },
+    ("Black", "Male", "old aged"): {
+        "Willie": 9, "James": 10, "Robert": 8, "Charles": 8, "Johnnie": 5, "Eddie": 6, "Leroy": 6,
+        "Clarence": 6, "Samuel": 6, "Otis": 4, "Roosevelt": 4, "Earl": 5, "Henry": 6, "Walter": 6,
+        "Lucius": 3, "Alvin": 4, "Cleveland": 3, "Herbert": 4, "Floyd": 4, "Jesse": 5, "Louis": 5,
+        "Nathaniel": 4, "Ernest": 5, "Wilbert": 3, "Percy": 3,
+    },
+    ("Black", "Female", "middle aged"): {
+        "Angela": 9, "Tanya": 6, "Kimberly": 7, "Yolanda": 6, "Sonya": 5, "Tonya": 5, "Michelle": 7,
+        "Sharon": 6, "Denise": 6, "Lisa": 6, "Monique": 5, "Valerie": 5, "Felicia": 5, "Cynthia": 5,
+        "Tamika": 4, "Keisha": 4, "Crystal": 4, "Regina": 5, "Gwendolyn": 4, "Vanessa": 5, "Rhonda": 4,
+        "Lakisha": 3, "Sheila": 4, "Patrice": 3, "Wanda": 4,
+    },
+    ("Black", "Female", "old aged"): {
+        "Mary": 10, "Dorothy": 8, "Annie": 7, "Bernice": 5, "Willie Mae": 4, "Louise": 6, "Ruby": 6,
+        "Gloria": 6, "Hattie": 4, "Mattie": 4, "Lillian": 5, "Ethel": 5, "Geraldine": 5, "Loretta": 4,
+        "Evelyn": 5, "Alberta": 3, "Odessa": 3, "Pearlie": 3, "Juanita": 4, "Lorraine": 4, "Doris": 5,
+        "Essie": 3, "Cora": 3, "Viola": 3, "Thelma": 4,
+    },
+    ("White", "Male", "middle aged"): {
+        "Michael": 10, "David": 9, "John": 8, "James": 8, "Robert": 7, "Mark": 7, "Scott": 6, "Jeffrey": 6,
+        "Steven": 6, "Brian": 6, "Timothy": 5, "Todd": 5, "Kevin": 5, "Christopher": 6, "Daniel": 6,
+        "Eric": 5, "Gregory": 4, "Douglas": 4, "Keith": 4, "Craig": 4, "Brett": 3, "Shawn": 3,
+        "Randall": 3, "Kurt": 3, "Patrick": 4,
+    },
+    ("White", "Male", "old aged"): {
+        "Robert": 10, "Richard": 8, "William": 9, "Donald": 7, "Gerald": 5, "Ronald": 6, "Harold": 6,
+        "Norman": 4, "Raymond": 6, "Eugene": 4, "Kenneth": 6, "Carl": 5, "Frank": 5, "Wayne": 4,
+        "Roger": 5, "Dale": 4, "Lawrence": 4, "Howard": 4, "Ralph": 4, "Leonard": 4, "Stanley": 4,
+        "Glenn": 3, "Russell": 3, "Vernon": 3, "Melvin": 3,
+    },
+    ("White", "Female", "middle aged"): {
+        "Jennifer": 10, "Lisa": 9, "Kimberly": 7, "Michelle": 7, "Amy": 7, "Susan": 6, "Karen": 7,
+        "Laura": 6, "Julie": 6, "Heather": 5, "Stephanie": 5, "Melissa": 6, "Tammy": 5, "Angela": 5,
+        "Christine": 5, "Dawn": 4, "Tracy": 4, "Kelly": 5, "Wendy": 4, "Rebecca": 5, "Kristen": 4,
+        "Shannon": 4, "Allison": 3, "Erin": 3, "Holly": 3,
+    },
+    ("White", "Female", "old aged"): {
+        "Barbara": 10, "Patricia": 9, "Linda": 8, "Carol": 8, "Judith": 6, "Shirley": 6, "Joan": 6,
+        "Marilyn": 5, "Nancy": 7, "Joyce": 5, "Beverly": 5, "Janet": 5, "Margaret": 6, "Helen": 5,
+        "Phyllis": 4, "Donna": 5, "Elaine": 4, "Marjorie": 3, "Sandra": 5, "Arlene": 3, "Norma": 4,
+        "Peggy": 4, "Darlene": 3, "Geraldine": 3, "Lois": 3,
+    },
+    ("Hispanic", "Male", "middle aged"): {
+        "Jose": 10, "Juan": 9, "Carlos": 8, "Luis": 8, "Jorge": 6, "Miguel": 7, "Ricardo": 6, "Roberto": 6,
+        "Javier": 6, "Francisco": 6, "Alejandro": 5, "Raul": 5, "Eduardo": 5, "Mario": 5, "Hector": 5,
+        "Sergio": 5, "Fernando": 5, "Victor": 4, "Ruben": 4, "Arturo": 4, "Oscar": 4, "Rafael": 4,
+        "Armando": 3, "Ramon": 3, "Gerardo": 3,
+    },
+    ("Hispanic", "Male", "old aged"): {
+        "Jose": 10, "Manuel": 8, "Jesus": 7, "Antonio": 8, "Pedro": 6, "Ramon": 6, "Guadalupe": 4,
+        "Alfredo": 5, "Salvador": 5, "Ignacio": 4, "Rodolfo": 4, "Enrique": 5, "Ernesto": 5, "Julio": 5,
+        "Rafael": 5, "Gilberto": 4, "Felipe": 4, "Arturo": 4, "Raul": 4, "Joaquin": 3, "Domingo": 3,
+        "Reynaldo": 3, "Tomas": 3, "Santiago": 3, "Agustin": 3,
+    },
+    ("Hispanic", "Female", "middle aged"): {
+        "Maria": 10, "Rosa": 6, "Patricia": 6, "Ana": 7, "Veronica": 6, "Elizabeth": 5, "Sandra": 6,
+        "Claudia": 6, "Leticia": 5, "Gabriela": 5, "Adriana": 5, "Yolanda": 5, "Monica": 5, "Silvia": 5,
+        "Laura": 5, "Alicia": 5, "Margarita": 4, "Martha": 4, "Norma": 4, "Lorena": 4, "Elena": 4,
+        "Marisol": 3, "Beatriz": 3, "Irma": 3, "Carmen": 4,
+    },
+    ("Hispanic", "Female", "old aged"): {
+        "Maria": 10, "Carmen": 8, "Guadalupe": 7, "Juana": 6, "Josefina": 5, "Dolores": 5, "Esperanza": 4,
+        "Socorro": 4, "Rosario": 5, "Teresa": 5, "Concepcion": 4, "Luz": 4, "Ofelia": 3, "Consuelo": 4,
+        "Amparo": 3, "Herminia": 3, "Graciela": 4, "Eva": 4, "Irene": 4, "Lucia": 4, "Alma": 3,
+        "Estela": 3, "Aurora": 3, "Celia": 3, "Olga": 3,
+    },
+    ("Asian", "Male", "middle aged"): {
+        "David": 8, "Michael": 7, "Kevin": 6, "John": 6, "Eric": 5, "Thomas": 5, "Peter": 5, "Jun": 5,
+        "Hiroshi": 4, "Raj": 5, "Sanjay": 5, "Wei": 6, "Hoang": 4, "Minh": 4, "Sung": 4, "Jae": 4,
+        "Vinod": 3, "Anil": 4, "Ramon": 3, "Arnel": 3, "Kenji": 3, "Dong": 3, "Tuan": 4, "Ravi": 4,
+        "Jian": 3,
+    },
+    ("Asian", "Male", "old aged"): {
+        "George": 6, "Frank": 5, "Henry": 5, "Paul": 5, "Kenneth": 4, "Takeshi": 4, "Hideo": 3,
+        "Masao": 3, "Chen": 5, "Ming": 4, "Ho": 3, "Ramesh": 4, "Suresh": 4, "Krishna": 3, "Bao": 3,
+        "Quang": 3, "Young": 4, "Chul": 3, "Rodolfo": 3, "Ernesto": 3, "Jose": 4, "Kazuo": 3,
+        "Shigeru": 3, "Prakash": 3, "Hung": 3,
+    },
+    ("Asian", "Female", "middle aged"): {
+        "Jennifer": 7, "Grace": 6, "Susan": 5, "Linda": 5, "Christine": 5, "Mei": 5, "Lan": 4,
+        "Priya": 5, "Sunita": 4, "Anjali": 4, "Kyung": 4, "Mi Young": 4, "Thuy": 4, "Huong": 4,
+        "Yuko": 4, "Naomi": 3, "Maricel": 3, "Rowena": 3, "Lily": 4, "Amy": 4, "Jasmine": 3,
+        "Hui": 3, "Ling": 4, "Kavita": 3, "Trang": 3,
+    },
+    ("Asian", "Female", "old aged"): {
+        "Mary": 6, "Helen": 5, "Alice": 5, "Rose": 5, "Fumiko": 3, "Keiko": 4, "Yoshiko": 3,
+        "Kazuko": 3, "Lakshmi": 4, "Savitri": 3, "Kamala": 3, "Mei Ling": 4, "Shu": 3, "Xiu": 3,
+        "Soon": 3, "Ok": 3, "Young Ja": 3, "Lien": 3, "Mai": 4, "Corazon": 4, "Remedios": 3,
+        "Erlinda": 3, "Teresita": 3, "Chiyo": 3, "Hana": 3,
+    },
+}
+
+LAST_NAMES = {
+    "Black": {
+        "Williams": 10, "Johnson": 10, "Smith": 9, "Jones": 9, "Brown": 8, "Jackson": 8, "Davis": 7,
+        "Thomas": 6, "Harris": 6, "Robinson": 6, "Taylor": 5, "Wilson": 5, "Moore": 5, "White": 4,
+        "Washington": 5, "Jefferson": 3, "Banks": 3, "Coleman": 4, "Freeman": 3, "Gaines": 3,
+        "Greene": 3, "Hayes": 3, "Mack": 2, "Pierce": 3, "Simmons": 4, "Tucker": 3, "Walker": 5,
+        "Bryant": 4, "Boykin": 2, "Dorsey": 2,
+    },
+    "White": {
+        "Smith": 10, "Johnson": 8, "Miller": 8, "Brown": 7, "Jones": 6, "Davis": 6, "Anderson": 6,
+        "Wilson": 6, "Taylor": 5, "Thomas": 5, "Moore": 5, "Martin": 5, "Thompson": 5, "Clark": 4,
+        "Lewis": 4, "Walker": 4, "Hall": 4, "Allen": 4, "Young": 4, "King": 4, "Wright": 4, "Hill": 4,
+        "Schmidt": 3, "Olson": 3, "Sullivan": 3, "Murphy": 4, "Kowalski": 2, "Lindqvist": 2,
+        "Becker": 3, "Fischer": 2,
+    },
+    "Hispanic": {
+        "Garcia": 10, "Rodriguez": 9, "Martinez": 9, "Hernandez": 9, "Lopez": 8, "Gonzalez": 8,
+        "Perez": 7, "Sanchez": 7, "Ramirez": 6, "Torres": 6, "Flores": 6, "Rivera": 6, "Gomez": 5,
+        "Diaz": 5, "Reyes": 5, "Morales": 5, "Cruz": 5, "Ortiz": 4, "Gutierrez": 4, "Chavez": 4,
+        "Ramos": 4, "Ruiz": 4, "Alvarez": 4, "Mendoza": 4, "Castillo": 3, "Jimenez": 3, "Vasquez": 3,
+        "Moreno": 3, "Romero": 3, "Herrera": 3,
+    },
+    "Asian": {
+        "Nguyen": 10, "Kim": 9, "Lee": 9, "Wang": 7, "Chen": 7, "Li": 6, "Patel": 8, "Tran": 6, "Le": 5,
+        "Zhang": 5, "Liu": 5, "Park": 5, "Huang": 4, "Wu": 4, "Yang": 4, "Pham": 4, "Singh": 5,
+        "Shah": 4, "Tanaka": 3, "Nakamura": 3, "Yamamoto": 3, "Santos": 4, "Reyes": 3, "Cruz": 3,
+        "Choi": 4, "Kumar": 4, "Lin": 4, "Chang": 4, "Wong": 4, "Sato": 2,
+    },
+}
+
+def normalize_name(full_name: str):
+    """
+    Normalize a full name for uniqueness checks, so that e.g. "José  Pérez" and
+    "jose perez" count as the same name.
+    """
+    decomposed = unicodedata.normalize("NFKD", full_name)
+    ascii_name = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return re.sub(r"[^a-z]+", " ", ascii_name.casefold()).strip()
+
+class _WeightedTable:
+    """
+    A name frequency table prepared for sampling in O(log n) with cumulative weights.
+    """
+
+    def __init__(self, frequencies: Dict[str, float]):
+        self.names = list(frequencies)
+        self.cumulative_weights = list(itertools.accumulate(frequencies.values()))
+
+    def sample(self, rng: random.Random):
+        draw = rng.random() * self.cumulative_weights[-1]
+        return self.names[bisect.bisect_right(self.cumulative_weights, draw)]
+
+class NameSampler:
+    """
+    Samples unique, demographically plausible patient names offline from name frequency
+    tables, instead of asking the API for every patient.
+    """
+
+    def __init__(self, first_names=FIRST_NAMES, last_names=LAST_NAMES, seed: Optional[int] = None, max_attempts: int = 1000):
+        """
+        Args:
+            first_names: First name frequencies keyed by (race, gender, age group)
+            last_names: Last name frequencies keyed by race
+            seed: The seed of the sampler, for reproducible names
+            max_attempts: The number of draws before giving up on finding an unused name
+        """
+        self.first_names = {key: _WeightedTable(table) for key, table in first_names.items()}
+        self.last_names = {key: _WeightedTable(table) for key, table in last_names.items()}
+        self.rng = random.Random(seed)
+        self.max_attempts = max_attempts
+        # The normalized names handed out so far, so the uniqueness check is a set lookup
+        self.used_names: Set[str] = set()
+
+    def reserve(self, full_name: str):
+        """
+        Mark a name as used, e.g. one from an earlier run. Returns False if it was already used.
+        """
+        normalized = normalize_name(full_name)
+        if normalized in self.used_names:
+            return False
+        self.used_names.add(normalized)
+        return True
+
+    def sample(self, race: str, gender: str, age_group: str):
+        """
+        Draw a name that has not been handed out before.
+        Args:
+            race: The race of the patient, a key of the last name table
+            gender: The gender of the patient, "Male" or "Female". It is required, so the
+                first name always matches the gender in the patient row
+            age_group: The age group of the patient, e.g. "middle aged"
+        Returns:
+            A dictionary with the first_name and last_name fields.
+        Raises:
+            KeyError: If there is no table for the patient's demographics
+            ValueError: If the gender is missing or not "Male" or "Female", or no unused
+                name was found in max_attempts draws
+        """
+        if not isinstance(gender, str) or gender.capitalize() not in ("Male", "Female"):
+            raise ValueError(f"A name needs the patient's gender, \"Male\" or \"Female\", not {gender!r}.")
+        gender = gender.capitalize()
+        first_names = self.first_names[(race, gender, age_group)]
+        last_names = self.last_names[race]
+        for _ in range(self.max_attempts):
+            name_data = {"first_name": first_names.sample(self.rng), "last_name": last_names.sample(self.rng)}
+            if self.reserve(f"{name_data['first_name']} {name_data['last_name']}"):
+                return name_data
+        raise ValueError(f"Failed to find an unused name for {race}, {gender}, {age_group} after {self.max_attempts} attempts.")
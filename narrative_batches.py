@@ -0,0 +1,186 @@
+import argparse
+import time
+from typing import Dict, Any, List
+
+# The batch mode reuses the prompt, the response parsing and the output schema of
+# narrative_generator5, so that batched and streamed runs produce the same CSV
+from llm_backends import usage_to_dict, content_to_text
+from token_budget import TokenLedger
+from narrative_generator5 import (
+    client,
+    CSV_FILE_PATH,
+    OUTPUT_CSV_FILE_PATH,
+    TOKEN_USAGE_FILE_PATH,
+    TEMPERATURE,
+    STRATUM_FIELD,
+    print_with_border,
+    print_prompt_cache_status,
+    build_narrative_request,
+    parse_narrative_response,
+    build_processed_patient,
+    load_patient_data,
+    save_processed_patients,
+)
+
+# How often (in seconds) we ask the API whether a submitted batch has finished.
+# Most batches finish well within an hour, so polling every minute is plenty
+BATCH_POLL_INTERVAL = 60
+
+# The Message Batches API accepts at most 100,000 requests per batch.
+# Larger designs are split over several batches
+MAX_BATCH_REQUESTS = 100_000
+
+# Message Batches requests are billed at half the list price
+BATCH_PRICE_FACTOR = 0.5
+
+def build_batch_requests(patient_data_list: List[Dict[str, Any]], existing_narratives: List[str] = None,
+                         use_structured_output: bool = False):
+    """
+    Compile the narrative request of every patient row into Message Batches requests.
+    Args:
+        patient_data_list: A list of dictionaries containing the patient rows from the input CSV
+        existing_narratives: Narratives from an earlier run to show the model as examples.
+            Because every request is compiled up front, narratives generated within the
+            batch itself cannot be used as examples.
+        use_structured_output: Whether to force the record_narrative tool call in every request
+    Returns:
+        A list of batch request dictionaries with a custom_id and the request params.
+        The custom_id encodes the 1-based input row number, e.g. "row-12".
+    """
+    existing_narratives = existing_narratives or []
+    return [
+        {
+            "custom_id": f"row-{i}",
+            "params": build_narrative_request(patient_data, existing_narratives, TEMPERATURE, use_structured_output),
+        }
+        for i, patient_data in enumerate(patient_data_list, 1)
+    ]
+
+def submit_batches(batch_requests: List[Dict[str, Any]], batch_client=None):
+    """
+    Submit the batch requests, splitting them into batches of at most MAX_BATCH_REQUESTS.
+    Args:
+        batch_requests: A list of batch requests built by build_batch_requests
+        batch_client: The client to submit the batches with. Defaults to the Anthropic client,
+            but any object with the same messages.batches interface can be used, such as a
+            local stand-in for testing.
+    Returns:
+        A list with the ids of the submitted batches.
+    """
+    batch_client = batch_client or client
+    batch_ids = []
+    for start in range(0, len(batch_requests), MAX_BATCH_REQUESTS):
+        chunk = batch_requests[start:start + MAX_BATCH_REQUESTS]
+        batch = batch_client.messages.batches.create(requests=chunk)
+        print(f"Submitted batch {batch.id} with {len(chunk)} requests")
+        batch_ids.append(batch.id)
+    return batch_ids
+
+def wait_for_batches(batch_ids: List[str], poll_interval: float = BATCH_POLL_INTERVAL, batch_client=None):
+    """
+    Poll the submitted batches until all of them have finished processing.
+    Args:
+        batch_ids: The ids of the submitted batches
+        poll_interval: The number of seconds to wait between two polls
+        batch_client: The client the batches were submitted with
+    """
+    batch_client = batch_client or client
+    pending = list(batch_ids)
+    while pending:
+        for batch_id in list(pending):
+            batch = batch_client.messages.batches.retrieve(batch_id)
+            counts = batch.request_counts
+            print(f"Batch {batch_id}: {batch.processing_status} "
+                  f"(processing: {counts.processing}, succeeded: {counts.succeeded}, errored: {counts.errored})")
+            if batch.processing_status == "ended":
+                pending.remove(batch_id)
+        if pending:
+            time.sleep(poll_interval)
+
+def collect_batch_results(batch_ids: List[str], patient_data_list: List[Dict[str, Any]], batch_client=None,
+                          token_ledger: TokenLedger = None):
+    """
+    Map the results of finished batches back onto the input rows.
+    Args:
+        batch_ids: The ids of the finished batches
+        patient_data_list: The patient rows the batch requests were built from
+        batch_client: The client the batches were submitted with
+        token_ledger: The TokenLedger the token usage of every result is recorded in, if any
+    Returns:
+        A list of processed patient dictionaries in input-row order, in the same schema
+        as the output of narrative_generator5.main(). Rows whose request failed or whose
+        response could not be parsed are left out.
+    """
+    batch_client = batch_client or client
+    processed_patients = [None] * len(patient_data_list)
+    for batch_id in batch_ids:
+        for entry in batch_client.messages.batches.results(batch_id):
+            row = int(entry.custom_id.split("-", 1)[1])
+            stratum = patient_data_list[row - 1].get(STRATUM_FIELD)
+            if entry.result.type != "succeeded":
+                print(f"Request for row {row} did not succeed: {entry.result.type}")
+                if token_ledger is not None:
+                    token_ledger.finish_row(entry.custom_id, stratum, accepted=False)
+                continue
+            message = entry.result.message
+            if token_ledger is not None:
+                token_ledger.record_call(entry.custom_id, stratum, message.model, usage_to_dict(message.usage))
+            response_text = content_to_text(message.content)
+            try:
+                narrative_data = parse_narrative_response(response_text, TEMPERATURE)
+                processed_patients[row - 1] = build_processed_patient(patient_data_list[row - 1], narrative_data)
+            except Exception as e:
+                print(f"Error processing batch result for row {row}: {str(e)}")
+                print(f"Response text: {response_text[:200]}...")
+            if token_ledger is not None:
+                token_ledger.finish_row(entry.custom_id, stratum, accepted=processed_patients[row - 1] is not None)
+    return [patient for patient in processed_patients if patient is not None]
+
+def main(poll_interval: float = BATCH_POLL_INTERVAL, use_structured_output: bool = False, batch_client=None):
+    """
+    Generate the narratives of every row in CSV_FILE_PATH as Message Batches jobs.
+    Args:
+        poll_interval: The number of seconds to wait between two batch status polls
+        use_structured_output: Whether to force the record_narrative tool call in every request
+        batch_client: The client to submit the batches with. Defaults to the Anthropic client
+    """
+    # Read patient data from the input CSV file
+    patient_data_list = load_patient_data(CSV_FILE_PATH)
+    if patient_data_list is None:
+        return
+    # Results are matched to their rows by position, so the compact records are kept in a list
+    patient_data_list = list(patient_data_list)
+
+    print_with_border(f"Submitting {len(patient_data_list)} patients from {CSV_FILE_PATH} as a Message Batches job")
+    print_prompt_cache_status()
+
+    batch_ids = submit_batches(build_batch_requests(patient_data_list, use_structured_output=use_structured_output),
+                               batch_client)
+    wait_for_batches(batch_ids, poll_interval, batch_client)
+    token_ledger = TokenLedger(len(patient_data_list), price_factor=BATCH_PRICE_FACTOR)
+    processed_patients = collect_batch_results(batch_ids, patient_data_list, batch_client, token_ledger)
+    print_with_border("\n".join(token_ledger.report_lines()))
+    # Saved like a streamed run's usage, so batch spend appears in the per-run usage record
+    try:
+        token_ledger.save(TOKEN_USAGE_FILE_PATH)
+    except IOError as e:
+        print(f"ERROR: Could not save the token usage to {TOKEN_USAGE_FILE_PATH}: {e}")
+
+    if not processed_patients:
+        print("No patients were processed. Output file will not be created.")
+        return
+
+    failed = len(patient_data_list) - len(processed_patients)
+    if failed:
+        print(f"{failed} of {len(patient_data_list)} rows failed in the batch and are missing from the output.")
+
+    save_processed_patients(processed_patients, OUTPUT_CSV_FILE_PATH)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate patient narratives through the Message Batches API.")
+    parser.add_argument("--poll-interval", type=float, default=BATCH_POLL_INTERVAL,
+                        help=f"Seconds between batch status polls (default: {BATCH_POLL_INTERVAL})")
+    parser.add_argument("--structured-output", action="store_true",
+                        help="Force a tool call with the {gender, narrative} schema instead of asking for JSON text")
+    args = parser.parse_args()
+    main(poll_interval=args.poll_interval, use_structured_output=args.structured_output)
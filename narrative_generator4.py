@@ -2,15 +2,24 @@ import csv
 import os
 import anthropic
 import json
+import time
 from typing import Dict, Any, List # Set is no longer used
 import sys
 
+from patient_tables import read_patient_file
+from retry_policy import RetryPolicy, CircuitBreaker, classify_error, aborts_run, FATAL, RETRYABLE
+from llm_backends import AnthropicBackend
+
 # Assuming api_key.py is in the same directory or accessible in PYTHONPATH
 from api_key import anthropic_key
 
 # Initialize the Anthropic client with the API key
 client = anthropic.Client(api_key=anthropic_key)
 
+# Narrative generation goes through an LLM backend. To use a local model,
+# replace this with e.g. OpenAICompatibleBackend("http://localhost:8080")
+backend = AnthropicBackend(client)
+
 # Copy paste patient data csv title into the variable patient_csv
 patient_csv = "stratified_patient_data_20250513_123759"
 # patient_csv is used to determine file path
@@ -19,13 +28,18 @@ CSV_FILE_PATH = f"patient_data/{patient_csv}.csv"
 # Output CSV file path
 OUTPUT_CSV_FILE_PATH = f"patient_data/{patient_csv}_with_narratives.csv"
 
+# Retry transient API errors with capped exponential backoff and jitter, and pause
+# all requests with the circuit breaker when the error rate spikes
+RETRY_POLICY = RetryPolicy(max_attempts=5, base_delay=1.0, max_delay=60.0)
+circuit_breaker = CircuitBreaker()
+
 def print_with_border(text: str, width: int = 80) -> None:
     """Print text with a decorative border."""
     print("\n" + "="*width)
     print(text)
     print("="*width + "\n")
 
-def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives: List[str], max_retries: int = 3):
+def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives: List[str], max_retries: int = RETRY_POLICY.max_attempts):
     """Generate a unique narrative for the patient using their information."""
     # Uses .get() for safer access in case a key is unexpectedly missing
     print_with_border(
@@ -41,15 +55,18 @@ def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives
         )
 
     for attempt in range(max_retries):
+        response_text = ""
         try:
+            # Wait here while the circuit breaker is open
+            circuit_breaker.wait_sync()
+
             temperature = 0.7  # Fixed temperature
             print(f"Using temperature: {temperature}")
 
-            message = client.messages.create(
+            request = dict(
                 model="claude-3-5-sonnet-20241022", # Using the model name you provided
                 max_tokens=500,
                 temperature=temperature,
-                stream=True,
                 system=f"""
                 You are an AI assistant helping with a psychological study that analyzes
                 the moral convictions of medical professionals confronted with the
@@ -95,43 +112,54 @@ def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives
                     }]
                 }])
 
+            stream = backend.stream(request)
+
             print("\nGenerating narrative: ")
             response_text = ""
-            for chunk in message:
-                if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
-                    sys.stdout.write(chunk.delta.text)
-                    sys.stdout.flush()
-                    response_text += chunk.delta.text
+            for text in stream:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+                response_text += text
             print("\n")
+            circuit_breaker.record_success()
 
             json_data = json.loads(response_text)
             json_data["temperature"] = temperature
             return json.dumps(json_data)
         except Exception as e:
-            print(f"Narrative generation attempt {attempt + 1} failed: {str(e)}. Retrying...")
-            continue
+            # Fatal errors such as a bad API key or a bad request are not retried
+            error_class = classify_error(e)
+            if error_class == FATAL:
+                print(f"Narrative generation attempt {attempt + 1} failed with a fatal error: {str(e)}")
+                raise
+            if error_class == RETRYABLE:
+                circuit_breaker.record_failure()
+            print(f"Narrative generation attempt {attempt + 1} failed: {str(e)}.")
+            if not RETRY_POLICY.should_retry(e, attempt) or attempt + 1 >= max_retries:
+                break
+            delay = RETRY_POLICY.backoff_delay(e, attempt)
+            print(f"Retrying in {delay:.1f}s...")
+            time.sleep(delay)
 
     raise ValueError("Failed to generate a valid JSON response after multiple attempts.")
 
 def main():
-    # Read patient data from the input CSV file
+    # Read patient data from the input file. Parquet and Arrow files are read column-wise
     try:
-        with open(CSV_FILE_PATH, "r", newline='') as csv_file: # Added newline='' for robust CSV handling
-            csv_reader = csv.DictReader(csv_file)
-            # Check if 'pain_intensity' is in the field names, if not, raise an error or warning
-            if 'pain_intensity' not in csv_reader.fieldnames:
-                print(f"ERROR: The CSV file '{CSV_FILE_PATH}' must contain a column named 'pain_intensity'.")
-                print(f"Detected columns: {csv_reader.fieldnames}")
-                return # Exit if the required column is missing
-
-            patient_data_list = list(csv_reader)
+        fieldnames, patient_data_list = read_patient_file(CSV_FILE_PATH)
     except FileNotFoundError:
-        print(f"ERROR: Input CSV file not found at {CSV_FILE_PATH}")
+        print(f"ERROR: Input patient file not found at {CSV_FILE_PATH}")
         return
     except Exception as e:
-        print(f"ERROR: Could not read CSV file: {e}")
+        print(f"ERROR: Could not read patient file: {e}")
         return
 
+    # Check if 'pain_intensity' is in the field names, if not, raise an error or warning
+    if 'pain_intensity' not in fieldnames:
+        print(f"ERROR: The patient file '{CSV_FILE_PATH}' must contain a column named 'pain_intensity'.")
+        print(f"Detected columns: {fieldnames}")
+        return # Exit if the required column is missing
+
 
     print_with_border(f"Processing {len(patient_data_list)} patients from {CSV_FILE_PATH}")
 
@@ -171,6 +199,10 @@ def main():
 
         except Exception as e:
             print(f"Error processing patient data for row {i} (Data: {current_patient_data}): {str(e)}")
+            # Errors such as an invalid API key would fail every remaining row, so we stop here
+            if aborts_run(e):
+                print("ERROR: Stopping the run, no request can succeed.")
+                break
             continue
 
     if not processed_patients:
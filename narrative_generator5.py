@@ -1,21 +1,53 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import contextvars
 import csv
+import itertools
 import os
 import anthropic
 import json
 import re
-from typing import Dict, Any, List
+import time
+from typing import Dict, Any, Iterable, List, Mapping
 import sys
 
+from response_cache import ResponseCache, make_cache_key, RESPONSE_CACHE_PATH
+from run_checkpoint import CheckpointedOutput, make_row_id
+from request_scheduler import RequestScheduler, SchedulerTicket, estimate_input_tokens
+from llm_backends import AnthropicBackend, OpenAICompatibleBackend
+from streaming_json import IncrementalJSONParser
+from patient_records import PatientRecordFile
+from run_metrics import RunMetrics, MetricsServer, MetricsFileWriter, METRICS_FILE_INTERVAL
+from token_budget import TokenLedger, BudgetGuard, FALLBACK_MODEL
+from near_duplicates import NearDuplicateIndex, NearDuplicateError, DUPLICATE_THRESHOLD
+from retry_policy import RetryPolicy, CircuitBreaker, InvalidResponseError, StopRunError, classify_error, aborts_run, FATAL, RETRYABLE
+
 # We first import the API key from a the api_key file within the folder
 # In our case, the api_key.py file contains the anthropic_key variable
 # You may not have the api_key.py file. If you do not, create one, and then 
 # add the following line to it:
 # anthropic_key = "your_anthropic_api_key_here"
-from api_key import anthropic_key
+# Without the file we fall back to the ANTHROPIC_API_KEY environment variable, which
+# is what the offline load tests (mock_anthropic_server.py) use
+try:
+    from api_key import anthropic_key
+except ImportError:
+    anthropic_key = os.environ.get("ANTHROPIC_API_KEY")
 
 # Once we have our API key, we can initialize the Anthropic client
 # We also save it to a variable for later use
 client = anthropic.Client(api_key=anthropic_key)
+# The async client is used by the concurrent generation engine in generate_narratives.
+# Its built-in retries are turned off: they would hide 429 and 529 responses from the
+# request scheduler, and generate_patient_narrative retries failed requests itself
+async_client = anthropic.AsyncClient(api_key=anthropic_key, max_retries=0)
+
+# Every narrative request goes through an LLM backend. Production runs use the hosted
+# Anthropic API; pilot runs and load tests can switch to an OpenAI-compatible local
+# server (llama.cpp, vLLM) with the --backend option
+backend = AnthropicBackend(client, async_client)
 
 # What we need to do next is to copy paste the patient data csv title into the variable patient_csv
 # This contains the patient information that we will use to generate narratives
@@ -26,6 +58,100 @@ CSV_FILE_PATH = f"patient_data/{patient_csv}.csv"
 # We also define the output CSV file path where we will save the generated narratives
 OUTPUT_CSV_FILE_PATH = f"patient_data/{patient_csv}_with_narratives.csv"
 
+# Every completed row is also recorded in a checkpoint file next to the output,
+# so that an interrupted run can be picked up again with --resume
+CHECKPOINT_FILE_PATH = f"patient_data/{patient_csv}_with_narratives.checkpoint.jsonl"
+
+# The token usage and spend of the run, per row, per stratum and in total, are saved here
+TOKEN_USAGE_FILE_PATH = f"patient_data/{patient_csv}_with_narratives.usage.json"
+
+# The number of narrative requests we allow to be in flight at the same time.
+# Our runs are network-bound, so 16-32 concurrent requests cut wall-clock time
+# considerably. Setting this to 1 reproduces the original one-row-at-a-time behaviour
+CONCURRENCY = 16
+
+# Our organisation's rate limits. These are only the starting point of the request
+# scheduler, which adopts the limits the API reports in the rate limit headers of its
+# responses and lowers the concurrency when it gets 429 or 529 responses
+REQUESTS_PER_MINUTE = 50
+INPUT_TOKENS_PER_MINUTE = 30000
+OUTPUT_TOKENS_PER_MINUTE = 8000
+
+# The request scheduler of the run, created by main. Without one, requests are sent
+# as soon as a worker is free
+scheduler = None
+
+# Failed requests are retried with capped exponential backoff and jitter. The circuit
+# breaker is shared by all workers and pauses every request when the error rate spikes
+RETRY_POLICY = RetryPolicy(max_attempts=5, base_delay=1.0, max_delay=60.0)
+circuit_breaker = CircuitBreaker()
+
+# The on-disk response cache. It is opt-in (see the --cache option), because a normal
+# sampling rerun should draw new narratives rather than replay the stored ones.
+# When enabled, rerunning on the same input replays every response from disk for free
+response_cache = None
+
+# The model settings used for every narrative request, whether streamed or batched
+MODEL = "claude-4-sonnet-20250514"
+MAX_TOKENS = 500
+TEMPERATURE = 0.7
+
+# The near-duplicate gate of the run, created by main. It holds every accepted narrative
+# in a MinHash LSH index and rejects new ones whose Jaccard similarity to any of them is
+# above the threshold (--duplicate-threshold, 0 turns the gate off). Showing the model the
+# last three narratives cannot stop it from repeating narrative 12 as narrative 500
+duplicate_index = None
+
+# The token accounting of the run, created by main. Every call's input, output and cached
+# tokens are recorded for its row and stratum, so we know what a run cost and how much of
+# it went to responses that were thrown away
+token_ledger = None
+
+# The spend limit of the run (--budget), created by main. Once the projected spend is over
+# the budget it switches to a cheaper model, and it stops sending requests that could
+# take the spend over it
+budget_guard = None
+
+# The (row ID, stratum) the current worker is generating, for the token accounting
+current_row = contextvars.ContextVar("current_row", default=(None, None))
+
+# The live metrics of the run (rows/s, in-flight requests, latency histograms, retries by
+# cause, tokens/s, ETA), created by main. They are served in Prometheus text format with
+# --metrics-port and/or rewritten as JSON to --metrics-file while the run goes on
+run_metrics = None
+
+# The factor the token usage is broken down by
+STRATUM_FIELD = "race"
+
+# With structured output, every request forces a call to the record_narrative tool, whose
+# input schema is the {gender, narrative} object we need. The API then returns the fields
+# as the tool's input instead of free text that may not parse, so invalid JSON no longer
+# costs an extra generation. Turned on with the --structured-output option
+structured_output = False
+NARRATIVE_TOOL = {
+    "name": "record_narrative",
+    "description": "Record the generated patient narrative.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "gender": {"type": "string", "description": "The gender of the patient"},
+            "narrative": {"type": "string", "description": "The first-person narrative of the patient"},
+        },
+        "required": ["gender", "narrative"],
+    },
+}
+
+# The columns of the *_with_narratives.csv output file, the same for streamed and batched
+# runs. The AI suggested temperature column is left empty for rows that do not have one
+OUTPUT_FIELDNAMES = [
+    "age_group", "gender", "race", "pain_intensity",
+    "narrative", "temperature", "ai_suggested_temperature"
+]
+
+# The number of previously generated narratives shown to the model in every request.
+# Only this many are kept in memory during a run
+NARRATIVE_EXAMPLES = 3
+
 def print_with_border(text: str, width: int = 80):
     """
     Print text with a decorative border within terminal.
@@ -65,15 +191,260 @@ def extract_json_from_response(response_text: str):
     # If no code blocks found, assume the entire response is JSON
     return response_text
 
-def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives: List[str], max_retries: int = 3):
+# The static part of the system prompt. It is identical for every row of a run, so it is
+# kept apart from everything that changes between calls (the previously generated
+# narratives), which go in a separate block after it. Once it is long enough to be cached
+# (see PROMPT_CACHE_MIN_TOKENS), the server reuses it instead of processing it again on
+# every call.
+STATIC_SYSTEM_PROMPT = """
+You are an AI assistant helping with a psychological study that analyzes
+the moral convictions of medical professionals confronted with the
+possibility of administering assisted dying to patients. The study involves
+presenting participants with patient narratives seeking assisted dying.
+Your task is to generate a short, realistic narrative for each patient
+based on their information, which includes their age, gender, race, and pain intensity.
+
+The narrative should be:
+1. Written in the first person from the patient's perspective
+2. Explain their situation and desire to pursue assisted dying
+3. Mention that they have family approval
+4. Be DISTINCTLY DIFFERENT from previous narratives in terms of:
+   - Narrative structure
+   - Word choice and phrasing
+   - Emotional tone and perspective
+   - Reasoning and decision-making process
+
+IMPORTANT RESTRICTIONS:
+- Do not mention the patient's occupation
+- Do not specify the type of illness
+- Do not describe how the illness affects the patient
+- Do not mention personal interests or hobbies
+- Do not mention personal or cultural beliefs
+
+The output content should be in JSON format with separate fields for:
+- gender (string)
+- narrative (string)
+
+Provide the JSON response without any markdown formatting or code blocks.
+"""
+
+# The API only caches prompt prefixes of at least this many tokens (1024 for Sonnet
+# models); a cache_control breakpoint on a shorter prefix never gives a cache hit
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# The estimated length of the static prompt, with the same 4 characters per token
+# estimate the request scheduler uses. Nothing else in the request is the same on every
+# call, so this is the longest prefix that could be cached
+STATIC_PROMPT_TOKENS = len(STATIC_SYSTEM_PROMPT) // 4
+
+# Whether the static prompt is long enough to be cached. The current prompt is about
+# 300 tokens, so prompt caching is DISABLED: no breakpoint is sent, and every run says so
+# at startup (see print_prompt_cache_status). It switches on by itself once the static
+# prompt grows past PROMPT_CACHE_MIN_TOKENS
+PROMPT_CACHE_ENABLED = STATIC_PROMPT_TOKENS >= PROMPT_CACHE_MIN_TOKENS
+
+def print_prompt_cache_status():
+    """
+    Print whether the static system prompt is cached, and why not if it is not.
+    """
+    if PROMPT_CACHE_ENABLED:
+        print(f"Prompt caching is enabled for the static system prompt (about {STATIC_PROMPT_TOKENS} tokens)")
+    else:
+        print(f"Prompt caching is disabled: the static system prompt is about {STATIC_PROMPT_TOKENS} tokens, "
+              f"below the {PROMPT_CACHE_MIN_TOKENS} token minimum the API caches. The token report will show no cache reads")
+
+def build_system_prompt(narrative_examples: str):
+    """
+    Build the system prompt as a static prefix followed by the dynamic examples. The
+    prefix is marked for prompt caching when PROMPT_CACHE_ENABLED is set.
+    Args:
+        narrative_examples: The formatted previously generated narratives, or an empty string
+    Returns:
+        A list of system prompt text blocks for the Messages API.
+    """
+    system = [{"type": "text", "text": STATIC_SYSTEM_PROMPT}]
+    if PROMPT_CACHE_ENABLED:
+        system[0]["cache_control"] = {"type": "ephemeral"}
+    # The API rejects empty text blocks, so the dynamic block is only added when there are examples
+    if narrative_examples:
+        system.append({"type": "text", "text": narrative_examples})
+    return system
+
+def record_token_usage(request: Dict[str, Any], usage: Dict[str, int]):
+    """
+    Add the usage of one API call to the token accounting of the current row.
+    Args:
+        request: The request keyword arguments the call was made with
+        usage: The token usage of the response, as reported by the backend
+    """
+    if token_ledger is not None:
+        row_key, stratum = current_row.get()
+        token_ledger.record_call(row_key, stratum, request["model"], usage)
+
+def build_narrative_request(patient_data: Dict[str, Any], existing_narratives: List[str], temperature: float = TEMPERATURE,
+                            use_structured_output: bool = False):
+    """
+    Build the keyword arguments of a Messages API request for one patient narrative.
+    Args:
+        patient_data: A dictionary containing patient information
+        existing_narratives: A list of previously generated narratives to ensure uniqueness
+        temperature: The sampling temperature for the request
+        use_structured_output: Whether to force the record_narrative tool call
+    Returns:
+        A dictionary with the model, max_tokens, temperature, system and messages of the request.
+        It can be passed to client.messages.create or used as the params of a batch request.
+    """
+    # We show the model the last three narratives so that it can make the new one distinct.
+    # Works for lists and for the bounded deques generate_narratives keeps
+    narrative_examples = ""
+    if existing_narratives:
+        last_narratives = list(itertools.islice(reversed(existing_narratives), NARRATIVE_EXAMPLES))[::-1]
+        narrative_examples = "\n\nPreviously generated narratives:\n" + "\n---\n".join(
+            [f"Narrative {i+1}:\n{narrative}" for i, narrative in enumerate(last_narratives)]
+        )
+
+    request = {
+        "model": MODEL,
+        "max_tokens": MAX_TOKENS,
+        "temperature": temperature,
+        "system": build_system_prompt(narrative_examples),
+        "messages": [{
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": f"""Please generate a unique patient narrative for assisted dying based on the following information:
+                        Age Group: {patient_data.get('age_group')}
+                        Race: {patient_data.get('race')}
+                        Pain Intensity: {patient_data.get('pain_intensity')}"""
+            }]
+        }],
+    }
+    if use_structured_output:
+        request["tools"] = [NARRATIVE_TOOL]
+        request["tool_choice"] = {"type": "tool", "name": NARRATIVE_TOOL["name"]}
+    return request
+
+def parse_narrative_response(response_text: str, temperature: float, json_content: str = None):
+    """
+    Parse the text of a narrative response into a dictionary.
+    Args:
+        response_text: The full text returned by the model
+        temperature: The temperature the request was made with
+        json_content: The JSON object in the response, if the caller already located it
+            (streamed responses do so while they arrive). Otherwise it is extracted here
+    Returns:
+        A dictionary with the gender and narrative fields, the temperature used, and the
+        AI suggested temperature if the model returned one.
+    Raises:
+        json.JSONDecodeError: If the response does not contain valid JSON
+        InvalidResponseError: If the JSON does not contain the gender and narrative fields
+    """
+    # Extract JSON from the response (handles markdown code blocks)
+    if json_content is None:
+        json_content = extract_json_from_response(response_text)
+    json_data = json.loads(json_content)
+    # A response without the fields we need is as unusable as one that is not JSON
+    for field in ("gender", "narrative"):
+        if field not in json_data:
+            raise InvalidResponseError(f"Response is missing the '{field}' field")
+
+    # Store both the AI-generated temperature (if any) and actual temperature
+    ai_generated_temp = json_data.get("temperature", None)
+    if ai_generated_temp is not None:
+        print(f"AI suggested temperature: {ai_generated_temp}")
+        json_data["ai_suggested_temperature"] = ai_generated_temp
+
+    # Always use our actual temperature value for the output
+    json_data["temperature"] = temperature
+    return json_data
+
+async def stream_narrative(request: Dict[str, Any], echo: bool = True):
+    """
+    Stream one narrative request and collect the response text.
+    Args:
+        request: The request keyword arguments built by build_narrative_request
+        echo: Whether to echo the streamed tokens to the terminal
+    Returns:
+        The IncrementalJSONParser that was fed the response. Its text is the full response
+        and its json_text the JSON object in it. Only the narrative is echoed.
+    Raises:
+        json.JSONDecodeError: As soon as the response turns out not to be a JSON object
+    """
+    # The scheduler holds the request back until it fits within the rate limits.
+    # Without a scheduler the ticket only collects what the request reports
+    if scheduler is not None:
+        slot = scheduler.slot(estimate_input_tokens(request), request["max_tokens"])
+    else:
+        slot = contextlib.nullcontext(SchedulerTicket())
+
+    reservation = 0.0
+    try:
+        async with slot as ticket:
+            # The worst-case cost of the request counts against the budget until its usage is
+            # known. It is reserved only once the scheduler lets the request go, so requests
+            # waiting in the scheduler do not hold budget
+            if budget_guard is not None:
+                reservation = await budget_guard.reserve(request)
+            # The latencies are measured from the moment the request is sent
+            sent_at = time.perf_counter()
+            usage = {}
+            if run_metrics is not None:
+                run_metrics.request_started()
+            try:
+                stream = await backend.astream(request)
+                ticket.observe_headers(stream.headers)
+
+                if echo:
+                    print("\nGenerating narrative: ")
+                # The parser follows the JSON structure as the tokens arrive, so a response that is
+                # not JSON fails on its first tokens and we can retry without waiting for the rest
+                parser = IncrementalJSONParser()
+                first_token = True
+                try:
+                    async for text in stream:
+                        if first_token and run_metrics is not None:
+                            run_metrics.first_token(time.perf_counter() - sent_at)
+                        first_token = False
+                        narrative_text = parser.feed(text)
+                        if echo and narrative_text:
+                            sys.stdout.write(narrative_text)
+                            sys.stdout.flush()
+                except json.JSONDecodeError:
+                    await stream.aclose()
+                    raise
+                finally:
+                    usage = stream.usage
+            finally:
+                # Every attempt is accounted: aborted responses are billed for what was generated,
+                # and attempts that failed before streaming (e.g. a 429 or 529) count as calls
+                # without tokens
+                record_token_usage(request, usage)
+                if run_metrics is not None:
+                    run_metrics.request_finished(time.perf_counter() - sent_at, usage)
+
+            # The usage includes the output tokens actually generated
+            ticket.output_tokens = stream.usage.get("output_tokens", ticket.output_tokens)
+    finally:
+        if budget_guard is not None:
+            await budget_guard.release(reservation)
+    if echo:
+        print("\n")
+    return parser
+
+async def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives: List[str], max_retries: int = RETRY_POLICY.max_attempts, echo: bool = True):
     """
     This is the main function that generates a unique narrative for a patient
     Args:
         patient_data: A dictionary containing patient information
         existing_narratives: A list of previously generated narratives to ensure uniqueness
-        max_retries: The maximum number of retries for generating a narrative in case of errors
+        max_retries: The maximum number of attempts for generating a narrative in case of errors
+        echo: Whether to echo the streamed tokens to the terminal. This is turned off when
+            several narratives are generated concurrently, as their tokens would interleave
     Returns:
         A JSON string containing the generated narrative and other patient information
+    Raises:
+        The original error if it is fatal (e.g. authentication or a bad request), as
+        retrying cannot fix it, or ValueError when all attempts failed.
     """
     # Here, we call the print_with_border function to print a message with a border
     # Uses .get() to safely access patient data fields in case a key is unexpectedly missing
@@ -85,183 +456,340 @@ def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives
         f"Pain Intensity: {patient_data.get('pain_intensity', 'N/A')})"
     )
 
-    
-    narrative_examples = ""
-    if existing_narratives:
-        narrative_examples = "\n\nPreviously generated narratives:\n" + "\n---\n".join(
-            [f"Narrative {i+1}:\n{narrative}" for i, narrative in enumerate(existing_narratives[-3:])]
-        )
 
+    # A cached response that the near-duplicate gate rejected would be replayed on every
+    # retry, so after a rejection we always ask the API for a new narrative
+    skip_cache = False
     for attempt in range(max_retries):
+        response_text = ""
         try:
-            temperature = .7  # Changed from 0.0 to 0.25
+            # When the circuit breaker is open, every worker waits here until it lets requests through
+            await circuit_breaker.wait_async()
+
+            temperature = TEMPERATURE
             print(f"Using temperature: {temperature}")
 
-            message = client.messages.create(
-                model="claude-4-sonnet-20250514", 
-                max_tokens=500,
-                temperature=temperature,
-                stream=True,
-                system=f"""
-                You are an AI assistant helping with a psychological study that analyzes
-                the moral convictions of medical professionals confronted with the
-                possibility of administering assisted dying to patients. The study involves
-                presenting participants with patient narratives seeking assisted dying.
-                Your task is to generate a short, realistic narrative for each patient
-                based on their information, which includes their age, gender, race, and pain intensity.
-
-                The narrative should be:
-                1. Written in the first person from the patient's perspective
-                2. Explain their situation and desire to pursue assisted dying
-                3. Mention that they have family approval
-                4. Be DISTINCTLY DIFFERENT from previous narratives in terms of:
-                   - Narrative structure
-                   - Word choice and phrasing
-                   - Emotional tone and perspective
-                   - Reasoning and decision-making process
-
-                IMPORTANT RESTRICTIONS:
-                - Do not mention the patient's occupation
-                - Do not specify the type of illness
-                - Do not describe how the illness affects the patient
-                - Do not mention personal interests or hobbies
-                - Do not mention personal or cultural beliefs
-
-                {narrative_examples}
-
-                The output content should be in JSON format with separate fields for:
-                - gender (string)
-                - narrative (string)
-
-                Provide the JSON response without any markdown formatting or code blocks.
-                """,
-                messages=[{
-                    "role": "user",
-                    "content": [{
-                        "type": "text",
-                        "text": f"""Please generate a unique patient narrative for assisted dying based on the following information:
-                        Age Group: {patient_data.get('age_group')}
-                        Race: {patient_data.get('race')}
-                        Pain Intensity: {patient_data.get('pain_intensity')}"""
-                    }]
-                }])
-
-            print("\nGenerating narrative: ")
-            response_text = ""
-            for chunk in message:
-                if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
-                    sys.stdout.write(chunk.delta.text)
-                    sys.stdout.flush()
-                    response_text += chunk.delta.text
-            print("\n")
-
-            # Extract JSON from the response (handles markdown code blocks)
-            json_content = extract_json_from_response(response_text)
-            json_data = json.loads(json_content)
-            
-            # Store both the AI-generated temperature (if any) and actual temperature
-            ai_generated_temp = json_data.get("temperature", None)
-            if ai_generated_temp is not None:
-                print(f"AI suggested temperature: {ai_generated_temp}")
-                json_data["ai_suggested_temperature"] = ai_generated_temp
-            
-            # Always use our actual temperature value for the output
-            json_data["temperature"] = temperature
+            request = build_narrative_request(patient_data, existing_narratives, temperature, structured_output)
+            if budget_guard is not None:
+                budget_guard.choose_model(request)
+
+            # Identical requests replay their stored response when the response cache is enabled
+            cache_key = make_cache_key(request) if response_cache is not None and not skip_cache else None
+            cached_text = response_cache.get(cache_key) if cache_key else None
+            json_content = None
+            if cached_text is not None:
+                print("Using cached response")
+                response_text = cached_text
+            else:
+                parser = await stream_narrative(request, echo)
+                circuit_breaker.record_success()
+                response_text = parser.text
+                json_content = parser.json_text()
+
+            json_data = parse_narrative_response(response_text, temperature, json_content)
+            # Narratives too similar to an accepted one are rejected and generated again
+            if duplicate_index is not None:
+                duplicate_index.check_and_add(json_data["narrative"])
+            # Only responses that pass these checks are cached, so a replayed response never needs a retry
+            if cache_key and cached_text is None:
+                response_cache.put(cache_key, response_text)
             return json.dumps(json_data)
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error in attempt {attempt + 1}: {str(e)}")
-            print(f"Response text: {response_text[:200]}...")  # Show first 200 chars for debugging
-            continue
         except Exception as e:
-            print(f"Narrative generation attempt {attempt + 1} failed: {str(e)}. Retrying...")
-            continue
+            error_class = classify_error(e)
+            if error_class == FATAL:
+                print(f"Narrative generation attempt {attempt + 1} failed with a fatal error: {str(e)}")
+                raise
+            if error_class == RETRYABLE:
+                circuit_breaker.record_failure()
+                print(f"Narrative generation attempt {attempt + 1} failed: {str(e)}.")
+            else:
+                print(f"Invalid response in attempt {attempt + 1}: {str(e)}")
+                print(f"Response text: {response_text[:200]}...")  # Show first 200 chars for debugging
+                if isinstance(e, NearDuplicateError):
+                    skip_cache = True
+            if not RETRY_POLICY.should_retry(e, attempt) or attempt + 1 >= max_retries:
+                break
+            if run_metrics is not None:
+                run_metrics.retry(e)
+            delay = RETRY_POLICY.backoff_delay(e, attempt)
+            print(f"Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
 
     raise ValueError("Failed to generate a valid JSON response after multiple attempts.")
 
-def main():
-    # Read patient data from the input CSV file
-    try:
-        with open(CSV_FILE_PATH, "r", newline='') as csv_file:
-            csv_reader = csv.DictReader(csv_file)
-            # Check if 'pain_intensity' is in the field names, if not, raise an error or warning
-            if 'pain_intensity' not in csv_reader.fieldnames:
-                print(f"ERROR: The CSV file '{CSV_FILE_PATH}' must contain a column named 'pain_intensity'.")
-                print(f"Detected columns: {csv_reader.fieldnames}")
-                return
+def build_processed_patient(patient_data: Dict[str, Any], narrative_data: Dict[str, Any]):
+    """
+    Combine an input row and its generated narrative into one output row.
+    Args:
+        patient_data: A dictionary containing the patient row from the input CSV
+        narrative_data: A dictionary with the parsed narrative response
+    Returns:
+        A dictionary with the columns of the *_with_narratives.csv output file.
+    """
+    processed_patient = {
+        "age_group": patient_data.get("age_group"),
+        "gender": narrative_data["gender"],
+        "race": patient_data.get("race"),
+        "pain_intensity": patient_data.get("pain_intensity"),
+        "narrative": narrative_data["narrative"],
+        "temperature": narrative_data["temperature"]
+    }
+
+    # Add AI suggested temperature if it exists
+    if "ai_suggested_temperature" in narrative_data:
+        processed_patient["ai_suggested_temperature"] = narrative_data["ai_suggested_temperature"]
+
+    return processed_patient
+
+async def generate_narratives(patient_data_list: Iterable[Mapping[str, Any]], output: CheckpointedOutput, concurrency: int = CONCURRENCY):
+    """
+    Generate narratives for every patient, keeping up to `concurrency` requests in flight.
+    Args:
+        patient_data_list: The patient rows from the input file: a PatientRecordFile, which
+            is streamed row by row, or a list of dictionaries
+        output: The checkpointed output the completed rows are written to. Rows it already
+            holds from an earlier run are skipped
+        concurrency: The maximum number of narrative requests that run at the same time
+    Returns:
+        The number of rows written to the output in this run. The output keeps the rows in
+        input-row order; rows that failed to generate are left out.
+    """
+    # Narratives from a resumed run are shown to the model just like new ones,
+    # and new narratives may not duplicate them either. Only the narratives the prompt
+    # shows are kept; the duplicate index reads the earlier ones from the checkpoint
+    existing_narratives = collections.deque(output.narratives, maxlen=NARRATIVE_EXAMPLES)
+    if duplicate_index is not None:
+        for narrative in output.iter_narratives():
+            duplicate_index.add(narrative)
+    # Streamed tokens are only echoed when we process one row at a time,
+    # otherwise the tokens of concurrent narratives would interleave in the terminal
+    echo = concurrency == 1
+    total_patients = len(patient_data_list)
+    # Every row that still needs a narrative gets a sequence number, which the output uses
+    # to write the rows in order. All workers pull their next row from the same iterator.
+    # This is safe because asyncio runs the workers on a single thread and only switches
+    # between them at an await
+    rows = enumerate(
+        (i, patient_data_row, row_id)
+        for i, patient_data_row in enumerate(patient_data_list, 1)
+        if (row_id := make_row_id(i, patient_data_row)) not in output.completed_row_ids
+    )
 
-            patient_data_list = list(csv_reader)
+    async def worker():
+        for sequence, (i, current_patient_data, row_id) in rows:
+            # Rows are only read, so the record is used as it is instead of being copied
+            stratum = current_patient_data.get(STRATUM_FIELD)
+            current_row.set((row_id, stratum))
+            try:
+                print_with_border(f"Processing patient {i} of {total_patients}")
+
+                # Ensure necessary keys are present from the CSV
+                if 'pain_intensity' not in current_patient_data or not current_patient_data['pain_intensity']:
+                    print(f"Warning: Patient {i} is missing 'pain_intensity' data in the CSV. Skipping or handling as default if necessary.")
+
+                print(f"Using data from CSV - Age Group: {current_patient_data.get('age_group')}, Race: {current_patient_data.get('race')}, Pain Intensity: {current_patient_data.get('pain_intensity')}")
+
+                narrative_json = await generate_patient_narrative(current_patient_data, existing_narratives, echo=echo)
+                narrative_data = json.loads(narrative_json)
+
+                existing_narratives.append(narrative_data['narrative'])
+
+                output.complete(sequence, row_id, build_processed_patient(current_patient_data, narrative_data))
+                if token_ledger is not None:
+                    token_ledger.finish_row(row_id, stratum, accepted=True)
+                if run_metrics is not None:
+                    run_metrics.row_finished(accepted=True)
+
+                print(f"\nSuccessfully processed patient {i} (Age Group: {current_patient_data.get('age_group')}, Pain: {current_patient_data.get('pain_intensity')})")
+
+            except StopRunError as e:
+                # No new requests are sent, but the rows other workers have in flight still finish
+                print(f"Stopping before row {i}: {e}")
+                output.fail(sequence)
+                if token_ledger is not None:
+                    token_ledger.finish_row(row_id, stratum, accepted=False)
+                if run_metrics is not None:
+                    run_metrics.row_finished(accepted=False)
+                return
+            except Exception as e:
+                print(f"Error processing patient data for row {i} (Data: {current_patient_data}): {str(e)}")
+                output.fail(sequence)
+                if token_ledger is not None:
+                    token_ledger.finish_row(row_id, stratum, accepted=False)
+                if run_metrics is not None:
+                    run_metrics.row_finished(accepted=False)
+                # Errors such as an invalid API key would fail every remaining row, so we stop the run
+                if aborts_run(e):
+                    raise
+                continue
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return output.rows_written
+
+def load_patient_data(csv_file_path: str):
+    """
+    Open the input file as a stream of compact patient records.
+    Args:
+        csv_file_path: The path of the input CSV file. Parquet (.parquet) and Arrow IPC
+            (.arrow) files written by patient_generator3 are read column-wise instead
+    Returns:
+        A PatientRecordFile, which reads the rows one at a time whenever it is iterated,
+        or None if the file could not be read. Its records behave like read-only dictionaries.
+    """
+    try:
+        patient_rows = PatientRecordFile(csv_file_path)
+        fieldnames = patient_rows.fieldnames
     except FileNotFoundError:
-        print(f"ERROR: Input CSV file not found at {CSV_FILE_PATH}")
-        return
+        print(f"ERROR: Input patient file not found at {csv_file_path}")
+        return None
     except Exception as e:
-        print(f"ERROR: Could not read CSV file: {e}")
-        return
-
-    print_with_border(f"Processing {len(patient_data_list)} patients from {CSV_FILE_PATH}")
+        print(f"ERROR: Could not read patient file: {e}")
+        return None
 
-    existing_narratives = []
-    processed_patients = []
+    # Check if 'pain_intensity' is in the field names, if not, raise an error or warning
+    if 'pain_intensity' not in fieldnames:
+        print(f"ERROR: The patient file '{csv_file_path}' must contain a column named 'pain_intensity'.")
+        print(f"Detected columns: {fieldnames}")
+        return None
+    return patient_rows
 
-    for i, patient_data_row in enumerate(patient_data_list, 1):
-        current_patient_data = dict(patient_data_row)
-        try:
-            print_with_border(f"Processing patient {i} of {len(patient_data_list)}")
-
-            # Ensure necessary keys are present from the CSV
-            if 'pain_intensity' not in current_patient_data or not current_patient_data['pain_intensity']:
-                print(f"Warning: Patient {i} is missing 'pain_intensity' data in the CSV. Skipping or handling as default if necessary.")
-
-            print(f"Using data from CSV - Age Group: {current_patient_data.get('age_group')}, Race: {current_patient_data.get('race')}, Pain Intensity: {current_patient_data.get('pain_intensity')}")
+def save_processed_patients(processed_patients: List[Dict[str, Any]], output_csv_file_path: str):
+    """
+    Write the processed patients to the output CSV file.
+    Args:
+        processed_patients: A list of output rows built by build_processed_patient
+        output_csv_file_path: The path of the output CSV file
+    """
+    try:
+        with open(output_csv_file_path, "w", newline="") as csv_file:
+            # The same columns as a streamed run, so both modes share one output schema
+            csv_writer = csv.DictWriter(csv_file, fieldnames=OUTPUT_FIELDNAMES)
+            csv_writer.writeheader()
+            csv_writer.writerows(processed_patients)
+        print_with_border(f"Generated narratives for {len(processed_patients)} patients and saved them to {output_csv_file_path}")
+    except IOError as e:
+        print(f"ERROR: Could not write to output CSV file {output_csv_file_path}: {e}")
 
-            narrative_json = generate_patient_narrative(current_patient_data, existing_narratives)
-            narrative_data = json.loads(narrative_json)
+def main(concurrency: int = CONCURRENCY, use_cache: bool = False, cache_path: str = RESPONSE_CACHE_PATH, resume: bool = False,
+         backend_name: str = "anthropic", base_url: str = None, backend_model: str = None, use_structured_output: bool = False,
+         duplicate_threshold: float = DUPLICATE_THRESHOLD, budget: float = None, fallback_model: str = FALLBACK_MODEL,
+         metrics_port: int = None, metrics_file: str = None):
+    global response_cache, scheduler, backend, structured_output, duplicate_index, token_ledger, budget_guard, run_metrics
 
-            existing_narratives.append(narrative_data['narrative'])
+    structured_output = use_structured_output
 
-            processed_patient = {
-                "age_group": current_patient_data.get("age_group"),
-                "gender": narrative_data["gender"],
-                "race": current_patient_data.get("race"),
-                "pain_intensity": current_patient_data.get("pain_intensity"),
-                "narrative": narrative_data["narrative"],
-                "temperature": narrative_data["temperature"]
-            }
-            
-            # Add AI suggested temperature if it exists
-            if "ai_suggested_temperature" in narrative_data:
-                processed_patient["ai_suggested_temperature"] = narrative_data["ai_suggested_temperature"]
-            
-            processed_patients.append(processed_patient)
+    if backend_name == "openai":
+        backend = OpenAICompatibleBackend(base_url, model=backend_model)
+        print(f"Using the OpenAI-compatible server at {base_url}")
 
-            print(f"\nSuccessfully processed patient {i} (Age Group: {current_patient_data.get('age_group')}, Pain: {current_patient_data.get('pain_intensity')})")
+    # Read patient data from the input CSV file
+    patient_data_list = load_patient_data(CSV_FILE_PATH)
+    if patient_data_list is None:
+        return
 
-        except Exception as e:
-            print(f"Error processing patient data for row {i} (Data: {current_patient_data}): {str(e)}")
-            continue
+    print_with_border(f"Processing {len(patient_data_list)} patients from {CSV_FILE_PATH}")
+    print_prompt_cache_status()
 
-    if not processed_patients:
-        print("No patients were processed. Output file will not be created.")
+    # Rows are written as soon as they complete, so the columns have to be fixed up front.
+    # The AI suggested temperature column is left empty for rows that do not have one
+    try:
+        output = CheckpointedOutput(
+            OUTPUT_CSV_FILE_PATH, CHECKPOINT_FILE_PATH,
+            OUTPUT_FIELDNAMES, resume=resume, narrative_window=NARRATIVE_EXAMPLES
+        )
+    except IOError as e:
+        print(f"ERROR: Could not open output CSV file {OUTPUT_CSV_FILE_PATH}: {e}")
         return
 
-    # Write all processed data to the output CSV file
+    if use_cache:
+        response_cache = ResponseCache(cache_path)
+    duplicate_index = NearDuplicateIndex(duplicate_threshold) if duplicate_threshold > 0 else None
+    rows_to_generate = max(0, len(patient_data_list) - len(output.completed_row_ids))
+    token_ledger = TokenLedger(rows_to_generate)
+    budget_guard = BudgetGuard(token_ledger, budget, fallback_model) if budget else None
+    run_metrics = RunMetrics(rows_to_generate)
+    metrics_outputs = []
     try:
-        with open(OUTPUT_CSV_FILE_PATH, "w", newline="") as csv_file:
-            # Determine fieldnames based on whether we have AI suggested temperatures
-            fieldnames = [
-                "age_group", "gender", "race", "pain_intensity",
-                "narrative", "temperature"
-            ]
-            
-            # Check if any patient has ai_suggested_temperature
-            if any("ai_suggested_temperature" in p for p in processed_patients):
-                fieldnames.append("ai_suggested_temperature")
-            
-            csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-            csv_writer.writeheader()
-            csv_writer.writerows(processed_patients)
-        print_with_border(f"Generated narratives for {len(processed_patients)} patients and saved them to {OUTPUT_CSV_FILE_PATH}")
+        if metrics_port is not None:
+            metrics_outputs.append(MetricsServer(run_metrics, port=metrics_port).start())
+            print(f"Serving live metrics at {metrics_outputs[-1].url}")
+        if metrics_file:
+            metrics_outputs.append(MetricsFileWriter(run_metrics, metrics_file).start())
+            print(f"Writing live metrics to {metrics_file}")
+    except OSError as e:
+        print(f"ERROR: Could not start the live metrics: {e}")
+    scheduler = RequestScheduler(concurrency, REQUESTS_PER_MINUTE, INPUT_TOKENS_PER_MINUTE, OUTPUT_TOKENS_PER_MINUTE)
+    try:
+        asyncio.run(generate_narratives(patient_data_list, output, concurrency))
+    except Exception as e:
+        if not aborts_run(e):
+            raise
+        print(f"ERROR: Stopping the run, no request can succeed: {e}")
+    finally:
+        output.close()
+        for metrics_output in metrics_outputs:
+            metrics_output.stop()
+        if response_cache is not None:
+            response_cache.close()
+            response_cache = None
+    print_with_border("\n".join(token_ledger.report_lines()))
+    try:
+        token_ledger.save(TOKEN_USAGE_FILE_PATH)
     except IOError as e:
-        print(f"ERROR: Could not write to output CSV file {OUTPUT_CSV_FILE_PATH}: {e}")
+        print(f"ERROR: Could not save the token usage to {TOKEN_USAGE_FILE_PATH}: {e}")
+    if duplicate_index is not None:
+        print(f"Near-duplicate gate: {duplicate_index.rejected} narratives rejected and regenerated "
+              f"(Jaccard threshold {duplicate_index.threshold})")
+
+    total_rows = len(output.completed_row_ids)
+    if not total_rows:
+        print("No patients were processed.")
+        return
+
+    print_with_border(
+        f"Generated narratives for {output.rows_written} patients in this run "
+        f"({total_rows} of {len(patient_data_list)} in total) and saved them to {OUTPUT_CSV_FILE_PATH}"
+    )
+
+def parse_args():
+    """
+    Parse the command line options for a narrative generation run.
+    Returns:
+        An argparse.Namespace with the parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Generate patient narratives for the assisted dying study.")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help=f"Maximum number of narrative requests in flight at once (default: {CONCURRENCY})")
+    parser.add_argument("--cache", action="store_true",
+                        help="Replay identical requests from the on-disk response cache instead of calling the API")
+    parser.add_argument("--cache-path", default=RESPONSE_CACHE_PATH,
+                        help=f"Location of the response cache database (default: {RESPONSE_CACHE_PATH})")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run, skipping the rows already recorded in the checkpoint")
+    parser.add_argument("--backend", choices=["anthropic", "openai"], default="anthropic",
+                        help="The LLM backend: the hosted Anthropic API or an OpenAI-compatible server such as llama.cpp or vLLM")
+    parser.add_argument("--base-url", default="http://localhost:8080",
+                        help="Address of the OpenAI-compatible server (default: http://localhost:8080)")
+    parser.add_argument("--backend-model", default=None,
+                        help="Model name to request from the OpenAI-compatible server")
+    parser.add_argument("--structured-output", action="store_true",
+                        help="Force a tool call with the {gender, narrative} schema instead of asking for JSON text")
+    parser.add_argument("--duplicate-threshold", type=float, default=DUPLICATE_THRESHOLD,
+                        help=f"Regenerate narratives whose Jaccard similarity to an accepted one is above this (default: {DUPLICATE_THRESHOLD}, 0 to turn off)")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="Spend limit of the run in USD. Requests that could go over it are not sent")
+    parser.add_argument("--budget-fallback-model", default=FALLBACK_MODEL,
+                        help=f"Cheaper model used once the projected spend is over the budget (default: {FALLBACK_MODEL}, 'none' to keep the model)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve live metrics in Prometheus text format on http://127.0.0.1:PORT/metrics (JSON on /metrics.json)")
+    parser.add_argument("--metrics-file", default=None,
+                        help=f"Rewrite live metrics as JSON to this file every {METRICS_FILE_INTERVAL:.0f} seconds")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    main(concurrency=args.concurrency, use_cache=args.cache, cache_path=args.cache_path, resume=args.resume,
+         backend_name=args.backend, base_url=args.base_url, backend_model=args.backend_model,
+         use_structured_output=args.structured_output, duplicate_threshold=args.duplicate_threshold,
+         budget=args.budget, fallback_model=None if args.budget_fallback_model == "none" else args.budget_fallback_model,
+         metrics_port=args.metrics_port, metrics_file=args.metrics_file)
\ No newline at end of file
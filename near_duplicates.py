@@ -0,0 +1,176 @@
+import hashlib
+import random
+import re
+from typing import Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from retry_policy import InvalidResponseError
+
+# The Jaccard similarity (0-1) above which a new narrative counts as a near duplicate of
+# an accepted one. Word 3-gram Jaccard is strict: rewording a sentence already drops it
+# sharply, so 0.6 only catches narratives that reuse most of an earlier one verbatim
+DUPLICATE_THRESHOLD = 0.6
+
+# The number of MinHash permutations. More permutations give a more precise estimate
+# but make every signature slower to compute
+NUM_PERMUTATIONS = 128
+
+# The number of consecutive words per shingle
+SHINGLE_SIZE = 3
+
+# The Mersenne prime the permutation hashes are computed modulo. With 32-bit shingle
+# hashes, a * hash + b stays below 2^64, so NumPy can compute the permutations in uint64
+MERSENNE_PRIME = (1 << 31) - 1
+
+class NearDuplicateError(InvalidResponseError):
+    """
+    Raised when a generated narrative is too similar to one that was already accepted.
+    """
+
+    def __init__(self, similarity: float, duplicate_of):
+        super().__init__(f"Narrative is a near duplicate (Jaccard {similarity:.2f}) of narrative {duplicate_of}")
+        self.similarity = similarity
+        self.duplicate_of = duplicate_of
+
+def shingle_hashes(text: str, shingle_size: int = SHINGLE_SIZE):
+    """
+    Split a text into overlapping word n-grams and hash each one.
+    Args:
+        text: The narrative text
+        shingle_size: The number of consecutive words per shingle
+    Returns:
+        A frozenset of 32-bit shingle hashes. Case and punctuation are ignored.
+    """
+    words = re.findall(r"[a-z0-9']+", text.lower())
+    if len(words) < shingle_size:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)]
+    return frozenset(
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+        for shingle in shingles
+    )
+
+def choose_bands(threshold: float, num_permutations: int):
+    """
+    Choose how the signature is split into LSH bands.
+    Two texts become candidates when all rows of at least one band match, which happens
+    with probability 1 - (1 - s^rows)^bands for Jaccard similarity s. This curve is steepest
+    around (1 / bands)^(1 / rows), so we put that point a little below the threshold:
+    candidates are verified exactly, so missing a duplicate is worse than an extra check.
+    Returns:
+        A (bands, rows) tuple with bands * rows == num_permutations.
+    """
+    target = max(0.05, threshold - 0.1)
+    options = [(num_permutations // rows, rows) for rows in range(1, num_permutations + 1) if num_permutations % rows == 0]
+    return min(options, key=lambda option: abs((1.0 / option[0]) ** (1.0 / option[1]) - target))
+
+class NearDuplicateIndex:
+    """
+    An in-memory MinHash LSH index over the shingles of every accepted narrative.
+
+    A query only compares a narrative with the accepted narratives that share an LSH bucket
+    with it, so its cost does not grow with the number of narratives the way pairwise
+    comparison does. Candidates are then checked with their exact Jaccard similarity.
+    """
+
+    def __init__(self, threshold: float = DUPLICATE_THRESHOLD, num_permutations: int = NUM_PERMUTATIONS,
+                 shingle_size: int = SHINGLE_SIZE, seed: int = 1):
+        """
+        Args:
+            threshold: The Jaccard similarity above which a narrative is a near duplicate
+            num_permutations: The number of MinHash permutations
+            shingle_size: The number of consecutive words per shingle
+            seed: The seed of the permutations
+        """
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = random.Random(seed)
+        self.permutations = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME)) for _ in range(num_permutations)
+        ]
+        if np is not None:
+            self.a = np.array([a for a, _ in self.permutations], dtype=np.uint64)[:, None]
+            self.b = np.array([b for _, b in self.permutations], dtype=np.uint64)[:, None]
+        self.bands, self.rows = choose_bands(threshold, num_permutations)
+        self.buckets = [{} for _ in range(self.bands)]
+        # The shingle hashes of every accepted narrative, for the exact check of candidates
+        self.shingles = {}
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.shingles)
+
+    def _signature(self, shingles):
+        # NumPy computes all permutations of all shingles at once, which is much faster than
+        # the pure Python loop. Both give the same signature
+        if np is not None:
+            hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+            return ((self.a * hashes + self.b) % MERSENNE_PRIME).min(axis=1).tolist()
+        return [min((a * h + b) % MERSENNE_PRIME for h in shingles) for a, b in self.permutations]
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [tuple(signature[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+
+    def most_similar(self, text: str) -> Tuple[float, Optional[object]]:
+        """
+        Find the accepted narrative most similar to a text among its LSH candidates.
+        Returns:
+            A (Jaccard similarity, key) tuple, or (0.0, None) if no narrative shares a bucket with it.
+        """
+        shingles = shingle_hashes(text, self.shingle_size)
+        return self._most_similar(shingles, self._band_keys(self._signature(shingles)))
+
+    def _most_similar(self, shingles, band_keys):
+        candidates = set()
+        for bucket, band_key in zip(self.buckets, band_keys):
+            candidates.update(bucket.get(band_key, ()))
+        best = (0.0, None)
+        for key in candidates:
+            other = self.shingles[key]
+            similarity = len(shingles & other) / len(shingles | other)
+            if similarity > best[0]:
+                best = (similarity, key)
+        return best
+
+    def add(self, text: str, key=None):
+        """
+        Accept a narrative into the index without checking it.
+        Args:
+            text: The narrative text
+            key: An identifier reported when a later narrative duplicates this one.
+                Defaults to the 0-based position of the narrative in the index
+        """
+        shingles = shingle_hashes(text, self.shingle_size)
+        self._add(shingles, self._band_keys(self._signature(shingles)), key)
+
+    def _add(self, shingles, band_keys, key):
+        key = len(self.shingles) if key is None else key
+        self.shingles[key] = shingles
+        for bucket, band_key in zip(self.buckets, band_keys):
+            bucket.setdefault(band_key, []).append(key)
+
+    def check_and_add(self, text: str, key=None):
+        """
+        Accept a narrative unless it is a near duplicate of an accepted one.
+        Checking and adding happen in one step, so two concurrent workers cannot both
+        accept the same narrative.
+        Args:
+            text: The narrative text
+            key: The identifier of the narrative, see add
+        Raises:
+            NearDuplicateError: If the narrative's Jaccard similarity to an accepted
+                narrative is above the threshold. The narrative is not added
+        """
+        shingles = shingle_hashes(text, self.shingle_size)
+        band_keys = self._band_keys(self._signature(shingles))
+        similarity, duplicate_of = self._most_similar(shingles, band_keys)
+        if similarity > self.threshold:
+            self.rejected += 1
+            raise NearDuplicateError(similarity, duplicate_of)
+        self._add(shingles, band_keys, key)
@@ -8,9 +8,27 @@ import sys
 
 from api_key import anthropic_key
 
+# The response cache lives in the repository root, one level above old_code
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from response_cache import ResponseCache, make_cache_key
+from llm_backends import AnthropicBackend
+from name_sampler import NameSampler
+
 # Initialize the Anthropic client with the API key 
 client = anthropic.Client(api_key=anthropic_key)
 
+# Narrative generation and editing go through an LLM backend. To use a local model,
+# replace this with e.g. OpenAICompatibleBackend("http://localhost:8080")
+backend = AnthropicBackend(client)
+
+# Set USE_RESPONSE_CACHE to True to replay identical requests from the on-disk
+# response cache. Leave it off for sampling reruns that should draw new responses
+USE_RESPONSE_CACHE = False
+response_cache = ResponseCache() if USE_RESPONSE_CACHE else None
+
+# Patient names are sampled locally from name frequency tables
+name_sampler = NameSampler()
+
 # Copy paste patient data csv title into the variable patient_csv
 patient_csv = "stratified_patient_data_20250213_150823"
 # patient_csv is used to determine file path
@@ -25,54 +43,18 @@ def print_with_border(text: str, width: int = 80) -> None:
     print(text)
     print("="*width + "\n")
 
-def generate_patient_name(patient_data: Dict[str, Any], existing_names: Set[str], max_retries: int = 3) -> Dict[str, str]:
-    """Generate a unique, culturally appropriate name based on patient demographics."""
+def generate_patient_name(patient_data: Dict[str, Any], existing_names: Set[str]) -> Dict[str, str]:
+    """Sample a unique, culturally appropriate name offline from the name frequency tables."""
     print_with_border(f"Generating name for patient with race: {patient_data['race']}, age_group: {patient_data['age_group']}")
-    
-    for attempt in range(max_retries):
-        try:
-            message = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=50,
-                temperature=0.7,
-                system=f"""
-                You are an AI assistant helping generate culturally appropriate names for a 
-                medical study. Generate a full name (first and last) that would be typical 
-                for someone of the specified race, age, and gender. The name must NOT be one
-                of these existing names: {', '.join(existing_names)}. Return the result as a 
-                JSON object with 'first_name' and 'last_name' fields. Only return the JSON,
-                no other text.
-                """,
-                messages=[{
-                    "role": "user",
-                    "content": [{
-                        "type": "text",
-                        "text": f"""Please generate a unique name given the following information:
-                        Race: {patient_data['race']}
-                        Age Group: {patient_data['age_group']}"""
-                    }]
-                }])
-            
-            print("Generated name: ", end="", flush=True)
-            response_text = message.content[0].text
-            print(response_text)
-            
-            name_data = json.loads(response_text)
-            full_name = f"{name_data['first_name']} {name_data['last_name']}"
-            
-            # Check if the generated name is unique
-            if full_name not in existing_names:
-                existing_names.add(full_name)
-                return name_data
-            else:
-                print(f"Generated name '{full_name}' already exists. Retrying...")
-                continue
-            
-        except Exception as e:
-            print(f"Name generation attempt {attempt + 1} failed: {str(e)}. Retrying...")
-            continue
-            
-    raise ValueError("Failed to generate a unique name after multiple attempts.")
+
+    # The sampler draws by race, gender and age group and checks uniqueness on normalized
+    # names with a set lookup, so no API call is needed and no name list grows in a prompt.
+    # The gender comes from the patient row, so the first name always matches it
+    name_data = name_sampler.sample(patient_data['race'], patient_data['gender'], patient_data['age_group'])
+    full_name = f"{name_data['first_name']} {name_data['last_name']}"
+    existing_names.add(full_name)
+    print(f"Generated name: {full_name}")
+    return name_data
 
 def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives: List[str], max_retries: int = 3) -> str:
     """Generate a unique narrative for the patient using their information."""
@@ -91,11 +73,10 @@ def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives
             temperature = .8
             print(f"Using temperature: {temperature}")
 
-            message = client.messages.create(
+            request = dict(
                 model="claude-3-5-sonnet-20241022",
                 max_tokens=500,
                 temperature=temperature,
-                stream=True,
                 system=f"""
                 You are an AI assistant helping with a psychological study that analyzes 
                 the moral convictions of medical professionals confronted with the 
@@ -146,14 +127,15 @@ def generate_patient_narrative(patient_data: Dict[str, Any], existing_narratives
                         Mortality: {patient_data['mortality']}"""
                     }]
                 }])
-            
+
+            stream = backend.stream(request)
+
             print("\nGenerating narrative: ")
             response_text = ""
-            for chunk in message:
-                if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
-                    sys.stdout.write(chunk.delta.text)
-                    sys.stdout.flush()
-                    response_text += chunk.delta.text
+            for text in stream:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+                response_text += text
             print("\n")
             
             json_data = json.loads(response_text)
@@ -183,11 +165,10 @@ def patient_narrative_editor(narrative_data, patient_data: Dict[str, Any], exist
             temperature = .8
             print(f"Using temperature: {temperature}")
 
-            message = client.messages.create(
+            request = dict(
                 model="claude-3-5-sonnet-20241022",
                 max_tokens=500,
                 temperature=temperature,
-                stream=True,
                 system=f"""
                 You are an AI assistant helping with a psychological study that analyzes 
                 the moral convictions of medical professionals confronted with the 
@@ -247,17 +228,29 @@ def patient_narrative_editor(narrative_data, patient_data: Dict[str, Any], exist
                         Mortality: {patient_data['mortality']}"""
                     }]
                 }])
-            
-            print("\nGenerating narrative: ")
-            response_text = ""
-            for chunk in message:
-                if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
-                    sys.stdout.write(chunk.delta.text)
+
+            # Replay the stored edit of an identical request when the response cache is enabled
+            cache_key = make_cache_key(request) if response_cache is not None else None
+            response_text = response_cache.get(cache_key) if cache_key else None
+            from_cache = response_text is not None
+            if from_cache:
+                print("\nUsing cached edit: ")
+                print(response_text)
+            else:
+                stream = backend.stream(request)
+
+                print("\nGenerating narrative: ")
+                response_text = ""
+                for text in stream:
+                    sys.stdout.write(text)
                     sys.stdout.flush()
-                    response_text += chunk.delta.text
-            print("\n")
+                    response_text += text
+                print("\n")
             
             json_data = json.loads(response_text)
+            # Only responses that parse are cached, so a replayed edit never needs a retry
+            if cache_key and not from_cache:
+                response_cache.put(cache_key, response_text)
             json_data["temperature"] = temperature
             return json.dumps(json_data)
         except Exception as e:
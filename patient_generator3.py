@@ -1,10 +1,26 @@
 import csv
+import json
 import random
+import secrets
 from datetime import datetime
 import os
 import math
+import bisect
+import hashlib
 from itertools import product
 
+# NumPy is only needed for the columnar backend used for large designs
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from patient_tables import FILE_EXTENSIONS, CodedColumnWriter, file_format_from_path, write_coded_columns, write_patient_rows
+from design_verifier import StratificationCounter, print_stratification_report
+from design_engine import DesignConfig, DesignPlan, load_design_config
+from external_shuffle import ExternalShuffler, BUCKET_ROWS
+from patient_records import save_csv_row_count
+
 # We start by defining the characteristics of the patients we want to generate.
 # Race is nested within a dictionary so that we can have both the race as the key
 # and the distribution as a value. This allows us to easily adjust the proportions
@@ -24,6 +40,64 @@ CHARACTERISTICS = {
     'pain_intensity': ['moderate', 'high'],
 }
 
+# An optional JSON design config (see design_engine.load_design_config) that replaces
+# CHARACTERISTICS, e.g. to add a third pain level or another factor.
+# design_config.json holds the default design to start from
+DESIGN_CONFIG_PATH = None
+
+# How a requested number of patients is allocated to cells when CHARACTERISTICS is used:
+# "exact" uses every requested patient, "complete" only complete sets of combinations
+ALLOCATION = "exact"
+
+# The design config, loaded once by get_design_config
+design_config = None
+
+def get_design_config():
+    """
+    Return the DesignConfig of our designs, from DESIGN_CONFIG_PATH if it is set and from
+    CHARACTERISTICS otherwise.
+    """
+    global design_config
+    if design_config is None:
+        if DESIGN_CONFIG_PATH:
+            design_config = load_design_config(DESIGN_CONFIG_PATH)
+        else:
+            design_config = DesignConfig(CHARACTERISTICS, ALLOCATION)
+    return design_config
+
+def plan_design(total_patients):
+    """
+    Allocate a requested number of patients to the strata and cells of the design.
+    Args:
+        total_patients: integer indicating number of patients to generate
+    Returns:
+        A DesignPlan, whose report() lists the allocation and the discarded rows
+    """
+    return DesignPlan(get_design_config(), total_patients)
+
+def new_design_seed():
+    """
+    Draw a fresh random seed for a design. Designs are always generated from a concrete
+    seed, which is recorded with the output, so even unseeded runs can be reproduced.
+    """
+    return secrets.randbits(63)
+
+def spawn_seed(seed, *key):
+    """
+    Derive an independent seed from a design seed for one random stream, e.g. one race
+    group, the final shuffle or one shard.
+    Every stream is a hash of the design seed and its key, so it can be created on any core
+    or machine without coordination, in any order, and never overlaps with another stream
+    the way consecutive draws from one shared generator would.
+    Args:
+        seed: the design seed
+        key: the name of the stream, e.g. ('race', 'Black')
+    Returns:
+        A 64-bit integer seed.
+    """
+    name = ":".join(str(part) for part in (seed,) + key)
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little')
+
 def calculate_group_sizes(total_patients):
     """
     Calculate the number of patients for each racial group. Groups are defined by race
@@ -32,42 +106,26 @@ def calculate_group_sizes(total_patients):
     Args:
         total_patients: integer indicating number of patients to generate
     Returns:
-        group_sizes: integer indicating size of group given relative to num. of patients
+        group_sizes: dictionary mapping each race to the size of its group
     """
-    # We start by initializing an empty dictionary to hold the sizes of each group.
-    group_sizes = {}
-    
-    # Because we have 4 racial groups, and for each racial group there are 2 genders
-    # we need to set a base size for each racial group that is divisible by 8 
-    # We start a for loop to iterate through each racial group and its proportion
-    # in the CHARACTERISTICS dictionary
-    for race, proportion in CHARACTERISTICS['race']['distribution'].items():
-        # We calculate the base size for each racial group by multiplying the total number
-        # of patients by the proportion of that racial group
-        # We use math.floor to ensure that we round down to the nearest whole number
-        base_size = math.floor(total_patients * proportion)
-        # We then round the base size to the nearest multiple of 8
-        size = (base_size // 8) * 8
-        if size == 0:  # Ensure at least 8 patients per race
-            size = 8
-        group_sizes[race] = size
-    
-    return group_sizes
+    # The design engine splits the patients over the races by the largest-remainder rule,
+    # for any number of factors and levels
+    return plan_design(total_patients).stratum_sizes
 
-def generate_perfectly_stratified_group(size):
+def generate_perfectly_stratified_group(size, extra_cells=None):
     """
     Generate a perfectly stratified group of patients.
     Args:
         size: integer indicating the number of patients to generate for this group
+        extra_cells: optional list of combination indices that get one more patient on
+            top of the complete sets, see design_engine.DesignPlan
     Returns:
         patients: list of dictionaries, each representing a patient with stratified characteristics
     """
-    # Get all possible combinations
-    combinations = list(product(
-        CHARACTERISTICS['gender'],
-        CHARACTERISTICS['age_group'],
-        CHARACTERISTICS['pain_intensity']
-    ))
+    # Get all possible combinations of the factors crossed within the group
+    crossed = get_design_config().crossed
+    combinations = list(product(*(levels for _, levels in crossed)))
+    fields = [field for field, _ in crossed]
     
     # Calculate how many complete sets we need
     sets_needed = size // len(combinations)
@@ -77,107 +135,605 @@ def generate_perfectly_stratified_group(size):
     # We then iterate through the number of sets needed, and for each set, we create
     for _ in range(sets_needed):
         # For each combination of characteristics, we create a patient dictionary
-        for gender, age_group, pain_intensity in combinations:
-            # Create a patient dictionary with the current combination of characteristics
-            patient = {
-                'gender': gender,
-                'age_group': age_group,
-                'pain_intensity': pain_intensity,
-            }
-            patients.append(patient)
+        for combination in combinations:
+            patients.append(dict(zip(fields, combination)))
+
+    # Leftover patients of an exact allocation each go to a different combination
+    for cell in extra_cells or []:
+        patients.append(dict(zip(fields, combinations[cell])))
     
     return patients
 
-def generate_stratified_patients(num_patients):
+def generate_stratified_patients(num_patients, seed=None):
     """
     Generate stratified patient data ensuring perfect distribution of characteristics.
     Args:
         num_patients: integer indicating the total number of patients to generate
+        seed: seed of the design. Each racial group is shuffled with its own spawned stream,
+            so the same seed always gives the same design. Defaults to a fresh random seed
     Returns:
         all_patients: list of dictionaries, each representing a patient with stratified characteristics
     """
     
-    # First, we calculate the sizes of each racial group based on the total number of patients
-    group_sizes = calculate_group_sizes(num_patients)
+    if seed is None:
+        seed = new_design_seed()
+
+    # First, we plan the sizes of each racial group based on the total number of patients
+    plan = plan_design(num_patients)
+    stratum_field = plan.config.stratum_field
     # We initialize an empty list to hold all patients
     all_patients = []
     
     # We then iterate through each racial group and its size
     # For each racial group, we generate a perfectly stratified group of patients
-    for race, size in group_sizes.items():
+    for race_index, (race, size) in enumerate(plan.stratum_sizes.items()):
         # Generate perfectly stratified group
-        race_patients = generate_perfectly_stratified_group(size)
+        race_patients = generate_perfectly_stratified_group(size, plan.extra_cells[race_index])
         
-        # Add race to each patient
-        for patient in race_patients:
-            patient['race'] = race
+        # Add race to each patient, as the first column
+        race_patients = [{stratum_field: race, **patient} for patient in race_patients]
         
-        # Shuffle the patients for this racial group
-        random.shuffle(race_patients)
+        # Shuffle the patients for this racial group with its own stream
+        random.Random(spawn_seed(seed, 'group', race)).shuffle(race_patients)
         all_patients.extend(race_patients)
     
     # Shuffle all patients while maintaining stratification
-    random.shuffle(all_patients)
+    random.Random(spawn_seed(seed, 'shuffle')).shuffle(all_patients)
     
     return all_patients
 
-def save_patients_to_csv(patients, output_dir="patient_data"):
+# Designs of at least this many patients are generated with the columnar NumPy backend
+LARGE_DESIGN_SIZE = 100_000
+
+# Designs of at least this many patients are shuffled out of core, through spill buckets
+# on disk, so their size is bounded by the disk instead of memory
+OUT_OF_CORE_DESIGN_SIZE = 50_000_000
+
+# The format designs are saved in: "csv", or "parquet" / "arrow" for dictionary-encoded
+# columns that are several times smaller and load column by column (needs pyarrow)
+OUTPUT_FORMAT = "csv"
+
+def get_cell_levels():
     """
-    Save the generated patient data to a CSV file.
+    List the levels of every factor in the order of the cell codes of the columnar backend.
+    Returns:
+        A list of (field name, levels) tuples: race first, then the factors that are
+        stratified within each race, in the order generate_perfectly_stratified_group uses.
+    """
+    return get_design_config().levels()
+
+def get_fieldnames():
+    """
+    List the columns of the patient files of the current design.
+    """
+    return [field for field, _ in get_cell_levels()]
+
+def cell_dtype(num_cells):
+    """
+    The smallest unsigned NumPy integer type that holds num_cells cell codes.
+    """
+    return np.uint8 if num_cells <= 256 else np.uint16 if num_cells <= 65536 else np.uint32
+
+def generate_stratified_cells(num_patients, seed=None):
+    """
+    Generate a stratified patient design as an array of cell codes (columnar backend).
+
+    Instead of a dictionary per patient, every patient is a single code for its
+    combination of race, gender, age group and pain intensity, so a design takes one byte
+    per patient (two for designs with more than 256 cells). Both backends follow the same
+    DesignPlan, so they have identical cell counts.
     Args:
-        patients: list of dictionaries, each representing a patient with stratified characteristics
-        output_dir: directory where the CSV file will be saved
+        num_patients: integer indicating the total number of patients to generate
+        seed: seed of the design, see generate_stratified_patients. Defaults to a fresh random seed
     Returns:
-        filepath: string indicating the path to the saved CSV file
+        cells: NumPy unsigned integer array with one cell code per patient, in random order.
+        Use decode_cells, cells_to_patients or save_cells_to_csv to read it.
+    """
+    if np is None:
+        raise ImportError("The columnar backend requires NumPy (pip install numpy)")
+
+    plan = plan_design(num_patients)
+    combinations_per_race = plan.config.cells_per_stratum
+    dtype = cell_dtype(len(plan.stratum_sizes) * combinations_per_race)
+
+    # Every race is its complete sets of within-race combinations, tiled, plus its
+    # leftover cells. Race r owns the codes r * combinations_per_race up to
+    # (r + 1) * combinations_per_race - 1
+    blocks = []
+    for race_index, (sets_needed, extra_cells) in enumerate(zip(plan.full_sets, plan.extra_cells)):
+        race_codes = np.arange(combinations_per_race, dtype=dtype) + race_index * combinations_per_race
+        blocks.append(np.tile(race_codes, sets_needed))
+        blocks.append(np.array(extra_cells, dtype=dtype) + race_index * combinations_per_race)
+    cells = np.concatenate(blocks)
+
+    # One in-place shuffle of the whole design. Shuffling within each race first, as the
+    # dictionary backend does, would not change the distribution of the result
+    if seed is None:
+        seed = new_design_seed()
+    np.random.default_rng(spawn_seed(seed, 'cells')).shuffle(cells)
+    return cells
+
+def iter_design_cells(plan, chunk_size=1_000_000):
+    """
+    Generate the cell codes of a planned design in stratum order, without shuffling.
+    Args:
+        plan: the DesignPlan of the design
+        chunk_size: the largest number of codes per array
+    Yields:
+        Arrays of cell codes, which together hold every cell exactly as often as the plan says.
+    """
+    combinations_per_race = plan.config.cells_per_stratum
+    dtype = cell_dtype(len(plan.stratum_sizes) * combinations_per_race)
+    for race_index, (sets_needed, extra_cells) in enumerate(zip(plan.full_sets, plan.extra_cells)):
+        first_code = race_index * combinations_per_race
+        complete = sets_needed * combinations_per_race
+        for start in range(0, complete, chunk_size):
+            positions = np.arange(start, min(start + chunk_size, complete))
+            yield (positions % combinations_per_race + first_code).astype(dtype)
+        if extra_cells:
+            yield (np.array(extra_cells) + first_code).astype(dtype)
+
+def decode_cells(cells):
+    """
+    Split cell codes into one code array per factor.
+    Args:
+        cells: array of cell codes from generate_stratified_cells
+    Returns:
+        Dictionary mapping each field name to a (codes, levels) tuple, where codes indexes levels.
+    """
+    columns = {}
+    remaining = cells
+    # The last factor varies fastest, like itertools.product
+    for field, values in reversed(get_cell_levels()):
+        columns[field] = ((remaining % len(values)).astype(np.uint8), values)
+        remaining = remaining // len(values)
+    return {field: columns[field] for field, _ in get_cell_levels()}
+
+def cell_rows():
+    """
+    Return the patient row of every cell code, as a list indexed by code.
+    """
+    return [dict(zip(get_fieldnames(), values)) for values in product(*(values for _, values in get_cell_levels()))]
+
+def cells_to_patients(cells, chunk_size=100_000):
+    """
+    Turn cell codes into patient dictionaries, one at a time.
+    Args:
+        cells: array of cell codes from generate_stratified_cells
+        chunk_size: number of codes converted per step
+    Yields:
+        A new patient dictionary for each cell code, in design order.
+    """
+    rows = cell_rows()
+    for start in range(0, len(cells), chunk_size):
+        for code in cells[start:start + chunk_size].tolist():
+            yield dict(rows[code])
+
+def design_metadata(num_patients, seed, backend, shard_index=None, num_shards=None):
+    """
+    Describe how a design was generated, so it can be regenerated instead of stored.
+    Args:
+        num_patients: integer indicating the total number of patients requested
+        seed: the design seed
+        backend: "patients" (generate_stratified_patients), "cells" (generate_stratified_cells),
+            "lazy" (StratifiedDesign) or "spill" (shuffle_design_to_file), since each orders
+            the same seed differently
+        shard_index, num_shards: the shard of a StratifiedDesign the file holds, if any
+    Returns:
+        A dictionary that save functions record next to the file, see regenerate_design.
+    """
+    config = get_design_config()
+    metadata = {
+        'num_patients': num_patients,
+        'seed': seed,
+        'backend': backend,
+        'allocation': config.allocation,
+        'factors': config.levels(),
+        'proportions': config.proportions,
+    }
+    if num_shards is not None:
+        metadata['shard_index'] = shard_index
+        metadata['num_shards'] = num_shards
+    return metadata
+
+def design_filepath(output_dir, extension, metadata=None):
+    """
+    Build a unique, timestamped path for a design file, creating output_dir if needed.
+    The seed and shard of the design, if known, are part of the file name.
     """
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
     # We also create a timestamp for the filename to ensure uniqueness
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    # We then create the filepath for the CSV file
-    filepath = os.path.join(output_dir, f"stratified_patient_data_{timestamp}.csv")
+    suffix = ""
+    if metadata is not None:
+        suffix = f"_seed{metadata['seed']}"
+        if 'num_shards' in metadata:
+            suffix += f"_shard{metadata['shard_index']}of{metadata['num_shards']}"
+    return os.path.join(output_dir, f"stratified_patient_data_{timestamp}{suffix}{extension}")
+
+def save_design_metadata(filepath, metadata):
+    """
+    Write the metadata of a design next to its file, as <file name>.meta.json, together
+    with the format of the file, so the design is regenerated in the same format.
+    """
+    if metadata is None:
+        return
+    metadata = {**metadata, 'file_format': file_format_from_path(filepath)}
+    with open(os.path.splitext(filepath)[0] + ".meta.json", 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+
+def save_cells_to_csv(cells, output_dir="patient_data", chunk_size=1_000_000, metadata=None):
+    """
+    Save a columnar design to a CSV file in the same format as save_patients_to_csv.
+    Args:
+        cells: array of cell codes from generate_stratified_cells
+        output_dir: directory where the CSV file will be saved
+        chunk_size: number of rows formatted and written per step
+        metadata: optional design_metadata, recorded in the file name and next to the file
+    Returns:
+        filepath: string indicating the path to the saved CSV file
+    """
+    filepath = design_filepath(output_dir, ".csv", metadata)
+    save_design_metadata(filepath, metadata)
+
+    # There are only as many distinct rows as cells, so we format each one once
+    # and write the design by looking the lines up
+    fieldnames = get_fieldnames()
+    lines = [",".join(row[field] for field in fieldnames) + "\r\n" for row in cell_rows()]
+    with open(filepath, 'w', newline='') as csvfile:
+        csvfile.write(",".join(fieldnames) + "\r\n")
+        for start in range(0, len(cells), chunk_size):
+            csvfile.write("".join([lines[code] for code in cells[start:start + chunk_size].tolist()]))
+    # The narrative generators read the row count from here instead of counting the rows
+    save_csv_row_count(filepath, len(cells))
+
+    return filepath
+
+def save_cells_to_file(cells, output_dir="patient_data", file_format=OUTPUT_FORMAT, metadata=None):
+    """
+    Save a columnar design in the given format.
+    Parquet and Arrow files store the cell codes as dictionary-encoded columns directly.
+    Args:
+        cells: array of cell codes from generate_stratified_cells
+        output_dir: directory where the file will be saved
+        file_format: "csv", "parquet" or "arrow"
+        metadata: optional design_metadata, recorded in the file name and next to the file
+    Returns:
+        filepath: string indicating the path to the saved file
+    """
+    if file_format == "csv":
+        return save_cells_to_csv(cells, output_dir, metadata=metadata)
+    filepath = design_filepath(output_dir, FILE_EXTENSIONS[file_format], metadata)
+    save_design_metadata(filepath, metadata)
+    write_coded_columns(decode_cells(cells), filepath, file_format)
+    return filepath
+
+def shuffle_design_to_file(num_patients, seed=None, output_dir="patient_data", file_format=OUTPUT_FORMAT,
+                           bucket_rows=BUCKET_ROWS, spill_dir=None):
+    """
+    Generate, shuffle and save a design that may be larger than memory (out-of-core backend).
+
+    The cell codes are generated chunk by chunk and spilled to randomly assigned buckets on
+    disk. The buckets are then shuffled one at a time and streamed to the output file, so
+    peak memory is about one bucket no matter how large the design is. The cell counts are
+    exactly those of the plan, as with the other backends.
+    Args:
+        num_patients: integer indicating the total number of patients to generate
+        seed: seed of the design. Defaults to a fresh random seed
+        output_dir: directory where the file will be saved
+        file_format: "csv", "parquet" or "arrow"
+        bucket_rows: average number of patients per spill bucket, which bounds memory
+        spill_dir: directory for the spill files, which need as much room as the design's
+            codes. Defaults to the system temporary directory
+    Returns:
+        A tuple of the path of the saved file and the StratificationCounter of the design,
+        counted while it was written.
+    """
+    if np is None:
+        raise ImportError("The out-of-core backend requires NumPy (pip install numpy)")
+    if seed is None:
+        seed = new_design_seed()
+
+    plan = plan_design(num_patients)
+    metadata = design_metadata(num_patients, seed, 'spill')
+    metadata['bucket_rows'] = bucket_rows
+    filepath = design_filepath(output_dir, FILE_EXTENSIONS[file_format], metadata)
+    counter = make_stratification_counter()
+    dtype = cell_dtype(len(plan.stratum_sizes) * plan.config.cells_per_stratum)
+
+    with ExternalShuffler(plan.total, dtype, spawn_seed(seed, 'spill'), bucket_rows, spill_dir) as shuffler:
+        for chunk in iter_design_cells(plan):
+            shuffler.add(chunk)
+
+        if file_format == "csv":
+            # As in save_cells_to_csv, every distinct row is formatted once
+            fieldnames = get_fieldnames()
+            lines = [",".join(row[field] for field in fieldnames) + "\r\n" for row in cell_rows()]
+            with open(filepath, 'w', newline='') as csvfile:
+                csvfile.write(",".join(fieldnames) + "\r\n")
+                for bucket in shuffler.shuffled_chunks():
+                    counter.update_cells(bucket)
+                    for start in range(0, len(bucket), 1_000_000):
+                        csvfile.write("".join([lines[code] for code in bucket[start:start + 1_000_000].tolist()]))
+            save_csv_row_count(filepath, plan.total)
+        else:
+            writer = CodedColumnWriter(filepath, get_cell_levels(), file_format)
+            try:
+                for bucket in shuffler.shuffled_chunks():
+                    counter.update_cells(bucket)
+                    writer.write({field: codes for field, (codes, _) in decode_cells(bucket).items()})
+            finally:
+                writer.close()
+
+    save_design_metadata(filepath, metadata)
+    return filepath, counter
+
+def verify_cell_stratification(cells):
+    """
+    Verify that the stratification of a columnar design is perfect within each racial group.
+    The cell codes are counted with a single vectorized bincount.
+    Args:
+        cells: array of cell codes from generate_stratified_cells
+    Returns:
+        The StratificationCounter of the design, which also holds every marginal count
+    """
+    counter = make_stratification_counter()
+    counter.update_cells(cells)
+    print_stratification_report(counter, get_design_config().stratum_field)
+    return counter
+
+MASK_64_BITS = (1 << 64) - 1
+
+class FeistelPermutation:
+    """
+    A seeded pseudo-random permutation of the integers 0 to size - 1, computed one index
+    at a time with a Feistel network. Nothing is stored, so any position can be mapped in
+    O(1) memory, and everyone who uses the same seed gets the same permutation.
+    """
+
+    def __init__(self, size, seed=0, rounds=6):
+        """
+        Args:
+            size: number of integers to permute
+            seed: seed of the round keys
+            rounds: number of Feistel rounds
+        """
+        self.size = size
+        # One 64-bit key per round, derived from the seed
+        self.round_keys = [
+            int.from_bytes(hashlib.blake2b(f"{seed}:{round_index}".encode('utf-8'), digest_size=8).digest(), 'little')
+            for round_index in range(rounds)
+        ]
+        # The network permutes a domain of 2 * half_bits bits, the smallest one that covers size
+        self.half_bits = max(1, (max(size - 1, 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+
+    def _encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_key in self.round_keys:
+            # The round function is the splitmix64 finalizer of the keyed half, which mixes
+            # every input bit into the output and is much cheaper than a cryptographic hash
+            z = ((right ^ round_key) * 0x9E3779B97F4A7C15) & MASK_64_BITS
+            z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64_BITS
+            z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK_64_BITS
+            left, right = right, left ^ ((z ^ (z >> 31)) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __call__(self, index):
+        """
+        Return the position index is mapped to.
+        """
+        # Cycle walking: the network permutes a domain of up to four times the size, so we
+        # re-encrypt until the value falls inside it. This keeps the result a permutation
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+class StratifiedDesign:
+    """
+    A lazy, random-access view of a stratified patient design.
+
+    Every patient of a stratified design is determined by its position: the race follows
+    from the group sizes and the other characteristics from the position within the race,
+    which indexes the race's complete sets of combinations and then its leftover cells
+    (see design_engine.DesignPlan). A seeded permutation
+    shuffles the positions. So patient i can be computed on its own, and workers on
+    different machines can each generate their own slice of the same design without storing
+    or exchanging it. The cell counts are the same as those of generate_stratified_patients.
+
+    Supports len(design), design[i], design[start:stop], iteration and iter_chunks.
+    """
+
+    def __init__(self, num_patients, seed=None):
+        """
+        Args:
+            num_patients: integer indicating the total number of patients requested
+            seed: seed of the permutation. The same seed always gives the same design.
+                Defaults to a fresh random seed, which is kept in self.seed
+        """
+        if seed is None:
+            seed = new_design_seed()
+        self.seed = seed
+        self.levels = get_cell_levels()
+        self.combinations = list(product(*(values for _, values in self.levels[1:])))
+        self.plan = plan_design(num_patients)
+        self.group_sizes = self.plan.stratum_sizes
+        sizes = list(self.group_sizes.values())
+        self.races = list(self.group_sizes.keys())
+        self.race_starts = [sum(sizes[:i]) for i in range(len(sizes))]
+        self.size = sum(sizes)
+        self.permutation = FeistelPermutation(self.size, seed)
+
+    def __len__(self):
+        return self.size
+
+    def _patient_at_position(self, position):
+        race_index = bisect.bisect_right(self.race_starts, position) - 1
+        within_race = position - self.race_starts[race_index]
+        complete = self.plan.full_sets[race_index] * len(self.combinations)
+        if within_race < complete:
+            combination = self.combinations[within_race % len(self.combinations)]
+        else:
+            combination = self.combinations[self.plan.extra_cells[race_index][within_race - complete]]
+        patient = {self.levels[0][0]: self.races[race_index]}
+        patient.update(zip((field for field, _ in self.levels[1:]), combination))
+        return patient
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("design index out of range")
+        return self._patient_at_position(self.permutation(index))
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def iter_chunks(self, chunk_size=10_000, start=0, stop=None):
+        """
+        Generate the patients from start to stop in lists of chunk_size.
+        Args:
+            chunk_size: number of patients per list
+            start: first index to generate
+            stop: index to stop before, defaults to the end of the design
+        Yields:
+            Lists of patient dictionaries, in design order.
+        """
+        stop = self.size if stop is None else min(stop, self.size)
+        for chunk_start in range(start, stop, chunk_size):
+            yield self[chunk_start:min(chunk_start + chunk_size, stop)]
+
+    def shard(self, shard_index, num_shards):
+        """
+        Return the index range one of num_shards workers is responsible for.
+        The ranges of all shards are contiguous, disjoint and together cover the design.
+        """
+        return range(self.size * shard_index // num_shards, self.size * (shard_index + 1) // num_shards)
+
+def generate_design_shard(num_patients, seed, shard_index, num_shards):
+    """
+    Generate one shard of a lazy StratifiedDesign.
+    Every shard can be generated on its own core or machine: the shards of the same seed
+    are disjoint, together form the whole design, and come out identical on every run.
+    Args:
+        num_patients: integer indicating the total number of patients of the whole design
+        seed: the design seed
+        shard_index: the shard to generate, from 0 to num_shards - 1
+        num_shards: the number of shards the design is split into
+    Returns:
+        A list of patient dictionaries.
+    """
+    design = StratifiedDesign(num_patients, seed)
+    shard = design.shard(shard_index, num_shards)
+    return design[shard.start:shard.stop]
+
+def regenerate_design(metadata_path):
+    """
+    Regenerate a saved design from its .meta.json file instead of reading the design.
+    Args:
+        metadata_path: the path of the metadata written next to a design file
+    Returns:
+        A list of patient dictionaries for the "patients" and "lazy" backends (the shard
+        only, for sharded designs), an array of cell codes for the "cells" backend, or the
+        path of a rewritten file for the out-of-core "spill" backend.
+    Raises:
+        ValueError: if the design was generated with other factors or allocation
+    """
+    with open(metadata_path, 'r') as metadata_file:
+        metadata = json.load(metadata_file)
+    config = get_design_config()
+    recorded = [(field, levels) for field, levels in metadata['factors']]
+    if recorded != config.levels() or metadata['proportions'] != config.proportions or metadata['allocation'] != config.allocation:
+        raise ValueError(f"{metadata_path} was generated with another design config")
+    num_patients, seed = metadata['num_patients'], metadata['seed']
+    if metadata['backend'] == 'cells':
+        return generate_stratified_cells(num_patients, seed)
+    if metadata['backend'] == 'spill':
+        # The design does not fit in memory, so it is written to a new file next to the
+        # metadata, in the format it was saved in. Metadata written before the format was
+        # recorded falls back to OUTPUT_FORMAT
+        file_format = metadata.get('file_format', OUTPUT_FORMAT)
+        path, _ = shuffle_design_to_file(num_patients, seed, os.path.dirname(metadata_path) or ".", file_format, metadata['bucket_rows'])
+        return path
+    if metadata['backend'] == 'lazy':
+        if 'num_shards' in metadata:
+            return generate_design_shard(num_patients, seed, metadata['shard_index'], metadata['num_shards'])
+        return list(StratifiedDesign(num_patients, seed))
+    return generate_stratified_patients(num_patients, seed)
+
+def save_patients_to_csv(patients, output_dir="patient_data", metadata=None):
+    """
+    Save the generated patient data to a CSV file.
+    Args:
+        patients: list of dictionaries, each representing a patient with stratified characteristics
+        output_dir: directory where the CSV file will be saved
+        metadata: optional design_metadata, recorded in the file name and next to the file
+    Returns:
+        filepath: string indicating the path to the saved CSV file
+    """
+    # We create a timestamped filepath for the CSV file, with the seed of the design
+    filepath = design_filepath(output_dir, ".csv", metadata)
+    save_design_metadata(filepath, metadata)
     
     # We set the column names for the CSV file as the characteristics we want to include
-    fieldnames = ['race', 'gender', 'age_group', 'pain_intensity']
+    fieldnames = get_fieldnames()
     
     with open(filepath, 'w', newline='') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
         writer.writerows(patients)
+    save_csv_row_count(filepath, len(patients))
     
     return filepath
 
+def save_patients_to_file(patients, output_dir="patient_data", file_format=OUTPUT_FORMAT, metadata=None):
+    """
+    Save the generated patient data in the given format.
+    Args:
+        patients: list of patient dictionaries, or a StratifiedDesign
+        output_dir: directory where the file will be saved
+        file_format: "csv", "parquet" or "arrow"
+        metadata: optional design_metadata, recorded in the file name and next to the file
+    Returns:
+        filepath: string indicating the path to the saved file
+    """
+    if file_format == "csv":
+        return save_patients_to_csv(patients, output_dir, metadata)
+    filepath = design_filepath(output_dir, FILE_EXTENSIONS[file_format], metadata)
+    save_design_metadata(filepath, metadata)
+    write_patient_rows(patients, filepath, get_cell_levels(), file_format)
+    return filepath
+
+def make_stratification_counter():
+    """
+    Create an empty StratificationCounter for the factors of our designs, expecting the
+    race proportions of the design config.
+    """
+    config = get_design_config()
+    return StratificationCounter(
+        config.levels(),
+        expected={config.stratum_field: list(config.proportions.values())},
+    )
+
 def verify_stratification(patients):
     """
     Verify that the stratification is perfect within each racial group.
+    The patients are counted in a single pass, so any iterable works, including a
+    StratifiedDesign or a csv.DictReader.
     Args:
-        patients: list of dictionaries, each representing a patient with stratified characteristics
+        patients: iterable of dictionaries, each representing a patient with stratified characteristics
     Returns:
-        Print verification results for each racial group
+        The StratificationCounter of the design, which also holds every marginal count
     """
-    for race in CHARACTERISTICS['race']['distribution'].keys():
-        race_patients = [p for p in patients if p['race'] == race]
-        if not race_patients:
-            continue
-            
-        print(f"\nVerification for {race} group ({len(race_patients)} patients):")
-        
-        # Count combinations
-        combinations = {}
-        for patient in race_patients:
-            key = (patient['gender'], patient['age_group'], patient['pain_intensity'])
-            combinations[key] = combinations.get(key, 0) + 1
-        
-        # Check if all combinations have the same count
-        counts = list(combinations.values())
-        if len(counts) > 0:
-            expected = len(race_patients) // 8  # 8 possible combinations
-            is_perfect = all(count == expected for count in counts)
-            print(f"Perfect stratification: {'Yes' if is_perfect else 'No'}")
-            
-            # Print detailed distribution
-            for (gender, age_group, pain_intensity), count in sorted(combinations.items()):
-                print(f"  {gender}, {age_group}, {pain_intensity} ({count/len(race_patients)*100:.1f}%)")
+    counter = make_stratification_counter()
+    counter.update_rows(patients)
+    print_stratification_report(counter, get_design_config().stratum_field)
+    return counter
 
 def main():
     while True:
@@ -186,28 +742,59 @@ def main():
             if num_patients <= 0:
                 print("Please enter a positive number.")
                 continue
-            if num_patients < 32:  # Minimum to ensure stratification (8 combinations × 4 races)
-                print("Please enter at least 32 patients to ensure proper stratification.")
+            # Minimum to ensure stratification: one complete set of combinations per stratum
+            minimum = get_design_config().cells_per_stratum * len(get_design_config().proportions)
+            if num_patients < minimum:
+                print(f"Please enter at least {minimum} patients to ensure proper stratification.")
                 continue
             break
         except ValueError:
             print("Please enter a valid number.")
+
+    while True:
+        seed_text = input("Enter a seed to reproduce a design (leave empty for a random seed): ").strip()
+        if not seed_text:
+            seed = new_design_seed()
+            break
+        try:
+            seed = int(seed_text)
+            break
+        except ValueError:
+            print("Please enter a whole number.")
+
+    # Report the allocation, and the rows it discards, before generating anything
+    plan = plan_design(num_patients)
+    print()
+    for line in plan.report():
+        print(line)
     
-    # Generate and save patients
-    patients = generate_stratified_patients(num_patients)
-    output_file = save_patients_to_csv(patients)
-    
-    # Print summary statistics
-    print(f"\nGenerated {len(patients)} patients and saved to {output_file}")
-    
-    # Verify and print stratification statistics
-    verify_stratification(patients)
-    
-    # Print overall racial distribution
+    # Designs too large for memory are shuffled through spill buckets on disk
+    if np is not None and num_patients >= OUT_OF_CORE_DESIGN_SIZE:
+        output_file, counter = shuffle_design_to_file(num_patients, seed)
+        print(f"\nGenerated {counter.total} patients with seed {seed} and saved to {output_file}")
+        print_stratification_report(counter, plan.config.stratum_field)
+    # Large designs are generated with the columnar backend, which needs a fraction of
+    # the time and memory of a dictionary per patient
+    elif np is not None and num_patients >= LARGE_DESIGN_SIZE:
+        cells = generate_stratified_cells(num_patients, seed)
+        output_file = save_cells_to_file(cells, metadata=design_metadata(num_patients, seed, 'cells'))
+        print(f"\nGenerated {len(cells)} patients with seed {seed} and saved to {output_file}")
+        counter = verify_cell_stratification(cells)
+    else:
+        # Generate and save patients
+        patients = generate_stratified_patients(num_patients, seed)
+        output_file = save_patients_to_file(patients, metadata=design_metadata(num_patients, seed, 'patients'))
+
+        # Print summary statistics
+        print(f"\nGenerated {len(patients)} patients with seed {seed} and saved to {output_file}")
+
+        # Verify and print stratification statistics
+        counter = verify_stratification(patients)
+
+    # Print overall racial distribution from the counts the verification already made
     print("\nOverall Racial Distribution:")
-    for race in CHARACTERISTICS['race']['distribution'].keys():
-        race_count = sum(1 for p in patients if p['race'] == race)
-        print(f"{race}: {race_count} patients ({race_count/len(patients)*100:.1f}%)")
+    for race, race_count in counter.marginal(plan.config.stratum_field).items():
+        print(f"{race}: {race_count} patients ({race_count/counter.total*100:.1f}%)")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
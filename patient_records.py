@@ -0,0 +1,244 @@
+import csv
+import json
+import os
+import sys
+from collections.abc import Mapping
+from typing import List
+
+from patient_tables import file_format_from_path
+
+# Parquet and Arrow IPC files need pyarrow. CSV files work without it
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# A column is interned only while it has at most this many distinct values. Patient
+# files hold a handful of levels per column; a column that goes past the limit is a
+# free-text or ID column, whose values are stored as they are from then on
+MAX_COLUMN_LEVELS = 1024
+
+class RecordSchema:
+    """
+    The columns of a patient file and the levels seen in each of them.
+
+    Every distinct value of a column is stored once, interned, and records refer to it by a
+    small integer code. Patient files hold a handful of levels per column ("middle aged",
+    "Hispanic", ...), so no matter how many rows are read, each level string exists once.
+    Columns with more than MAX_COLUMN_LEVELS distinct values stop growing the table: their
+    later values are kept in the records themselves, so free-text and ID columns do not
+    hold every value they ever had in memory.
+    """
+
+    __slots__ = ("fieldnames", "field_index", "levels", "codes", "max_levels")
+
+    def __init__(self, fieldnames: List[str], max_levels: int = MAX_COLUMN_LEVELS):
+        self.fieldnames = list(fieldnames)
+        self.field_index = {field: i for i, field in enumerate(self.fieldnames)}
+        self.max_levels = max_levels
+        # levels[i][code] is the value of code in column i, codes[i][value] its code.
+        # codes[i] is None once column i has gone past max_levels
+        self.levels = [[] for _ in self.fieldnames]
+        self.codes = [{} for _ in self.fieldnames]
+
+    def code(self, column: int, value: str):
+        """
+        Return the code of a value in a column, adding it as a new level if it is new.
+        In a column with too many levels, a new value is returned as a 1-tuple holding
+        the value itself instead.
+        """
+        codes = self.codes[column]
+        if codes is None:
+            return (value,)
+        code = codes.get(value)
+        if code is None:
+            if len(codes) >= self.max_levels:
+                # The levels already handed out stay valid, but the lookup table is dropped
+                self.codes[column] = None
+                return (value,)
+            code = codes[value] = len(self.levels[column])
+            self.levels[column].append(sys.intern(value) if isinstance(value, str) else value)
+        return code
+
+    def value(self, column: int, code):
+        """
+        Return the value of a code returned by code().
+        """
+        if type(code) is tuple:
+            return code[0]
+        return self.levels[column][code]
+
+    def record(self, values):
+        """
+        Build a PatientRecord from the values of a row, in column order.
+        """
+        return PatientRecord(self, tuple([self.code(i, value) for i, value in enumerate(values)]))
+
+class PatientRecord(Mapping):
+    """
+    A read-only patient row that stores one small integer code per column instead of a
+    dictionary of strings (or the value itself, in a column with too many levels). It behaves like the dictionaries csv.DictReader returns (get,
+    [], keys, items, dict(record), ...), so code written for dictionaries keeps working.
+    """
+
+    __slots__ = ("schema", "row_codes")
+
+    def __init__(self, schema: RecordSchema, row_codes: tuple):
+        self.schema = schema
+        self.row_codes = row_codes
+
+    def __getitem__(self, field):
+        column = self.schema.field_index[field]
+        return self.schema.value(column, self.row_codes[column])
+
+    def __iter__(self):
+        return iter(self.schema.fieldnames)
+
+    def __len__(self):
+        return len(self.schema.fieldnames)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def csv_row_count_path(path: str):
+    """
+    Return the path of the file the row count of a CSV file is cached in, <file name>.rows.json.
+    """
+    return os.path.splitext(path)[0] + ".rows.json"
+
+def _file_stamp(path: str):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def save_csv_row_count(path: str, num_rows: int):
+    """
+    Cache the number of data rows of a CSV file next to it, so that opening the file again
+    does not take a pass over it to count them. patient_generator3 saves the count of every
+    CSV file it writes; PatientRecordFile saves it the first time it counts a file.
+    Args:
+        path: The path of the CSV file, which has to be completely written
+        num_rows: The number of data rows in the file, without the header
+    """
+    # A missing cache only costs a count later on, so a read-only directory is fine
+    try:
+        with open(csv_row_count_path(path), "w") as count_file:
+            json.dump({**_file_stamp(path), "num_rows": num_rows}, count_file)
+    except OSError:
+        pass
+
+def read_csv_row_count(path: str):
+    """
+    Return the cached number of data rows of a CSV file, or None if there is no cached
+    count or the file has changed since it was counted.
+    """
+    try:
+        with open(csv_row_count_path(path)) as count_file:
+            cached = json.load(count_file)
+        if {key: cached.get(key) for key in ("size", "mtime_ns")} == _file_stamp(path):
+            return cached["num_rows"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+class PatientRecordFile:
+    """
+    A patient file read as a stream of PatientRecords.
+
+    Iterating reads the file again from the start, one row (CSV) or one record batch
+    (Parquet and Arrow) at a time, so the file is never held in memory as a whole. All
+    records of a file share one RecordSchema, and so the same interned level strings.
+    The row count of a CSV file is cached next to it (see save_csv_row_count), so it is
+    read at most once to be counted.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: The path of a CSV, Parquet or Arrow IPC patient file
+        Raises:
+            FileNotFoundError: If the file does not exist
+        """
+        self.path = path
+        self.file_format = file_format_from_path(path)
+        if self.file_format == "csv":
+            with open(path, "r", newline='') as csv_file:
+                self.fieldnames = next(csv.reader(csv_file), [])
+        elif pa is None:
+            raise ImportError("Parquet and Arrow files require pyarrow (pip install pyarrow)")
+        elif self.file_format == "parquet":
+            self.fieldnames = pq.ParquetFile(path).schema_arrow.names
+        else:
+            with pa.memory_map(path, "r") as source:
+                self.fieldnames = pa.ipc.open_file(source).schema.names
+        self.schema = RecordSchema(self.fieldnames)
+        self.num_rows = None
+
+    def __len__(self):
+        # Parquet and Arrow files know their row count from their metadata. A CSV file has
+        # to be read to count its rows unless its count is cached, so it is counted once
+        # and the count cached for the next time
+        if self.num_rows is None:
+            if self.file_format == "csv":
+                self.num_rows = read_csv_row_count(self.path)
+                if self.num_rows is None:
+                    with open(self.path, "r", newline='') as csv_file:
+                        self.num_rows = max(0, sum(1 for row in csv.reader(csv_file) if row) - 1)
+                    save_csv_row_count(self.path, self.num_rows)
+            elif self.file_format == "parquet":
+                self.num_rows = pq.ParquetFile(self.path).metadata.num_rows
+            else:
+                # Memory-mapped batches are not copied, so only their headers are read
+                with pa.memory_map(self.path, "r") as source:
+                    reader = pa.ipc.open_file(source)
+                    self.num_rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+        return self.num_rows
+
+    def __iter__(self):
+        if self.file_format == "csv":
+            yield from self._iter_csv()
+        elif self.file_format == "parquet":
+            yield from self._iter_batches(pq.ParquetFile(self.path).iter_batches())
+        else:
+            with pa.memory_map(self.path, "r") as source:
+                reader = pa.ipc.open_file(source)
+                yield from self._iter_batches(reader.get_batch(i) for i in range(reader.num_record_batches))
+
+    def _iter_csv(self):
+        schema = self.schema
+        with open(self.path, "r", newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            next(reader, None)
+            width = len(self.fieldnames)
+            num_rows = 0
+            for row in reader:
+                if not row:
+                    continue
+                # Short rows are padded like csv.DictReader pads them
+                if len(row) < width:
+                    row = row + [None] * (width - len(row))
+                num_rows += 1
+                yield schema.record(row[:width])
+        # A complete pass counts the rows as well, so len() afterwards reads nothing
+        if self.num_rows is None:
+            self.num_rows = num_rows
+            save_csv_row_count(self.path, num_rows)
+
+    def _iter_batches(self, batches):
+        schema = self.schema
+        for batch in batches:
+            columns = []
+            for column_index, column in enumerate(batch.columns):
+                if pa.types.is_dictionary(column.type):
+                    # Dictionary-encoded columns are translated code by code, without a
+                    # string per row
+                    lookup = [schema.code(column_index, value) for value in column.dictionary.to_pylist()]
+                    columns.append([
+                        schema.code(column_index, None) if code is None else lookup[code]
+                        for code in column.indices.to_pylist()
+                    ])
+                else:
+                    columns.append([schema.code(column_index, value) for value in column.to_pylist()])
+            for row_codes in zip(*columns):
+                yield PatientRecord(schema, row_codes)
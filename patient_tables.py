@@ -0,0 +1,211 @@
+import csv
+import os
+from typing import Dict, Any, Iterable, List, Tuple
+
+# Parquet and Arrow IPC support needs pyarrow. CSV files work without it
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# The file formats patient designs can be stored in
+PATIENT_FILE_FORMATS = ("csv", "parquet", "arrow")
+
+# The file extension of each format
+FILE_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+def file_format_from_path(path: str):
+    """
+    Tell the format of a patient file from its extension.
+    Args:
+        path: The path of the file
+    Returns:
+        "parquet" for .parquet files, "arrow" for .arrow, .feather and .ipc files and "csv" otherwise.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".parquet":
+        return "parquet"
+    if extension in (".arrow", ".feather", ".ipc"):
+        return "arrow"
+    return "csv"
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet and Arrow files require pyarrow (pip install pyarrow)")
+
+def patient_schema(levels: List[Tuple[str, List[str]]]):
+    """
+    Build the Arrow schema of a patient design: one dictionary-encoded column per factor.
+    Every row stores a one-byte code, and each level string is stored once per file
+    (per row group in Parquet) instead of once per row.
+    Args:
+        levels: A list of (field name, levels) tuples
+    Returns:
+        A pyarrow.Schema.
+    """
+    _require_pyarrow()
+    return pa.schema([(field, pa.dictionary(pa.int8(), pa.string())) for field, _ in levels])
+
+class _TableWriter:
+    """
+    Writes record batches to a Parquet or Arrow IPC file.
+    """
+
+    def __init__(self, path: str, schema, file_format: str):
+        if file_format == "parquet":
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            self.sink = pa.OSFile(path, "wb")
+            self.writer = pa.ipc.new_file(self.sink, schema)
+        self.file_format = file_format
+
+    def write(self, batch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        if self.file_format == "arrow":
+            self.sink.close()
+
+class CodedColumnWriter:
+    """
+    Streams a design given as code columns into a Parquet or Arrow IPC file, one batch at a
+    time, so designs larger than memory can be written.
+    """
+
+    def __init__(self, path: str, levels: List[Tuple[str, List[str]]], file_format: str = None):
+        """
+        Args:
+            path: The path of the file to write
+            levels: A list of (field name, levels) tuples, in column order
+            file_format: "parquet" or "arrow". Defaults to the format of the path's extension
+        """
+        _require_pyarrow()
+        self.schema = patient_schema(levels)
+        # Every batch uses the same dictionaries, which the Arrow IPC file format requires
+        self.dictionaries = {field: pa.array(values, pa.string()) for field, values in levels}
+        self.fields = [field for field, _ in levels]
+        self.writer = _TableWriter(path, self.schema, file_format or file_format_from_path(path))
+
+    def write(self, codes: Dict[str, Any]):
+        """
+        Write one batch, given as a dictionary mapping each field name to an integer NumPy
+        array of codes indexing its levels.
+        """
+        arrays = [
+            pa.DictionaryArray.from_arrays(pa.array(codes[field].astype("int8")), self.dictionaries[field])
+            for field in self.fields
+        ]
+        self.writer.write(pa.record_batch(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def write_coded_columns(columns: Dict[str, Tuple[Any, List[str]]], path: str, file_format: str = None, chunk_size: int = 1_000_000):
+    """
+    Write a design given as code columns, e.g. from patient_generator3.decode_cells.
+    The codes go into the file as they are, without a Python object per row.
+    Args:
+        columns: A dictionary mapping each field name to a (codes, levels) tuple, where codes
+            is an integer NumPy array indexing levels
+        path: The path of the file to write
+        file_format: "parquet" or "arrow". Defaults to the format of the path's extension
+        chunk_size: The number of rows per record batch (and Parquet row group)
+    """
+    writer = CodedColumnWriter(path, [(field, values) for field, (_, values) in columns.items()], file_format)
+    num_rows = len(next(iter(columns.values()))[0])
+    try:
+        for start in range(0, num_rows, chunk_size):
+            writer.write({field: codes[start:start + chunk_size] for field, (codes, _) in columns.items()})
+    finally:
+        writer.close()
+
+def write_patient_rows(patients: Iterable[Dict[str, Any]], path: str, levels: List[Tuple[str, List[str]]],
+                       file_format: str = None, chunk_size: int = 100_000):
+    """
+    Write patient dictionaries to a Parquet or Arrow IPC file with dictionary-encoded columns.
+    Args:
+        patients: Any iterable of patient dictionaries, e.g. a list or a StratifiedDesign.
+            It is consumed chunk by chunk, so it does not have to fit in memory
+        path: The path of the file to write
+        levels: A list of (field name, levels) tuples covering every value in the patients
+        file_format: "parquet" or "arrow". Defaults to the format of the path's extension
+        chunk_size: The number of rows per record batch (and Parquet row group)
+    """
+    _require_pyarrow()
+    file_format = file_format or file_format_from_path(path)
+    schema = patient_schema(levels)
+    # Every batch uses the same dictionaries, which the Arrow IPC file format requires
+    dictionaries = {field: pa.array(values, pa.string()) for field, values in levels}
+    codes = {field: {value: code for code, value in enumerate(values)} for field, values in levels}
+    writer = _TableWriter(path, schema, file_format)
+
+    def write_chunk(chunk):
+        arrays = [
+            pa.DictionaryArray.from_arrays(pa.array([codes[field][patient[field]] for patient in chunk], pa.int8()), dictionaries[field])
+            for field, _ in levels
+        ]
+        writer.write(pa.record_batch(arrays, schema=schema))
+
+    try:
+        chunk = []
+        for patient in patients:
+            chunk.append(patient)
+            if len(chunk) == chunk_size:
+                write_chunk(chunk)
+                chunk = []
+        if chunk:
+            write_chunk(chunk)
+    finally:
+        writer.close()
+
+def read_patient_table(path: str):
+    """
+    Read a Parquet or Arrow IPC patient file.
+    Args:
+        path: The path of the file
+    Returns:
+        A tuple of the field names and a list of patient dictionaries.
+    """
+    _require_pyarrow()
+    if file_format_from_path(path) == "parquet":
+        table = pq.read_table(path)
+    else:
+        with pa.memory_map(path, "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+    return table.column_names, table_to_rows(table)
+
+def table_to_rows(table):
+    """
+    Convert an Arrow table into a list of row dictionaries, column by column.
+    Dictionary-encoded columns are decoded through their dictionary, so every row shares
+    the same few string objects instead of holding its own copies.
+    """
+    columns = []
+    for column in table.columns:
+        values = []
+        for chunk in column.chunks:
+            if pa.types.is_dictionary(chunk.type):
+                dictionary = chunk.dictionary.to_pylist()
+                values.extend(None if code is None else dictionary[code] for code in chunk.indices.to_pylist())
+            else:
+                values.extend(chunk.to_pylist())
+        columns.append(values)
+    names = table.column_names
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+def read_patient_file(path: str):
+    """
+    Read a patient file of any supported format.
+    Args:
+        path: The path of a CSV, Parquet or Arrow IPC file
+    Returns:
+        A tuple of the field names and a list of patient dictionaries.
+    """
+    if file_format_from_path(path) != "csv":
+        return read_patient_table(path)
+    with open(path, "r", newline='') as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        return csv_reader.fieldnames, list(csv_reader)
@@ -0,0 +1,309 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+from retry_policy import get_status_code
+
+# The HTTP status codes that mean we are sending too much: 429 is a rate limit
+# error and 529 means the API is overloaded
+OVERLOAD_STATUS_CODES = (429, 529)
+
+# The rate limit headers sent with every Messages API response. Each limit comes with
+# a "-limit", "-remaining" and "-reset" header, e.g. anthropic-ratelimit-requests-remaining
+RATE_LIMIT_HEADER_PREFIXES = {
+    "requests": "anthropic-ratelimit-requests",
+    "input_tokens": "anthropic-ratelimit-input-tokens",
+    "output_tokens": "anthropic-ratelimit-output-tokens",
+}
+
+def estimate_input_tokens(request: Dict[str, Any]):
+    """
+    Roughly estimate the number of input tokens of a Messages API request.
+    Args:
+        request: The request keyword arguments, with a system prompt and messages
+    Returns:
+        An estimate of the input tokens, using the rule of thumb of 4 characters per token.
+    """
+    characters = 0
+    system = request.get("system", "")
+    if isinstance(system, str):
+        characters += len(system)
+    else:
+        characters += sum(len(block.get("text", "")) for block in system)
+    for message in request.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, str):
+            characters += len(content)
+        else:
+            characters += sum(len(block.get("text", "")) for block in content)
+    return characters // 4 + 1
+
+def parse_reset_time(value: Optional[str]):
+    """
+    Convert a rate limit reset header into the number of seconds from now.
+    Args:
+        value: An RFC 3339 timestamp such as "2025-06-02T12:15:39Z", or None
+    Returns:
+        The number of seconds until the reset (0 if it is in the past), or None if unknown.
+    """
+    if not value:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, reset_at.timestamp() - time.time())
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at a per-minute rate.
+    """
+
+    def __init__(self, per_minute: float):
+        """
+        Create a full bucket.
+        Args:
+            per_minute: The number of tokens (or requests) allowed per minute
+        """
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount: float):
+        """
+        Return the number of seconds until `amount` tokens are available.
+        Amounts larger than the bucket only wait for a full bucket, so they cannot block forever.
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.capacity
+
+    def consume(self, amount: float):
+        """
+        Take `amount` tokens out of the bucket. The bucket may go negative, which is paid back by waiting.
+        """
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        """
+        Put back tokens that were reserved but not used.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def update(self, limit: Optional[float], remaining: Optional[float], reset_seconds: Optional[float]):
+        """
+        Align the bucket with the limit and remaining count reported by the server.
+        Args:
+            limit: The per-minute limit of the organisation, if reported
+            remaining: The number of tokens (or requests) left before the limit, if reported
+            reset_seconds: The number of seconds until the remaining count is fully replenished
+        """
+        self._refill()
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            # The server knows about every request of the organisation, not only ours,
+            # so we never allow more than it reports as remaining
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining <= 0 and reset_seconds:
+                self.tokens = min(self.tokens, -self.capacity * reset_seconds / 60.0)
+
+class SchedulerTicket:
+    """
+    The caller's handle on one scheduled request. The caller reports the response headers
+    and the actual output tokens on it, and the scheduler reads them when the request ends.
+    """
+
+    def __init__(self, input_tokens: int = 0, output_tokens: int = 0):
+        self.input_tokens = input_tokens
+        # Starts as the reserved maximum and is replaced by the actual count when known
+        self.output_tokens = output_tokens
+        self.headers = None
+
+    def observe_headers(self, headers):
+        """
+        Record the headers of the response.
+        """
+        self.headers = headers
+
+class RequestScheduler:
+    """
+    An adaptive scheduler that sits between the generators and the API client.
+
+    Requests wait for a free concurrency slot and for room in three token buckets
+    (requests, input tokens and output tokens per minute). The buckets are kept in line
+    with the rate limit headers of every response. The concurrency limit grows by one
+    slot per window of successful requests and is halved when the API answers with a
+    429 or 529 (AIMD), and all requests pause for the retry-after time it asks for.
+    """
+
+    def __init__(self, max_concurrency: int, requests_per_minute: float, input_tokens_per_minute: float,
+                 output_tokens_per_minute: float, min_concurrency: int = 1):
+        """
+        Args:
+            max_concurrency: The upper bound of the concurrency limit
+            requests_per_minute: The initial requests per minute budget
+            input_tokens_per_minute: The initial input tokens per minute budget
+            output_tokens_per_minute: The initial output tokens per minute budget
+            min_concurrency: The lower bound of the concurrency limit
+        The per-minute budgets are replaced by the limits the server reports.
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.buckets = {
+            "requests": TokenBucket(requests_per_minute),
+            "input_tokens": TokenBucket(input_tokens_per_minute),
+            "output_tokens": TokenBucket(output_tokens_per_minute),
+        }
+        self.in_flight = 0
+        # The monotonic time until which no new request may start
+        self.paused_until = 0.0
+        self.overloads = 0
+        self._condition = None
+        self._loop = None
+
+    def _get_condition(self):
+        # asyncio primitives belong to one event loop, so we create the condition lazily
+        # on the loop that is running, which lets one scheduler serve several asyncio.run calls
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+
+    async def acquire(self, input_tokens: int, output_tokens: int):
+        """
+        Wait until a request with the given token estimates may be sent, then reserve it.
+        Args:
+            input_tokens: The estimated input tokens of the request
+            output_tokens: The output tokens to reserve, normally the request's max_tokens
+        """
+        condition = self._get_condition()
+        async with condition:
+            while True:
+                if self.in_flight < max(self.min_concurrency, int(self.concurrency_limit)):
+                    wait = max(
+                        self.paused_until - time.monotonic(),
+                        self.buckets["requests"].wait_time(1),
+                        self.buckets["input_tokens"].wait_time(input_tokens),
+                        self.buckets["output_tokens"].wait_time(output_tokens),
+                    )
+                    if wait <= 0:
+                        break
+                    # A finished request can change the picture, so we wake up on notify as well
+                    try:
+                        await asyncio.wait_for(condition.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await condition.wait()
+            self.in_flight += 1
+            self.buckets["requests"].consume(1)
+            self.buckets["input_tokens"].consume(input_tokens)
+            self.buckets["output_tokens"].consume(output_tokens)
+
+    async def release(self, ticket: SchedulerTicket, reserved_output_tokens: int, error: Optional[BaseException] = None):
+        """
+        Finish a request and adapt the limits to its outcome.
+        Args:
+            ticket: The ticket of the request
+            reserved_output_tokens: The output tokens reserved in acquire
+            error: The exception the request failed with, if any
+        """
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            headers = ticket.headers
+            # Anthropic SDK errors carry status_code and response.headers, the urllib
+            # HTTPErrors of the OpenAI-compatible backend code and headers
+            status_code = get_status_code(error) if error is not None else None
+            if headers is None and error is not None:
+                response = getattr(error, "response", None)
+                headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+            if headers is not None:
+                self.observe_headers(headers)
+
+            if status_code in OVERLOAD_STATUS_CODES:
+                self.on_overload(headers)
+            elif error is None:
+                # Additive increase: one more slot after a full window of successful requests
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit)
+                unused = reserved_output_tokens - ticket.output_tokens
+                if unused > 0:
+                    self.buckets["output_tokens"].refund(unused)
+            condition.notify_all()
+
+    def on_overload(self, headers=None):
+        """
+        Back off after a 429 or 529: halve the concurrency limit and pause new requests.
+        Args:
+            headers: The headers of the failed response, used for its retry-after time
+        """
+        self.overloads += 1
+        self.concurrency_limit = max(float(self.min_concurrency), self.concurrency_limit / 2.0)
+        retry_after = None
+        if headers is not None:
+            try:
+                retry_after = float(headers.get("retry-after"))
+            except (TypeError, ValueError):
+                retry_after = None
+        # Without a retry-after header we wait a second, which is enough to break up a burst
+        pause = retry_after if retry_after is not None else 1.0
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        print(f"Rate limited or overloaded. Pausing {pause:.1f}s and lowering concurrency to {int(self.concurrency_limit)}")
+
+    def observe_headers(self, headers):
+        """
+        Update the token buckets from the rate limit headers of a response.
+        Args:
+            headers: A mapping with the response headers
+        """
+        for name, prefix in RATE_LIMIT_HEADER_PREFIXES.items():
+            limit = _header_number(headers, f"{prefix}-limit")
+            remaining = _header_number(headers, f"{prefix}-remaining")
+            reset_seconds = parse_reset_time(headers.get(f"{prefix}-reset"))
+            if limit is not None or remaining is not None:
+                self.buckets[name].update(limit, remaining, reset_seconds)
+
+    @asynccontextmanager
+    async def slot(self, input_tokens: int, output_tokens: int):
+        """
+        Reserve a request for the duration of an async with block.
+        Args:
+            input_tokens: The estimated input tokens of the request
+            output_tokens: The output tokens to reserve, normally the request's max_tokens
+        Yields:
+            A SchedulerTicket on which the caller records the response headers and output tokens.
+        """
+        await self.acquire(input_tokens, output_tokens)
+        ticket = SchedulerTicket(input_tokens, output_tokens)
+        try:
+            yield ticket
+        except BaseException as e:
+            await self.release(ticket, output_tokens, error=e)
+            raise
+        await self.release(ticket, output_tokens)
+
+def _header_number(headers, name: str):
+    """
+    Read a numeric header, returning None when it is missing or malformed.
+    """
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Any, Optional
+
+# The default location of the on-disk response cache
+RESPONSE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "response_cache.sqlite")
+
+# Once the stored responses grow beyond this many bytes, the least recently used
+# responses are evicted until the cache fits again
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+def make_cache_key(request: Dict[str, Any]):
+    """
+    Build a content-addressed key for an LLM request.
+    Args:
+        request: The keyword arguments of the request, i.e. the model, temperature,
+            system prompt, messages and max_tokens (and anything else that changes the response)
+    Returns:
+        A hex SHA-256 digest of the request. Identical requests always get the same key.
+    """
+    # We serialise the request with sorted keys so that the key does not depend on dict order
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    A persistent SQLite cache of LLM response texts keyed by make_cache_key.
+    The cache is size-bounded and evicts the least recently used responses first.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Open (or create) the cache database.
+        Args:
+            path: The path of the SQLite database file
+            max_bytes: The maximum total size of the stored responses
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.connection.commit()
+        # We keep the total size in memory so that a put does not need to rescan the table
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response and mark it as recently used.
+        Args:
+            key: The cache key of the request
+        Returns:
+            The cached response text, or None if the request is not in the cache.
+        """
+        row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return row[0]
+
+    def put(self, key: str, response_text: str):
+        """
+        Store a response, evicting the least recently used responses if the cache is full.
+        Args:
+            key: The cache key of the request
+            response_text: The full text of the response
+        """
+        size = len(response_text.encode("utf-8"))
+        previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if previous is not None:
+            self.total_bytes -= previous[0]
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+            (key, response_text, size, time.time()),
+        )
+        self.total_bytes += size
+        self._evict()
+        self.connection.commit()
+
+    def _evict(self):
+        """
+        Delete the least recently used responses until the cache fits within max_bytes.
+        """
+        while self.total_bytes > self.max_bytes:
+            row = self.connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            self.total_bytes -= row[1]
+
+    def close(self):
+        """
+        Print the hit and miss counts of this session and close the database.
+        """
+        print(f"Response cache: {self.hits} hits, {self.misses} misses ({self.path})")
+        self.connection.close()
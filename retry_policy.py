@@ -0,0 +1,215 @@
+import asyncio
+import collections
+import json
+import random
+import time
+
+try:
+    import anthropic
+except ImportError:
+    anthropic = None
+
+# The classes an error can be sorted into
+# - RETRYABLE: transient API trouble (overload, rate limit, connection). Retried with backoff
+# - FATAL: the request itself is wrong (authentication, bad request). Retrying cannot help
+# - INVALID_RESPONSE: the API answered, but the response could not be used (e.g. broken JSON).
+#   A new generation is requested straight away, as there is nothing to wait for
+RETRYABLE = "retryable"
+FATAL = "fatal"
+INVALID_RESPONSE = "invalid_response"
+
+class InvalidResponseError(Exception):
+    """
+    Raised when the API answered but the response cannot be used, e.g. because it fails
+    a content check. Like broken JSON, it is classified as INVALID_RESPONSE.
+    """
+
+class StopRunError(Exception):
+    """
+    Raised when the run has to stop sending requests although the API works, e.g. because
+    its budget is spent. It is classified as FATAL, so it is never retried.
+    """
+
+# Errors that mean our own code is wrong. They fail the row straight away instead of being retried
+PROGRAMMING_ERRORS = (KeyError, IndexError, TypeError, AttributeError, NameError)
+
+# Request timeout, conflict, rate limit, server errors and overload (529)
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504, 529)
+# Authentication and permission errors affect every request of the run, not just one row
+RUN_FATAL_STATUS_CODES = (401, 403)
+
+def get_status_code(error: BaseException):
+    """
+    Return the HTTP status code of an API error, or None if it has none.
+    Works for the Anthropic SDK errors (status_code) and for urllib HTTP errors (code).
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(error, "code", None)
+    return status_code if isinstance(status_code, int) else None
+
+def get_retry_after(error: BaseException):
+    """
+    Return the retry-after time (in seconds) the API sent with an error, or None.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    if headers is None:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def classify_error(error: BaseException):
+    """
+    Sort an error raised while generating a response into RETRYABLE, FATAL or INVALID_RESPONSE.
+    Args:
+        error: The exception that was raised
+    Returns:
+        One of RETRYABLE, FATAL or INVALID_RESPONSE.
+    """
+    if isinstance(error, StopRunError):
+        return FATAL
+    # Only the errors raised on purpose for unusable responses. A bare KeyError (or a
+    # TypeError, AttributeError, ...) is a bug in our own code, which retrying would hide
+    if isinstance(error, (json.JSONDecodeError, InvalidResponseError)):
+        return INVALID_RESPONSE
+    if isinstance(error, PROGRAMMING_ERRORS):
+        return FATAL
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return RETRYABLE if status_code in RETRYABLE_STATUS_CODES or status_code >= 500 else FATAL
+    if anthropic is not None and isinstance(error, anthropic.APIConnectionError):
+        return RETRYABLE
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return RETRYABLE
+    # Anything else we do not recognise is retried with backoff, as the generators always did
+    return RETRYABLE
+
+def aborts_run(error: BaseException):
+    """
+    Return True if the error means that no request of the run can succeed, e.g. a bad API key.
+    """
+    return get_status_code(error) in RUN_FATAL_STATUS_CODES
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed request is retried.
+    Retryable errors wait a capped exponential backoff with full jitter, so that workers
+    that failed together do not all retry at the same moment.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        """
+        Args:
+            max_attempts: The total number of attempts per request, including the first one
+            base_delay: The backoff cap (in seconds) after the first failure
+            max_delay: The largest backoff (in seconds) between two attempts
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, error: BaseException, attempt: int):
+        """
+        Return True if a request that failed with `error` on the 0-based `attempt` should be tried again.
+        """
+        return classify_error(error) != FATAL and attempt + 1 < self.max_attempts
+
+    def backoff_delay(self, error: BaseException, attempt: int):
+        """
+        Return the number of seconds to wait before retrying after the 0-based `attempt` failed.
+        Invalid responses are retried straight away. If the API sent a retry-after time,
+        we never wait less than that.
+        """
+        if classify_error(error) != RETRYABLE:
+            return 0.0
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+class CircuitBreaker:
+    """
+    A run-wide circuit breaker over the outcomes of recent API requests.
+
+    When the share of retryable failures in the recent window reaches the threshold, the
+    breaker opens and every worker pauses for the cooldown. After the cooldown, requests
+    are let through again; if the next one fails, the breaker reopens with a doubled cooldown.
+    """
+
+    def __init__(self, window: int = 20, min_requests: int = 5, failure_threshold: float = 0.5,
+                 cooldown: float = 30.0, max_cooldown: float = 300.0):
+        """
+        Args:
+            window: The number of recent requests the error rate is computed over
+            min_requests: The number of requests needed in the window before the breaker can open
+            failure_threshold: The error rate (0-1) at which the breaker opens
+            cooldown: The first pause (in seconds) when the breaker opens
+            max_cooldown: The longest pause (in seconds) after repeated openings
+        """
+        self.outcomes = collections.deque(maxlen=window)
+        self.min_requests = min_requests
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.open_until = 0.0
+        self.half_open = False
+        self.times_opened = 0
+
+    def record_success(self):
+        """
+        Record a successful request. A success after a pause closes the breaker.
+        """
+        self.outcomes.append(True)
+        if self.half_open:
+            self.half_open = False
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        """
+        Record a request that failed with a retryable error, opening the breaker if needed.
+        """
+        if self.half_open:
+            # Requests that were already in flight when the breaker opened fail during the
+            # pause as well. They tell us nothing new, so only failures after it count
+            if self.wait_time() > 0:
+                return
+            # The first request after the pause failed as well, so we pause for longer
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self._open()
+            return
+        self.outcomes.append(False)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_requests and failures / len(self.outcomes) >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.times_opened += 1
+        self.open_until = time.monotonic() + self.cooldown
+        self.half_open = True
+        self.outcomes.clear()
+        print(f"Circuit breaker opened: error rate too high. Pausing all requests for {self.cooldown:.0f}s")
+
+    def wait_time(self):
+        """
+        Return the number of seconds until requests may be sent again (0 if the breaker is closed).
+        """
+        return max(0.0, self.open_until - time.monotonic())
+
+    def wait_sync(self):
+        """
+        Block until the breaker lets requests through.
+        """
+        while self.wait_time() > 0:
+            time.sleep(self.wait_time())
+
+    async def wait_async(self):
+        """
+        Wait (without blocking the event loop) until the breaker lets requests through.
+        """
+        while self.wait_time() > 0:
+            await asyncio.sleep(self.wait_time())
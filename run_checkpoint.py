@@ -0,0 +1,200 @@
+import collections
+import csv
+import hashlib
+import heapq
+import json
+import os
+from typing import Dict, Any, List
+
+def make_row_id(row_number: int, patient_data: Dict[str, Any]):
+    """
+    Build a stable ID for an input row.
+    Args:
+        row_number: The 1-based position of the row in the input file
+        patient_data: The patient row from the input file, a dictionary or a PatientRecord
+    Returns:
+        A string such as "12-3f9a2c1b". The digest of the row content makes sure that a
+        checkpoint is only matched against the same row of the same input file.
+    """
+    content = json.dumps(dict(patient_data), sort_keys=True)
+    return f"{row_number}-{hashlib.sha1(content.encode('utf-8')).hexdigest()[:8]}"
+
+def row_number(row_id: str):
+    """
+    Return the 1-based input row number encoded in a row ID built by make_row_id.
+    """
+    return int(row_id.split("-", 1)[0])
+
+class CheckpointedOutput:
+    """
+    Incrementally written output CSV with a checkpoint file that records the completed row IDs.
+
+    Every completed row is written to the checkpoint and the output CSV as soon as all rows
+    handed out before it have finished, so the output stays in input-row order even when
+    rows complete out of order. Only the rows waiting on a slower predecessor are held in
+    memory, so memory use does not grow with the number of rows.
+
+    A resumed run writes the rows that failed in the earlier run after the rows that run
+    completed. When the output is closed, such a checkpoint is merged back into input-row
+    order, reading every earlier run's rows as a stream, and the output CSV is rewritten.
+    """
+
+    def __init__(self, output_path: str, checkpoint_path: str, fieldnames: List[str], resume: bool = False,
+                 narrative_window: int = 3):
+        """
+        Open the output and checkpoint files.
+        Args:
+            output_path: The path of the output CSV file
+            checkpoint_path: The path of the JSON lines checkpoint file
+            fieldnames: The columns of the output CSV file
+            resume: Whether to continue an earlier run. If False, both files are started over
+            narrative_window: The number of the most recent narratives of an earlier run
+                kept in narratives, i.e. the number the prompt shows the model
+        """
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path
+        self.fieldnames = fieldnames
+        # The IDs of rows already in the output, and the last narratives of an earlier run.
+        # Use iter_narratives to read all of them
+        self.completed_row_ids = set()
+        self.narratives = collections.deque(maxlen=narrative_window)
+        self.rows_written = 0
+        self.resumed = False
+
+        # The checkpoint is the source of truth: it holds every completed output row. On resume
+        # the output CSV is rebuilt from it, so a crash between the two writes cannot leave
+        # rows that are duplicated or missing in the output
+        self.output_file = open(output_path, "w", newline="")
+        self.csv_writer = csv.DictWriter(self.output_file, fieldnames=fieldnames)
+        self.csv_writer.writeheader()
+
+        if resume and os.path.exists(checkpoint_path):
+            valid_bytes = 0
+            with open(checkpoint_path, "rb") as checkpoint_file:
+                for line in checkpoint_file:
+                    # A crash can leave a partially written last line behind, which we drop
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    valid_bytes += len(line)
+                    self.completed_row_ids.add(record["row_id"])
+                    self.narratives.append(record["patient"]["narrative"])
+                    self.csv_writer.writerow(record["patient"])
+            os.truncate(checkpoint_path, valid_bytes)
+            self.resumed = valid_bytes > 0
+            print(f"Resuming from {checkpoint_path}: {len(self.completed_row_ids)} rows already completed")
+        self.output_file.flush()
+
+        self.checkpoint_file = open(checkpoint_path, "a" if resume else "w")
+
+        # Rows that finished before an earlier row, keyed by their sequence number
+        self.pending = {}
+        self.next_sequence = 0
+
+    def complete(self, sequence: int, row_id: str, processed_patient: Dict[str, Any]):
+        """
+        Record a completed row.
+        Args:
+            sequence: The 0-based order in which the row was handed out in this run
+            row_id: The stable ID of the row built by make_row_id
+            processed_patient: The output row
+        """
+        self.pending[sequence] = (row_id, processed_patient)
+        self._flush_ready()
+
+    def fail(self, sequence: int):
+        """
+        Record a row that could not be generated, so that later rows are not held back by it.
+        Args:
+            sequence: The 0-based order in which the row was handed out in this run
+        """
+        self.pending[sequence] = None
+        self._flush_ready()
+
+    def _flush_ready(self):
+        """
+        Write every pending row whose predecessors have all finished.
+        """
+        wrote = False
+        while self.next_sequence in self.pending:
+            entry = self.pending.pop(self.next_sequence)
+            self.next_sequence += 1
+            if entry is None:
+                continue
+            row_id, processed_patient = entry
+            self.checkpoint_file.write(json.dumps({"row_id": row_id, "patient": processed_patient}) + "\n")
+            self.csv_writer.writerow(processed_patient)
+            self.completed_row_ids.add(row_id)
+            self.rows_written += 1
+            wrote = True
+        if wrote:
+            self.checkpoint_file.flush()
+            self.output_file.flush()
+
+    def iter_narratives(self):
+        """
+        Read the narratives of every row in the checkpoint, one at a time, in checkpoint order.
+        """
+        self.checkpoint_file.flush()
+        with open(self.checkpoint_path, "r") as checkpoint_file:
+            for line in checkpoint_file:
+                yield json.loads(line)["patient"]["narrative"]
+
+    def _sorted_runs(self):
+        """
+        Split the checkpoint into the runs of rows in ascending input order, one per run
+        of the generator.
+        Returns:
+            A list of (start, end) byte offsets of the runs.
+        """
+        runs = []
+        start = offset = 0
+        previous = None
+        with open(self.checkpoint_path, "rb") as checkpoint_file:
+            for line in checkpoint_file:
+                number = row_number(json.loads(line)["row_id"])
+                if previous is not None and number < previous:
+                    runs.append((start, offset))
+                    start = offset
+                previous = number
+                offset += len(line)
+        if offset > start:
+            runs.append((start, offset))
+        return runs
+
+    def _read_run(self, start: int, end: int):
+        with open(self.checkpoint_path, "rb") as checkpoint_file:
+            checkpoint_file.seek(start)
+            while checkpoint_file.tell() < end:
+                record = json.loads(checkpoint_file.readline())
+                yield row_number(record["row_id"]), record["patient"]
+
+    def restore_input_order(self):
+        """
+        Rewrite the output CSV in input-row order if a resumed run added rows before rows
+        of an earlier run. Each run of the checkpoint is already in order, so they are
+        merged as streams and memory does not grow with the number of rows.
+        """
+        runs = self._sorted_runs()
+        if len(runs) < 2:
+            return
+        temporary_path = f"{self.output_path}.tmp"
+        with open(temporary_path, "w", newline="") as output_file:
+            csv_writer = csv.DictWriter(output_file, fieldnames=self.fieldnames)
+            csv_writer.writeheader()
+            for _, processed_patient in heapq.merge(*(self._read_run(start, end) for start, end in runs),
+                                                    key=lambda entry: entry[0]):
+                csv_writer.writerow(processed_patient)
+        os.replace(temporary_path, self.output_path)
+
+    def close(self):
+        """
+        Close the output and checkpoint files, restoring the input-row order of a resumed output.
+        """
+        self.output_file.close()
+        self.checkpoint_file.close()
+        if self.resumed and self.rows_written:
+            self.restore_input_order()
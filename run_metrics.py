@@ -0,0 +1,341 @@
+import asyncio
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List
+
+from retry_policy import InvalidResponseError, get_status_code
+
+# Live metrics of a narrative run. The generator records every row, request, retry and
+# token in a RunMetrics object, and the metrics can be watched while the run goes on,
+# either scraped from a local HTTP endpoint in Prometheus text format (/metrics, with
+# the same numbers as JSON on /metrics.json) or read from a JSON file that is rewritten
+# every few seconds. Both are meant for tuning the concurrency and catching slowdowns
+# in long runs while they happen.
+
+# The upper bounds (in seconds) of the time-to-first-token histogram buckets
+TTFT_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0]
+
+# The upper bounds (in seconds) of the total request latency histogram buckets
+LATENCY_BUCKETS = [0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0]
+
+# Rates (rows/s, tokens/s) and the ETA are taken over this many recent seconds, so they
+# follow slowdowns instead of averaging them away over the whole run
+RATE_WINDOW_SECONDS = 60.0
+
+# How often the metrics file is rewritten, in seconds
+METRICS_FILE_INTERVAL = 5.0
+
+def retry_cause(error: BaseException):
+    """
+    Return a short label for the cause of a failed attempt, e.g. "http_429" or "invalid_json".
+    """
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return f"http_{status_code}"
+    if isinstance(error, json.JSONDecodeError):
+        return "invalid_json"
+    # Subclasses such as NearDuplicateError are labelled with their own name below
+    if type(error) is InvalidResponseError:
+        return "invalid_response"
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    return type(error).__name__
+
+class Histogram:
+    """
+    A histogram with fixed buckets, kept as Prometheus keeps them: a count per bucket
+    upper bound, plus the sum and the count of all observations.
+    """
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Return (upper bound, cumulative count) pairs, the last bound being float("inf").
+        """
+        pairs = []
+        total = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, q: float):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in, or None without observations.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound if bound != float("inf") else self.buckets[-1]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): total for bound, total in self.cumulative()},
+        }
+
+class RunMetrics:
+    """
+    The counters, gauges and histograms of one narrative run.
+
+    All updates come from the asyncio thread of the run, which is also the only thread
+    that trims the rate windows. The HTTP endpoint and the file writer read the metrics
+    from their own threads without changing anything: every value is a plain number or
+    is copied before use, so a reading is at most one update behind.
+    """
+
+    def __init__(self, rows_to_generate: int = 0, clock=time.monotonic):
+        """
+        Args:
+            rows_to_generate: The number of rows the run has to generate, for the ETA
+            clock: The clock the rates are measured with
+        """
+        self.clock = clock
+        self.start_time = clock()
+        self.rows_to_generate = rows_to_generate
+        self.rows_completed = 0
+        self.rows_failed = 0
+        self.requests_started = 0
+        self.in_flight = 0
+        self.output_tokens = 0
+        self.input_tokens = 0
+        self.retries = collections.Counter()
+        self.ttft = Histogram(TTFT_BUCKETS)
+        self.latency = Histogram(LATENCY_BUCKETS)
+        # (time, rows) and (time, output tokens) events of the rate window
+        self.recent_rows = collections.deque()
+        self.recent_tokens = collections.deque()
+
+    def _trim(self, events, now):
+        while events and events[0][0] < now - RATE_WINDOW_SECONDS:
+            events.popleft()
+
+    def request_started(self):
+        self.requests_started += 1
+        self.in_flight += 1
+
+    def first_token(self, seconds: float):
+        self.ttft.observe(seconds)
+
+    def request_finished(self, seconds: float, usage: Dict[str, int]):
+        """
+        Record the end of a request, successful or not.
+        Args:
+            seconds: The time from sending the request to the end of its response
+            usage: The token usage of the response, as reported by the backend
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+        self.latency.observe(seconds)
+        output_tokens = usage.get("output_tokens") or 0
+        self.output_tokens += output_tokens
+        self.input_tokens += usage.get("input_tokens") or 0
+        now = self.clock()
+        self.recent_tokens.append((now, output_tokens))
+        self._trim(self.recent_tokens, now)
+
+    def retry(self, error: BaseException):
+        self.retries[retry_cause(error)] += 1
+
+    def row_finished(self, accepted: bool):
+        if accepted:
+            self.rows_completed += 1
+        else:
+            self.rows_failed += 1
+        now = self.clock()
+        self.recent_rows.append((now, 1))
+        self._trim(self.recent_rows, now)
+
+    def _window_rate(self, events, now):
+        # Read from other threads, so the window is filtered on a copy instead of trimmed.
+        # Early in the run the window is shorter than RATE_WINDOW_SECONDS
+        window = min(RATE_WINDOW_SECONDS, now - self.start_time)
+        start = now - RATE_WINDOW_SECONDS
+        return sum(amount for at, amount in list(events) if at >= start) / window if window > 0 else 0.0
+
+    def snapshot(self):
+        """
+        Return the current metrics as a dictionary that can be saved as JSON.
+        Safe to call from any thread.
+        """
+        now = self.clock()
+        elapsed = now - self.start_time
+        rows_finished = self.rows_completed + self.rows_failed
+        rows_per_second = self._window_rate(self.recent_rows, now)
+        rows_remaining = max(0, self.rows_to_generate - rows_finished)
+        return {
+            "elapsed_seconds": elapsed,
+            "rows_to_generate": self.rows_to_generate,
+            "rows_completed": self.rows_completed,
+            "rows_failed": self.rows_failed,
+            "rows_remaining": rows_remaining,
+            "rows_per_second": rows_per_second,
+            "rows_per_second_overall": rows_finished / elapsed if elapsed > 0 else 0.0,
+            "requests_started": self.requests_started,
+            "in_flight_requests": self.in_flight,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "output_tokens_per_second": self._window_rate(self.recent_tokens, now),
+            "retries": dict(self.retries),
+            "eta_seconds": rows_remaining / rows_per_second if rows_per_second > 0 else None,
+            "time_to_first_token_seconds": self.ttft.summary(),
+            "request_latency_seconds": self.latency.summary(),
+        }
+
+    def prometheus_text(self):
+        """
+        Return the current metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP narrative_{name} {help_text}")
+            lines.append(f"# TYPE narrative_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"narrative_{name}{labels} {value}")
+
+        metric("rows_completed_total", "counter", "Rows whose narrative was written to the output",
+               [("", self.rows_completed)])
+        metric("rows_failed_total", "counter", "Rows that failed to generate", [("", self.rows_failed)])
+        metric("rows_remaining", "gauge", "Rows the run still has to generate", [("", snapshot["rows_remaining"])])
+        metric("rows_per_second", "gauge", f"Rows finished per second over the last {RATE_WINDOW_SECONDS:.0f}s",
+               [("", snapshot["rows_per_second"])])
+        metric("requests_total", "counter", "Requests sent to the API", [("", self.requests_started)])
+        metric("in_flight_requests", "gauge", "Requests being sent or streaming", [("", self.in_flight)])
+        metric("input_tokens_total", "counter", "Input tokens of finished requests", [("", self.input_tokens)])
+        metric("output_tokens_total", "counter", "Output tokens of finished requests", [("", self.output_tokens)])
+        metric("output_tokens_per_second", "gauge", f"Output tokens per second over the last {RATE_WINDOW_SECONDS:.0f}s",
+               [("", snapshot["output_tokens_per_second"])])
+        metric("retries_total", "counter", "Failed attempts that were retried, by cause",
+               [(f'{{cause="{cause}"}}', count) for cause, count in sorted(self.retries.items())])
+        if snapshot["eta_seconds"] is not None:
+            metric("eta_seconds", "gauge", "Estimated seconds until every row is finished", [("", snapshot["eta_seconds"])])
+        for name, help_text, histogram in (
+            ("time_to_first_token_seconds", "Seconds from sending a request to its first token", self.ttft),
+            ("request_latency_seconds", "Seconds from sending a request to the end of its response", self.latency),
+        ):
+            samples = [
+                (f'_bucket{{le="{"+Inf" if bound == float("inf") else bound}"}}', total)
+                for bound, total in histogram.cumulative()
+            ]
+            samples += [("_sum", histogram.sum), ("_count", histogram.count)]
+            metric(name, "histogram", help_text, samples)
+        return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics of the server's RunMetrics: Prometheus text on /metrics, JSON on /metrics.json.
+    """
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the terminal of the run
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.server.metrics.prometheus_text().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(self.server.metrics.snapshot(), indent=2).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    A local HTTP server for the metrics of a run, serving on a background thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, metrics: RunMetrics, host: str = "127.0.0.1", port: int = 0):
+        """
+        Args:
+            metrics: The RunMetrics of the run
+            host: The address to listen on. Only the local machine by default
+            port: The port to listen on, 0 for any free port
+        """
+        super().__init__((host, port), MetricsHandler)
+        self.metrics = metrics
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/metrics"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class MetricsFileWriter:
+    """
+    Rewrites a JSON file with the metrics of a run every few seconds, on a background thread.
+    The file is replaced atomically, so a reader never sees it half written.
+    """
+
+    def __init__(self, metrics: RunMetrics, path: str, interval: float = METRICS_FILE_INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def write(self):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as metrics_file:
+            json.dump(self.metrics.snapshot(), metrics_file, indent=2)
+        os.replace(temporary_path, self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"ERROR: Could not write the metrics to {self.path}: {e}")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop rewriting the file, writing the final metrics once more.
+        """
+        self.stopped.set()
+        self.thread.join()
+        # Called while the run shuts down, so a disk error must not hide the run's own error
+        try:
+            self.write()
+        except OSError as e:
+            print(f"ERROR: Could not write the metrics to {self.path}: {e}")
@@ -0,0 +1,201 @@
+import json
+
+# The field whose text is decoded and handed out while the response is still streaming
+STREAMED_FIELD = "narrative"
+
+# The characters of the simple JSON string escapes
+SIMPLE_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+class IncrementalJSONParser:
+    """
+    A single-pass parser for a JSON object response that is fed the streamed text chunk by chunk.
+
+    It tracks whether it is inside the object and inside a string, so it knows where the
+    object ends without re-scanning the text, and it decodes the narrative field as it
+    arrives. A response that does not start with a JSON object (optionally in a ```json
+    code fence) raises as soon as the first offending characters arrive, instead of after
+    the last token. The chunks are kept in a list and joined once, so long outputs are not
+    concatenated quadratically.
+    """
+
+    def __init__(self, streamed_field: str = STREAMED_FIELD):
+        """
+        Args:
+            streamed_field: The top-level string field to decode while streaming
+        """
+        self.streamed_field = streamed_field
+        self.chunks = []
+        self.position = 0
+        self.preamble = ""
+        self.fenced = False
+        # The absolute positions of the opening and closing braces of the object
+        self.start = None
+        self.end = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        # Top-level key tracking: whether the next string is a key, the key being read and the last key seen
+        self.expect_key = False
+        self.reading_key = False
+        self.key_chars = []
+        self.current_key = None
+        # Decoding state of the streamed field
+        self.in_streamed_field = False
+        self.escape_buffer = ""
+        self.pending_high_surrogate = None
+        self.streamed_parts = []
+
+    @property
+    def done(self):
+        """
+        True once the closing brace of the object has arrived.
+        """
+        return self.end is not None
+
+    @property
+    def text(self):
+        """
+        The full response text received so far.
+        """
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+    @property
+    def streamed_value(self):
+        """
+        The decoded text of the streamed field received so far.
+        """
+        return "".join(self.streamed_parts)
+
+    def _error(self, message: str, offset: int):
+        return json.JSONDecodeError(message, self.text, offset)
+
+    def feed(self, chunk: str):
+        """
+        Process the next chunk of the response.
+        Args:
+            chunk: The text of a stream delta
+        Returns:
+            The newly decoded text of the streamed field in this chunk (often empty).
+        Raises:
+            json.JSONDecodeError: If the response turns out not to be a JSON object
+        """
+        self.chunks.append(chunk)
+        base = self.position
+        self.position += len(chunk)
+        decoded = []
+
+        for offset, char in enumerate(chunk):
+            if self.start is None:
+                self._read_preamble(char, base + offset)
+                continue
+            if self.end is not None:
+                # After a code-fenced object the closing fence and any remarks are ignored.
+                # Without a fence only whitespace may follow, as json.loads would reject the rest
+                if not self.fenced and not char.isspace():
+                    raise self._error("Extra data after the JSON object", base + offset)
+                continue
+
+            if self.in_string:
+                self._read_string_char(char, decoded)
+                continue
+
+            if char == '"':
+                self.in_string = True
+                if self.depth == 1 and self.expect_key:
+                    self.reading_key = True
+                    self.key_chars = []
+                elif self.depth == 1 and self.current_key == self.streamed_field:
+                    self.in_streamed_field = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = base + offset
+            elif self.depth == 1 and char == ",":
+                self.expect_key = True
+            elif self.depth == 1 and char == ":":
+                self.expect_key = False
+
+        new_text = "".join(decoded)
+        if new_text:
+            self.streamed_parts.append(new_text)
+        return new_text
+
+    def _read_preamble(self, char: str, position: int):
+        if char == "{":
+            self.start = position
+            self.depth = 1
+            self.expect_key = True
+            return
+        self.preamble += char
+        stripped = self.preamble.strip()
+        # Only whitespace and (the start of) a ```json code fence may come before the object
+        if stripped.startswith("```"):
+            if "json".startswith(stripped[3:].strip().lower()):
+                self.fenced = True
+                return
+        elif "```".startswith(stripped):
+            return
+        raise self._error("Response does not start with a JSON object", position)
+
+    def _read_string_char(self, char: str, decoded):
+        if self.in_streamed_field:
+            self._decode_streamed_char(char, decoded)
+            return
+        if self.escaped:
+            self.escaped = False
+        elif char == "\\":
+            self.escaped = True
+        elif char == '"':
+            self.in_string = False
+            if self.reading_key:
+                self.reading_key = False
+                self.expect_key = False
+                self.current_key = json.loads('"' + "".join(self.key_chars) + '"')
+            return
+        if self.reading_key:
+            self.key_chars.append(char)
+
+    def _decode_streamed_char(self, char: str, decoded):
+        if self.escape_buffer:
+            self.escape_buffer += char
+            if self.escape_buffer[1] == "u":
+                # A \uXXXX escape is complete after four hex digits
+                if len(self.escape_buffer) < 6:
+                    return
+                code = int(self.escape_buffer[2:], 16)
+                self.escape_buffer = ""
+                if 0xD800 <= code < 0xDC00:
+                    # The first half of a surrogate pair, completed by the next escape
+                    self.pending_high_surrogate = code
+                    return
+                if 0xDC00 <= code < 0xE000 and self.pending_high_surrogate is not None:
+                    code = 0x10000 + ((self.pending_high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+                self.pending_high_surrogate = None
+                decoded.append(chr(code))
+            else:
+                decoded.append(SIMPLE_ESCAPES.get(self.escape_buffer[1], self.escape_buffer[1]))
+                self.escape_buffer = ""
+        elif char == "\\":
+            self.escape_buffer = char
+        elif char == '"':
+            self.in_string = False
+            self.in_streamed_field = False
+            self.current_key = None
+        else:
+            decoded.append(char)
+
+    def json_text(self):
+        """
+        Return the text of the complete JSON object.
+        Raises:
+            json.JSONDecodeError: If the object has not been closed, e.g. because the response was truncated
+        """
+        if self.start is None:
+            raise self._error("Response does not contain a JSON object", self.position)
+        if self.end is None:
+            raise self._error("Response ended before the JSON object was complete", self.position)
+        return self.text[self.start:self.end + 1]
@@ -0,0 +1,277 @@
+import asyncio
+import json
+from typing import Any, Dict, Optional
+
+from request_scheduler import estimate_input_tokens
+from retry_policy import StopRunError
+
+# USD per million tokens of each model, from the Anthropic price list. Cache writes are
+# the 5-minute ephemeral cache writes our system prompt uses. Update these when prices
+# change; models that are not listed (e.g. local OpenAI-compatible servers) cost nothing
+MODEL_PRICES = {
+    "claude-4-sonnet-20250514": {"input": 3.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30},
+    "claude-sonnet-4-20250514": {"input": 3.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30},
+    "claude-3-5-haiku-20241022": {"input": 0.80, "output": 4.00, "cache_write": 1.00, "cache_read": 0.08},
+}
+
+# The cheaper model the budget guard switches to when the projected spend of the run
+# would go over the budget
+FALLBACK_MODEL = "claude-3-5-haiku-20241022"
+
+# The token counts we keep for every call, row, stratum and run
+TOKEN_FIELDS = ["input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"]
+
+class BudgetExceededError(StopRunError):
+    """
+    Raised instead of sending a request that could take the spend of the run over its budget.
+    """
+
+def usage_cost(model: str, usage: Dict[str, int]):
+    """
+    Return the cost in USD of one call.
+    Args:
+        model: The model the call was sent to
+        usage: The token usage the backend reported for the call
+    """
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return 0.0
+    return (
+        (usage.get("input_tokens") or 0) * prices["input"]
+        + (usage.get("output_tokens") or 0) * prices["output"]
+        + (usage.get("cache_creation_input_tokens") or 0) * prices["cache_write"]
+        + (usage.get("cache_read_input_tokens") or 0) * prices["cache_read"]
+    ) / 1_000_000
+
+def _empty_totals():
+    totals = {field: 0 for field in TOKEN_FIELDS}
+    totals.update({"calls": 0, "cost": 0.0})
+    return totals
+
+def _add(totals: Dict[str, Any], usage: Dict[str, int], cost: float):
+    for field in TOKEN_FIELDS:
+        totals[field] += usage.get(field) or 0
+    totals["calls"] += 1
+    totals["cost"] += cost
+
+class TokenLedger:
+    """
+    Accounts for the tokens and the cost of every API call of a run, per row, per stratum
+    and for the whole run.
+
+    The calls of a row are held until the row finishes. If it produced a narrative, its last
+    call is the one that was used and every earlier call was wasted on a retry; if it failed,
+    all its calls were wasted.
+    """
+
+    def __init__(self, rows_to_generate: int = 0, price_factor: float = 1.0):
+        """
+        Args:
+            rows_to_generate: The number of rows the run still has to generate, for the
+                projection of its total spend
+            price_factor: The share of the list prices the calls are billed at, e.g. 0.5
+                for the Message Batches API
+        """
+        self.price_factor = price_factor
+        self.run = _empty_totals()
+        self.wasted = _empty_totals()
+        self.strata = {}
+        self.strata_rows = {}
+        self.rows = {}
+        self.open_rows = {}
+        self.rows_to_generate = rows_to_generate
+        self.rows_finished = 0
+        self.rows_accepted = 0
+
+    def record_call(self, row_key, stratum, model: str, usage: Dict[str, int]):
+        """
+        Record the usage of one call.
+        Args:
+            row_key: The row the call was made for, e.g. its row ID
+            stratum: The stratum of the row, e.g. its race
+            model: The model the call was sent to
+            usage: The token usage the backend reported for the call
+        Returns:
+            The cost of the call in USD.
+        """
+        cost = usage_cost(model, usage) * self.price_factor
+        _add(self.run, usage, cost)
+        _add(self.strata.setdefault(stratum, _empty_totals()), usage, cost)
+        self.open_rows.setdefault(row_key, []).append((usage, cost))
+        return cost
+
+    def finish_row(self, row_key, stratum, accepted: bool):
+        """
+        Close the accounting of a row.
+        Args:
+            row_key: The row, as passed to record_call
+            stratum: The stratum of the row
+            accepted: Whether the row produced a narrative that was written to the output
+        """
+        calls = self.open_rows.pop(row_key, [])
+        row = _empty_totals()
+        for usage, cost in calls:
+            _add(row, usage, cost)
+        for usage, cost in (calls[:-1] if accepted else calls):
+            _add(self.wasted, usage, cost)
+        self.rows[row_key] = row
+        self.strata_rows[stratum] = self.strata_rows.get(stratum, 0) + 1
+        self.rows_finished += 1
+        self.rows_accepted += accepted
+
+    @property
+    def rows_remaining(self):
+        return max(0, self.rows_to_generate - self.rows_finished)
+
+    def projected_cost(self):
+        """
+        Project the total spend of the run: what it has spent plus the average cost of a
+        finished row, retries included, for every row it still has to generate.
+        """
+        if not self.rows_finished:
+            return self.run["cost"]
+        return self.run["cost"] + self.run["cost"] / self.rows_finished * self.rows_remaining
+
+    def summary(self):
+        """
+        Return the accounting of the run as a dictionary that can be saved as JSON.
+        """
+        return {
+            "run": self.run,
+            "wasted_on_retries": self.wasted,
+            "strata": self.strata,
+            "strata_rows": self.strata_rows,
+            "rows": {str(key): totals for key, totals in self.rows.items()},
+            "rows_finished": self.rows_finished,
+            "rows_accepted": self.rows_accepted,
+        }
+
+    def save(self, path: str):
+        """
+        Save the summary of the run as JSON.
+        """
+        with open(path, "w") as usage_file:
+            json.dump(self.summary(), usage_file, indent=2)
+
+    def report_lines(self):
+        """
+        Describe the token usage and spend of the run.
+        Returns:
+            A list of lines to print.
+        """
+        run, wasted = self.run, self.wasted
+        wasted_share = wasted["cost"] / run["cost"] * 100 if run["cost"] else 0.0
+        # input_tokens counts only the uncached input tokens, the cache fields the rest
+        cache_read, cache_write = run["cache_read_input_tokens"], run["cache_creation_input_tokens"]
+        total_input = run["input_tokens"] + cache_read + cache_write
+        hit_rate = cache_read / total_input * 100 if total_input else 0.0
+        lines = [
+            f"Token usage: {run['calls']} calls, {run['input_tokens']} input, {run['output_tokens']} output, "
+            f"{cache_write} cache write and {cache_read} cache read tokens",
+            f"Prompt cache: {hit_rate:.1f}% of {total_input} input tokens read from cache",
+            f"Spend: ${run['cost']:.4f}, of which ${wasted['cost']:.4f} ({wasted_share:.1f}%) on "
+            f"{wasted['calls']} calls whose responses were not used",
+        ]
+        for stratum, totals in self.strata.items():
+            rows = self.strata_rows.get(stratum)
+            per_row = f", ${totals['cost'] / rows:.4f} per row" if rows else ""
+            lines.append(f"  {stratum}: {totals['calls']} calls, ${totals['cost']:.4f}{per_row}")
+        return lines
+
+class BudgetGuard:
+    """
+    Keeps the spend of a run within a budget.
+
+    Before a request is sent, the guard adds the worst case of the new request (its estimated
+    input tokens and max_tokens of output) to what the run has spent. If that could go over
+    the budget, the request is not sent and the run stops. If only the worst cases of the
+    requests in flight could take it over, the request waits for them to finish, as their
+    actual cost is usually far below their worst case. Well before that point, once the
+    projected spend of the whole run goes over the budget, the guard switches new requests
+    to a cheaper fallback model.
+    """
+
+    def __init__(self, ledger: TokenLedger, budget: float, fallback_model: Optional[str] = FALLBACK_MODEL):
+        """
+        Args:
+            ledger: The TokenLedger of the run
+            budget: The spend limit of the run in USD
+            fallback_model: The cheaper model used once the projection goes over budget,
+                or None to keep the model until the budget is spent
+        """
+        self.ledger = ledger
+        self.budget = budget
+        self.fallback_model = fallback_model
+        self.downgraded = False
+        self.reserved = 0.0
+        self._condition = None
+        self._loop = None
+
+    def _get_condition(self):
+        # Like the request scheduler, the condition is created on the running event loop
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+
+    def worst_case_cost(self, request: Dict[str, Any]):
+        """
+        The most a request can cost: every input token uncached plus max_tokens of output.
+        """
+        usage = {"input_tokens": estimate_input_tokens(request), "output_tokens": request["max_tokens"]}
+        return usage_cost(request["model"], usage)
+
+    def choose_model(self, request: Dict[str, Any]):
+        """
+        Switch a request to the fallback model once the projected spend is over budget.
+        Args:
+            request: The request keyword arguments. Its model may be changed in place
+        """
+        if not self.downgraded and self.fallback_model and self.ledger.projected_cost() > self.budget:
+            self.downgraded = True
+            print(f"Projected spend ${self.ledger.projected_cost():.2f} is over the ${self.budget:.2f} budget, "
+                  f"switching to {self.fallback_model}")
+        if self.downgraded:
+            request["model"] = self.fallback_model
+
+    def check(self, request: Dict[str, Any]):
+        """
+        Check a request against what the run has actually spent.
+        Raises:
+            BudgetExceededError: If sending the request could take the run over its budget
+        """
+        if self.ledger.run["cost"] + self.worst_case_cost(request) > self.budget:
+            raise BudgetExceededError(
+                f"The next request could take the spend over the ${self.budget:.2f} budget "
+                f"(${self.ledger.run['cost']:.4f} spent)"
+            )
+
+    async def reserve(self, request: Dict[str, Any]):
+        """
+        Hold the worst-case cost of a request while it is in flight, waiting for requests
+        in flight to finish while their reservations leave no room for it.
+        Returns:
+            The reserved amount, to pass to release once the call has been recorded.
+        Raises:
+            BudgetExceededError: If sending the request could take the run over its budget
+        """
+        amount = self.worst_case_cost(request)
+        condition = self._get_condition()
+        async with condition:
+            while True:
+                self.check(request)
+                if self.ledger.run["cost"] + self.reserved + amount <= self.budget or not self.reserved:
+                    break
+                await condition.wait()
+            self.reserved += amount
+        return amount
+
+    async def release(self, amount: float):
+        """
+        Give back a reservation once the call's usage has been recorded.
+        """
+        condition = self._get_condition()
+        async with condition:
+            self.reserved = max(0.0, self.reserved - amount)
+            condition.notify_all()